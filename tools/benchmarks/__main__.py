@@ -0,0 +1,154 @@
+import argparse
+import gc
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from oldschooltibia import recording, utils, _utils
+from oldschooltibia._rec import RecordingFormatRec
+
+from benchmarks import corpus
+
+
+def _read_rec_frames(filename):
+    # Returns the frames of a .rec file (version 515 or later) as (frame, checksum), without decrypting them
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    rec_version, num_frames = struct.unpack_from('<HI', data)
+    offset = 6
+    frames = []
+    for _ in range(num_frames - 57):
+        frame = recording.Frame()
+        frame_length, frame.time = struct.unpack_from('<HI', data, offset)
+        frame.data = data[offset + 6:offset + 6 + frame_length]
+        checksum, = struct.unpack_from('<I', data, offset + 6 + frame_length)
+        frames.append((frame, checksum))
+        offset += 6 + frame_length + 4
+
+    return rec_version, frames
+
+
+def _benchmarks(paths, tmp_dir):
+    # Returns a dict of benchmark name to a function that runs it once
+    # The setup, e.g. reading files that the benchmark does not load, is done here and not measured
+    benchmarks = {}
+
+    for name, path in paths.items():
+        benchmarks['load.' + name] = lambda path=path: recording.load(path)
+
+    benchmarks['load.trp.trp (compact, mmap)'] = lambda: recording.load(paths['trp.trp'], compact=True, use_mmap=True)
+    benchmarks['probe.rec518.rec'] = lambda: recording.probe(paths['rec518.rec'])
+
+    rec = recording.load(paths['trp.trp'])
+
+    def save(extension):
+        filename = os.path.join(tmp_dir, 'save' + extension)
+        if os.path.isfile(filename):
+            os.remove(filename)
+        recording.save(rec, filename)
+
+    benchmarks['save.trp'] = lambda: save('.trp')
+    benchmarks['save.trz'] = lambda: save('.trz')
+
+    # The stages of loading a .rec file on their own
+    rec_version, encrypted_frames = _read_rec_frames(paths['rec518.rec'])
+    benchmarks['simple_decrypt'] = lambda: [RecordingFormatRec._simple_decrypt(rec_version, checksum, frame) for frame, checksum in encrypted_frames]
+
+    aes_encrypted_data = [RecordingFormatRec._simple_decrypt(rec_version, checksum, frame) for frame, checksum in encrypted_frames]
+    benchmarks['aes_decrypt'] = lambda: [RecordingFormatRec._aes_decrypt(data) for data in aes_encrypted_data]
+
+    unmerged_frames = list(RecordingFormatRec._read_frames(paths['rec259.rec'], recording.Recording(), False, None))
+    benchmarks['merge_frames'] = lambda: list(_utils.merge_frames(unmerged_frames))
+
+    frames = rec.frames
+    benchmarks['get_all_strings'] = lambda: list(_utils.get_all_strings(frames, 4, False, False))
+    benchmarks['get_all_strings (unique, smart)'] = lambda: list(_utils.get_all_strings(frames, 4, True, True))
+    benchmarks['guess_version'] = lambda: utils.guess_version(frames)
+    benchmarks['guess_world'] = lambda: utils.guess_world(frames)
+
+    return benchmarks
+
+
+def run(benchmarks, repeat):
+    # Returns a dict of benchmark name to the best time of repeat runs, in seconds
+    results = {}
+    for name, benchmark in benchmarks.items():
+        times = []
+        for _ in range(repeat):
+            # Like timeit, do not let garbage collection of earlier runs disturb the timing
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                benchmark()
+                times.append(time.perf_counter() - start)
+            finally:
+                gc.enable()
+
+        results[name] = min(times)
+        print(f"{name:<32} {results[name] * 1000:10.2f} ms", file=sys.stderr)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks loading, saving and analysing recordings in all formats, using a generated corpus")
+    parser.add_argument("-n", "--packets", help="number of Tibia packets in each recording of the corpus", type=int, default=20000)
+    parser.add_argument("-r", "--repeat", help="run each benchmark this many times, and use the best time", type=int, default=5)
+    parser.add_argument("-c", "--corpus-dir", help="directory for the corpus, it is generated if it does not exist. Default is a directory in the system's temporary directory")
+    parser.add_argument("-k", "--filter", help="only run the benchmarks whose name contains this string")
+    parser.add_argument("-b", "--baseline", help="compare the results with the results in this file")
+    parser.add_argument("-t", "--threshold", help="report a regression if a benchmark is this much slower than the baseline, e.g. 0.2 for 20%%", type=float, default=0.2)
+    parser.add_argument("-s", "--save", help="save the results to this file, to use as a baseline later")
+    args = parser.parse_args()
+
+    corpus_dir = args.corpus_dir
+    if corpus_dir is None:
+        corpus_dir = os.path.join(tempfile.gettempdir(), f'oldschooltibia-benchmarks-{args.packets}')
+
+    print(f"Corpus: {corpus_dir}", file=sys.stderr)
+    paths = corpus.generate(corpus_dir, args.packets)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        benchmarks = _benchmarks(paths, tmp_dir)
+        if args.filter is not None:
+            benchmarks = {name: benchmark for name, benchmark in benchmarks.items() if args.filter in name}
+
+        results = run(benchmarks, args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'packets': args.packets, 'results': results}, f, indent=2)
+
+    if args.baseline is None:
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline['packets'] != args.packets:
+        print(f"'{args.baseline}': baseline is for {baseline['packets']} packets, not {args.packets}")
+        sys.exit(2)
+
+    num_regressions = 0
+    print(f"{'Benchmark':<32} {'Baseline':>10} {'Now':>10} {'Change':>8}")
+    for name, seconds in results.items():
+        if name not in baseline['results']:
+            print(f"{name:<32} {'-':>10} {seconds * 1000:8.2f}ms")
+            continue
+
+        change = seconds / baseline['results'][name] - 1
+        regression = change > args.threshold
+        num_regressions += regression
+        print(f"{name:<32} {baseline['results'][name] * 1000:8.2f}ms {seconds * 1000:8.2f}ms {change:+8.1%}{' REGRESSION' if regression else ''}")
+
+    print(f"Number of regressions: {num_regressions}")
+    sys.exit(1 if num_regressions > 0 else 0)
@@ -0,0 +1,252 @@
+import gzip
+import lzma
+import os
+import random
+import struct
+import zlib
+
+from Crypto.Cipher import AES
+
+from oldschooltibia import recording
+
+
+# The encoders below are written from the file format descriptions, independently of the loaders in
+# oldschooltibia, so that a bug in a loader does not cancel out the same bug in its encoder
+
+_AES = AES.new(b'\x54\x68\x79\x20\x6B\x65\x79\x20\x69\x73\x20\x6D\x69\x6E\x65\x20\xA9\x20\x32\x30\x30\x36\x20\x47\x42\x20\x4D\x6F\x6E\x61\x63\x6F', AES.MODE_ECB)
+
+_SIMPLE_MODULOS = {
+    515: 5,
+    516: 8,
+    517: 8,
+    518: 6,
+}
+
+# Tibia version of the recordings, the .rec files get the login message of this version
+VERSION = 740
+
+# Name of each file in the corpus, and the function that writes it
+FILES = {
+    'rec259.rec': lambda filename, packets, frames: _write_rec(filename, 259, frames),
+    'rec515.rec': lambda filename, packets, frames: _write_rec(filename, 515, frames),
+    'rec516.rec': lambda filename, packets, frames: _write_rec(filename, 516, frames),
+    'rec517.rec': lambda filename, packets, frames: _write_rec(filename, 517, frames),
+    'rec518.rec': lambda filename, packets, frames: _write_rec(filename, 518, frames),
+    'cam.cam': lambda filename, packets, frames: _write_cam(filename, frames),
+    'ttm.ttm': lambda filename, packets, frames: _write_ttm(filename, packets),
+    'tmv.tmv': lambda filename, packets, frames: _write_tmv(filename, frames),
+    'trp.trp': lambda filename, packets, frames: _write_trp(filename, packets),
+    'trz.trz': lambda filename, packets, frames: _write_trz(filename, packets),
+}
+
+_WORDS = ['hello', 'exura', 'sio', 'sword', 'rope', 'shovel', 'dragon', 'rotworm',
+          'depot', 'Thais', 'Carlin', 'gold', 'coins', 'you', 'see', 'a', 'the', 'of']
+
+
+def _string(s):
+    data = s.encode('latin-1')
+    return struct.pack('<H', len(data)) + data
+
+
+def _packets(rnd, num_packets):
+    # Returns a list of (time, Tibia packet), without the 2 byte packet length
+    # The first packets are a login, as guess_version and guess_world expect them
+    packets = [
+        b'\x0a' + struct.pack('<IH', 0x10000000 + rnd.randrange(0x1000000), 50) + b'\x00' + bytes(rnd.randrange(256) for _ in range(40)),
+        b'\xb4\x14' + _string('Your last visit in Tibia: 12. Mar 2005 18:12:22 CET.'),
+        b'\xb4\x16' + _string('Welcome to Antica!'),
+    ]
+
+    while len(packets) < num_packets:
+        kind = rnd.randrange(4)
+        if kind == 0:
+            # Speech
+            packets.append(b'\xaa' + _string(rnd.choice(['Player', 'Knight', 'Druid'])) + b'\x01' +
+                           _string(' '.join(rnd.choice(_WORDS) for _ in range(rnd.randrange(1, 10)))))
+        elif kind == 1:
+            # Text message
+            packets.append(b'\xb4' + bytes([rnd.choice((0x11, 0x13, 0x14, 0x16))]) +
+                           _string(' '.join(rnd.choice(_WORDS) for _ in range(rnd.randrange(1, 10)))))
+        elif kind == 2:
+            # Creature move
+            packets.append(b'\x6d' + bytes(rnd.randrange(256) for _ in range(11)))
+        else:
+            # Map data, mostly zeros as in real recordings
+            packets.append(b'\x65' + bytes(rnd.randrange(256) if rnd.randrange(8) == 0 else 0 for _ in range(rnd.randrange(16, 600))))
+
+    time = 0
+    timed_packets = []
+    for packet in packets:
+        timed_packets.append((time, packet))
+        time += rnd.choice((0, 0, 0, rnd.randrange(1, 300), rnd.randrange(300, 2000)))
+
+    return timed_packets
+
+
+def _frames(rnd, packets):
+    # Returns a list of (time, data) as TibiCAM stores them: the Tibia packets with their 2 byte
+    # length, where some frames contain several packets and some packets are split over frames
+    frames = []
+    data = bytearray()
+    time = packets[0][0]
+    for packet_time, packet in packets:
+        if data and (packet_time != time or rnd.randrange(4) == 0):
+            frames.append((time, bytes(data)))
+            data.clear()
+
+        time = packet_time
+        packet = struct.pack('<H', len(packet)) + packet
+
+        # Split some large packets, the rest of the packet gets the same time
+        while len(packet) > 256 and rnd.randrange(2) == 0:
+            split = rnd.randrange(1, len(packet))
+            frames.append((time, bytes(data + packet[:split])))
+            data.clear()
+            packet = packet[split:]
+
+        data += packet
+
+    frames.append((time, bytes(data)))
+    return frames
+
+
+def _simple_encrypt(rec_version, time, data):
+    # Inverse of RecordingFormatRec._simple_decrypt: TibiCAM adds the subtrahend to each byte
+    # Note: the key uses the length of the encrypted data, which is the same as the plain data
+    key = (len(data) + time + 2) & 0xFF
+    modulo = _SIMPLE_MODULOS[rec_version]
+
+    subtrahends = []
+    for i in range(256):
+        minus = (key + 33 * i) & 0xFF
+        minus = minus - 256 if minus > 127 else minus
+        if minus % modulo != 0:
+            minus += modulo - (minus % modulo)
+        subtrahends.append(minus & 0xFF)
+
+    return bytes((byte + subtrahends[i & 0xFF]) & 0xFF for i, byte in enumerate(data))
+
+
+def _aes_encrypt(data):
+    # Inverse of RecordingFormatRec._aes_decrypt: PKCS#7 padding, then AES-256 ECB
+    padding = 16 - len(data) % 16
+    return _AES.encrypt(data + bytes([padding]) * padding)
+
+
+def _write_rec(filename, rec_version, frames):
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<HI', rec_version, len(frames) + (57 if rec_version != 259 else 0)))
+        for time, data in frames:
+            if rec_version == 259:
+                f.write(struct.pack('<II', len(data), time))
+                f.write(data)
+                continue
+
+            if rec_version in (517, 518):
+                data = _aes_encrypt(data)
+
+            data = _simple_encrypt(rec_version, time, data)
+            f.write(struct.pack('<HI', len(data), time))
+            f.write(data)
+            f.write(struct.pack('<I', zlib.adler32(data, 1)))
+
+
+def _write_cam(filename, frames):
+    data = bytearray(struct.pack('<HI', 0, len(frames) + 57))
+    for time, frame_data in frames:
+        data += struct.pack('<HI', len(frame_data), time)
+        data += frame_data
+        data += bytes(4)
+
+    compressed_data = lzma.compress(data, format=lzma.FORMAT_ALONE)
+
+    # The compressed length does not include the LZMA header
+    version = str(VERSION)
+    with open(filename, 'wb') as f:
+        f.write(bytes(32))
+        f.write(bytes([int(version[0]), int(version[1]), int(version[2]), 0]))
+        f.write(struct.pack('<I', 0))
+        f.write(struct.pack('<I', len(compressed_data) - 13))
+        f.write(compressed_data)
+
+
+def _write_ttm(filename, packets):
+    server_name = b'localhost'
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<HB', VERSION, len(server_name)))
+        f.write(server_name)
+        f.write(struct.pack('<HI', 7171, packets[-1][0]))
+
+        previous_time = packets[0][0]
+        for i, (time, packet) in enumerate(packets):
+            if i > 0:
+                delay = time - previous_time
+                f.write(b'\x01' if delay == 1000 else b'\x00' + struct.pack('<H', delay))
+            f.write(struct.pack('<H', len(packet)))
+            f.write(packet)
+            previous_time = time
+
+
+def _write_tmv(filename, frames):
+    with gzip.open(filename, 'wb') as f:
+        f.write(struct.pack('<HHI', 2, VERSION, frames[-1][0]))
+
+        previous_time = frames[0][0]
+        for time, data in frames:
+            f.write(b'\x00' + struct.pack('<IH', time - previous_time, len(data)))
+            f.write(data)
+            previous_time = time
+
+
+def _write_trp(filename, packets):
+    with open(filename, 'wb') as f:
+        f.write(b'TRP\0')
+        f.write(struct.pack('<HII', VERSION, packets[-1][0], len(packets)))
+        for time, packet in packets:
+            f.write(struct.pack('<IH', time, len(packet)))
+            f.write(packet)
+
+
+def _write_trz(filename, packets):
+    # .trz is this project's own format, so its writer is used
+    rec = recording.Recording()
+    rec.version = VERSION
+    rec.length = packets[-1][0]
+    for time, packet in packets:
+        frame = recording.Frame()
+        frame.time = time
+        frame.data = packet
+        rec.frames.append(frame)
+
+    recording.save(rec, filename)
+
+
+def generate(directory, num_packets, seed=0):
+    """Writes a recording of num_packets Tibia packets in each format to directory.
+
+    The recordings are the same for the same num_packets and seed. Existing files are kept, so the
+    corpus is only written once for each directory. Returns a dict of file name to path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, name) for name in FILES}
+    if all(os.path.isfile(path) for path in paths.values()):
+        return paths
+
+    rnd = random.Random(seed)
+    packets = _packets(rnd, num_packets)
+    frames = _frames(rnd, packets)
+
+    for name, write in FILES.items():
+        if os.path.isfile(paths[name]):
+            continue
+
+        # Write to a temporary file first, so that an interrupted run does not leave a broken corpus
+        root, extension = os.path.splitext(paths[name])
+        tmp_filename = root + '.tmp' + extension
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+        write(tmp_filename, packets, frames)
+        os.replace(tmp_filename, paths[name])
+
+    return paths
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import sqlite3
+
+from oldschooltibia import recording, utils
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    format TEXT,
+    version INTEGER,
+    world TEXT,
+    length INTEGER,
+    num_frames INTEGER,
+    warnings TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_version ON recordings (version);
+CREATE INDEX IF NOT EXISTS recordings_world ON recordings (world COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS recordings_length ON recordings (length);
+CREATE INDEX IF NOT EXISTS recordings_hash ON recordings (hash);
+"""
+
+# Maximum number of files submitted to each worker at a time
+MAX_PENDING_PER_WORKER = 4
+
+COLUMNS = ('path', 'size', 'mtime', 'hash', 'format', 'version', 'world', 'length', 'num_frames', 'warnings', 'error')
+
+
+def open_catalog(filename):
+    db = sqlite3.connect(filename)
+
+    # Allow queries while a scan is running
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def scan_file(filename, size, mtime):
+    row = dict.fromkeys(COLUMNS)
+    row.update(path=filename, size=size, mtime=mtime)
+
+    try:
+        row['hash'] = utils.hash_file(filename)
+
+        # Warnings, e.g. about partial loading, are printed by recording
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            # The frames are loaded in the format that is stored, even if another format could load them
+            recording_format = recording.probe(filename, guess_version=False).recording_format
+            row['format'] = recording_format.extension
+            r = recording.load(filename, compact=True, use_mmap=True, recording_format=recording_format)
+            row['world'] = utils.guess_world(r.frames)
+
+        row['version'] = r.version
+        row['length'] = r.length
+        row['num_frames'] = len(r.frames)
+        row['warnings'] = output.getvalue().strip() or None
+
+    except Exception as e:
+        row['hash'] = row['hash'] or ''
+        row['error'] = str(e) or type(e).__name__
+
+    return row
+
+
+def scan_files(executor, to_scan, max_pending):
+    # Yields the row of each file as it is scanned, with at most max_pending files submitted at a time,
+    # so that memory use does not depend on the number of files
+    pending = set()
+    for args in to_scan:
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+        pending.add(executor.submit(scan_file, *args))
+
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def scan(db, paths, jobs):
+    # Find all files, and skip the ones that have not changed since the last scan
+    known = {path: (size, mtime) for path, size, mtime in db.execute('SELECT path, size, mtime FROM recordings')}
+    seen = set()
+    to_scan = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = (os.path.join(current_dir, filename) for current_dir, _, current_filenames in os.walk(path) for filename in current_filenames)
+        else:
+            filenames = [path]
+
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            try:
+                stat = os.stat(filename)
+            except OSError as e:
+                print(f"'{filename}': could not read file: {e}")
+                continue
+
+            seen.add(filename)
+            if known.get(filename) != (stat.st_size, stat.st_mtime_ns):
+                to_scan.append((filename, stat.st_size, stat.st_mtime_ns))
+
+    # Remove files that no longer exist in the scanned directories
+    roots = tuple(os.path.join(os.path.abspath(path), '') for path in paths if os.path.isdir(path))
+    removed = [(path, ) for path in known if path.startswith(roots) and path not in seen]
+    db.executemany('DELETE FROM recordings WHERE path = ?', removed)
+    db.commit()
+
+    print(f"Number of files found: {len(seen)}")
+    print(f"Number of files to scan: {len(to_scan)}")
+    print(f"Number of files removed: {len(removed)}")
+
+    num_scanned = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for row in scan_files(executor, to_scan, jobs * MAX_PENDING_PER_WORKER):
+            db.execute(f'INSERT OR REPLACE INTO recordings ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})',
+                       [row[column] for column in COLUMNS])
+
+            num_scanned += 1
+            if num_scanned % 100 == 0:
+                db.commit()
+                print(f"Scanned {num_scanned} / {len(to_scan)} files")
+
+    db.commit()
+    print(f"Number of files scanned: {num_scanned}")
+
+
+def query(db, args):
+    conditions = []
+    parameters = []
+
+    if args.errors:
+        conditions.append('error IS NOT NULL')
+    else:
+        conditions.append('error IS NULL')
+
+    if args.version is not None:
+        conditions.append('version = ?')
+        parameters.append(args.version)
+
+    if args.world is not None:
+        conditions.append('world = ? COLLATE NOCASE')
+        parameters.append(args.world)
+
+    if args.format is not None:
+        conditions.append('format = ?')
+        parameters.append(args.format if args.format.startswith('.') else '.' + args.format)
+
+    if args.min_length is not None:
+        conditions.append('length >= ?')
+        parameters.append(args.min_length * 1000)
+
+    if args.max_length is not None:
+        conditions.append('length <= ?')
+        parameters.append(args.max_length * 1000)
+
+    if args.duplicates:
+        conditions.append('hash IN (SELECT hash FROM recordings GROUP BY hash HAVING COUNT(*) > 1)')
+
+    sql = f'SELECT path, format, version, world, length, num_frames, warnings, error FROM recordings WHERE {" AND ".join(conditions)} ORDER BY path'
+    for path, file_format, version, world, length, num_frames, warnings, error in db.execute(sql, parameters):
+        if args.long and error:
+            print(f"{path}: Error: {error}")
+        elif args.long:
+            print(f"{path}: Format: {file_format} Version: {version} World: {world} Length: {length}ms Number of frames: {num_frames}"
+                  f"{' Warnings: ' + warnings if warnings else ''}")
+        else:
+            print(path, end='\0' if args.null else '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="keeps a catalog of recordings in an SQLite database")
+    parser.add_argument("DATABASE", help="the catalog database file, created if it does not exist")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = subparsers.add_parser('scan', help="add new and changed files to the catalog")
+    scan_parser.add_argument("-j", "--jobs", help="scan files in parallel using this many workers", type=int, default=1)
+    scan_parser.add_argument("FILE", help="file(s) to scan or directory to scan for files", nargs='+')
+
+    query_parser = subparsers.add_parser('query', help="print the files in the catalog that match all given conditions")
+    query_parser.add_argument("-v", "--version", help="Tibia version, e.g. 740", type=int)
+    query_parser.add_argument("-w", "--world", help="game world, e.g. Antica")
+    query_parser.add_argument("-f", "--format", help="file format, e.g. rec")
+    query_parser.add_argument("--min-length", help="minimum length in seconds", type=int)
+    query_parser.add_argument("--max-length", help="maximum length in seconds", type=int)
+    query_parser.add_argument("-d", "--duplicates", help="only files with the same content as another file", action='store_true')
+    query_parser.add_argument("-e", "--errors", help="only files that could not be loaded, instead of only files that could", action='store_true')
+    query_parser.add_argument("-l", "--long", help="print all information about each file, not only the path", action='store_true')
+    query_parser.add_argument("-0", "--null", help="separate paths with NUL instead of newline, e.g. for xargs -0", action='store_true')
+    args = parser.parse_args()
+
+    db = open_catalog(args.DATABASE)
+
+    if args.command == 'scan':
+        scan(db, args.FILE, args.jobs)
+    else:
+        query(db, args)
+
+    db.close()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import collections
 import concurrent.futures
+import filecmp
+import heapq
+import itertools
+import json
 import os
 import signal
+import sqlite3
 import sys
 import threading
 import time
 
-from oldschooltibia import recording
+from oldschooltibia import recording, utils, _utils
 
 
 def terminate_if_parent_dies(parent_pid):
@@ -23,23 +29,126 @@ def terminate_if_parent_dies(parent_pid):
     thread.start()
 
 
-def convert_file(filename, allow_partial, version, overwrite, rename, delete, output_dir):
+def init_worker(parent_pid, stdout_to_stderr):
+    terminate_if_parent_dies(parent_pid)
+
+    if stdout_to_stderr:
+        # The metrics are written to stdout, keep the messages out of them
+        sys.stdout = sys.stderr
+
+
+# A batch of files converted in one worker task ends when it has this many files or bytes,
+# or less when there are not enough files to give each worker a full batch
+BATCH_MAX_FILES = 32
+BATCH_MAX_SIZE = 4 * 1024 * 1024
+
+# Number of batches submitted per worker, the rest wait until a batch is done
+MAX_BATCHES_PER_WORKER = 2
+
+# Number of directory scans submitted per walker, the rest wait until a scan is done
+MAX_SCANS_PER_WALKER = 2
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    output TEXT
+);
+"""
+
+
+def open_manifest(filename):
+    db = sqlite3.connect(filename)
+
+    # Each converted file is committed, which only needs to wait for the disk on checkpoints with WAL
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(MANIFEST_SCHEMA)
+    return db
+
+
+def renamed_filename(filename):
+    # Returns filename with a number appended, so that it does not already exist
+    i = 1
+    filename_renamed = filename
+    while os.path.isfile(filename_renamed):
+        filename_renamed = f"{filename[:-4]}{i}{filename[-4:]}"
+        i += 1
+    return filename_renamed
+
+
+def temporary_filename(filename):
+    # Returns a filename in the same directory as filename, for writing a file that replaces it
+    temporary = os.path.join(os.path.dirname(filename), f".{os.path.basename(filename)[:-4]}.{os.getpid()}.trp")
+    if os.path.isfile(temporary):
+        os.remove(temporary)
+    return temporary
+
+
+def remove_output(filename):
+    # Removes an output file and its index, if they exist
+    for output_filename in (filename, recording.RecordingFormatTrp.index_filename(filename)):
+        try:
+            os.remove(output_filename)
+        except FileNotFoundError:
+            pass
+
+
+class LoadError(Exception):
+    """Raised when the source file can not be read while the output file is written.
+
+    The exception from the loader is the __cause__.
+    """
+    pass
+
+
+def load_errors(frames):
+    # Yields the frames, and raises the exceptions from reading them as LoadError,
+    # so that they are not reported as errors writing the output file
+    try:
+        yield from frames
+    except Exception as e:
+        raise LoadError() from e
+
+
+def convert_file(filename, allow_partial, version, overwrite, rename, delete, fsync, index, output_dir, previous_output=None, resume=False, metrics=None):
+    # If resume is set, an existing output file that is the same as the converted file is not an error
+    # metrics, if set, is a dict that gets the time spent loading, in each stage of loading,
+    # and saving, the output size and the reason for a failure
+    stats = recording.LoadStats() if metrics is not None else None
+    if metrics is None:
+        metrics = {}
+
+    # The frames are written while they are read, so that the whole recording is never in memory
+    start = time.perf_counter()
+    r = recording.Recording()
+    frames = recording.iter_frames(filename, allow_partial, rec=r, stats=stats)
     try:
-        r = recording.load(filename, allow_partial)
+        # Reading the first frame finds the format of the file, and the version if it is known
+        first_frames = list(itertools.islice(frames, 1))
     except Exception as e:
         print(f"'{filename}': could not load file: {e}")
+        metrics['error'] = type(e).__name__
         return False
+    finally:
+        metrics['load'] = time.perf_counter() - start
+        if stats is not None:
+            metrics['load_stages'] = {name: stage.time for name, stage in stats.stages.items()}
 
     # Abort if no version was provided and we could not guess one
     if version is None and r.version is None:
         print(f"'{filename}': could not guess version and no version explicitly set")
+        metrics['error'] = 'unknown version'
+        frames.close()
         return False
 
     # Overwrite recording version if overwrite set, or if recording version is unset (could not auto detect version)
     if overwrite or r.version is None:
         r.version = version
 
-    output_filename = os.path.split(filename)[1][:-3] + 'trp'
+    output_filename = os.path.splitext(os.path.basename(filename))[0] + '.trp'
     if subfolder:
         tmp = str(r.version)
         subfolder_dir = os.path.join(output_dir, tmp[0] + '.' + tmp[1:])
@@ -57,30 +166,360 @@ def convert_file(filename, allow_partial, version, overwrite, rename, delete, ou
     else:
         output = os.path.join(output_dir, output_filename)
 
-    if os.path.isfile(output):
-        if not rename:
+    existing_output = None
+    replaced_output = None
+    if previous_output is not None and os.path.abspath(output) == os.path.abspath(previous_output) and os.path.isfile(output):
+        # The source file has changed since it was converted, replace the old output file,
+        # but only once the new one is written, so that a failed conversion keeps it
+        replaced_output = output
+        output = temporary_filename(output)
+
+    elif os.path.isfile(output):
+        if resume:
+            # An interrupted run may have written the output file without recording it in the manifest,
+            # convert to a temporary file first to compare them
+            existing_output = output
+            output = temporary_filename(output)
+
+        elif not rename:
             print(f"'{output}': file already exists")
+            metrics['error'] = 'output exists'
+            frames.close()
             return False
 
-        # Find filename that does not already exist
-        i = 1
-        output_renamed = output
-        while os.path.isfile(output_renamed):
-            output_renamed = f"{output[:-4]}{i}{output[-4:]}"
-            i += 1
-        output = output_renamed
+        else:
+            output = renamed_filename(output)
 
+    start = time.perf_counter()
     try:
-        recording.save(r, output)
-        print(f"'{output}': wrote file with version {r.version}")
+        # The index is written when the output file has its final name
+        recording.save_frames(r, output, load_errors(itertools.chain(first_frames, frames)), fsync, index and existing_output is None and replaced_output is None)
+
+        if replaced_output is not None:
+            os.replace(output, replaced_output)
+            output = replaced_output
+            if fsync:
+                _utils.fsync_directory_deferred(os.path.dirname(os.path.abspath(output)))
+            print(f"'{output}': replaced file with version {r.version}")
+
+            if index:
+                recording.RecordingFormatTrp.save_index(output, fsync)
+
+        elif existing_output is not None:
+            if filecmp.cmp(output, existing_output, shallow=False):
+                os.remove(output)
+                output = existing_output
+                print(f"'{output}': file already exists, and is the same as the converted file")
+
+            elif rename:
+                output_renamed = renamed_filename(existing_output)
+                os.rename(output, output_renamed)
+                output = output_renamed
+                if fsync:
+                    _utils.fsync_directory_deferred(os.path.dirname(os.path.abspath(output)))
+                print(f"'{output}': wrote file with version {r.version}")
+
+            else:
+                os.remove(output)
+                print(f"'{existing_output}': file already exists")
+                metrics['error'] = 'output exists'
+                return False
+
+            if index and not os.path.isfile(recording.RecordingFormatTrp.index_filename(output)):
+                recording.RecordingFormatTrp.save_index(output, fsync)
+
+        else:
+            print(f"'{output}': wrote file with version {r.version}")
+
+    except LoadError as e:
+        print(f"'{filename}': could not load file: {e.__cause__}")
+        metrics['error'] = type(e.__cause__).__name__
+        if (existing_output is not None or replaced_output is not None) and os.path.isfile(output):
+            os.remove(output)
+        return False
     except Exception as e:
         print(f"'{output}': could not write file: {e}")
+        metrics['error'] = type(e).__name__
+        if (existing_output is not None or replaced_output is not None) and os.path.isfile(output):
+            os.remove(output)
         return False
+    finally:
+        frames.close()
+        metrics['save'] = time.perf_counter() - start
+        if stats is not None:
+            # The rest of the frames were read while they were written, move that time from save to load
+            load_stages = {name: stage.time for name, stage in stats.stages.items()}
+            read_time = sum(load_stages.values()) - sum(metrics['load_stages'].values())
+            metrics['load'] += read_time
+            metrics['save'] -= read_time
+            metrics['load_stages'] = load_stages
+
+    metrics['output_bytes'] = os.path.getsize(output)
+
+    if previous_output is not None and os.path.abspath(output) != os.path.abspath(previous_output):
+        # The output file has moved, e.g. to another version subfolder, remove the old one
+        remove_output(previous_output)
 
     if delete:
+        if fsync:
+            # The output must be on disk before the source is removed, even in a batch
+            _utils.fsync_directory(os.path.dirname(os.path.abspath(output)))
         os.remove(filename)
 
-    return True
+    return output
+
+
+def convert_file_with_manifest(filename, previous, *args, metrics=None):
+    # previous is the (hash, output) of the last successful conversion of this file, if any
+    # Returns the output filename, or None if the conversion failed, and the hash of the file
+    start = time.perf_counter()
+    try:
+        file_hash = utils.hash_file(filename)
+    except OSError as e:
+        print(f"'{filename}': could not read file: {e}")
+        if metrics is not None:
+            metrics['error'] = type(e).__name__
+        return None, None
+    finally:
+        if metrics is not None:
+            metrics['hash'] = time.perf_counter() - start
+
+    previous_output = None
+    if previous is not None:
+        previous_hash, previous_output = previous
+        if file_hash == previous_hash and os.path.isfile(previous_output):
+            print(f"'{filename}': not changed since it was converted to '{previous_output}'")
+            return previous_output, file_hash
+
+    return convert_file(filename, *args, previous_output=previous_output, resume=True, metrics=metrics), file_hash
+
+
+def convert_files(tasks, convert_args, use_manifest, measure, submitted):
+    # Converts a batch of files in one worker task, which is cheaper than one task per file
+    # Returns (output filename or None, hash or None, metrics or None) for each file
+    # With fsync, the output directories are flushed to disk once for the batch instead of once per file
+    results = []
+    with _utils.fsync_batch():
+        for filename, _, _, _, previous in tasks:
+            # The time since the batch was submitted includes the earlier files in the batch
+            metrics = {'queue': time.time() - submitted} if measure else None
+            start = time.perf_counter()
+            if use_manifest:
+                output, file_hash = convert_file_with_manifest(filename, previous, *convert_args, metrics=metrics)
+            else:
+                output, file_hash = convert_file(filename, *convert_args, metrics=metrics), None
+            if measure:
+                metrics['total'] = time.perf_counter() - start
+
+            results.append((output, file_hash, metrics))
+    return results
+
+
+class RunMetrics:
+    """Collects metrics about a conversion run, and writes them as JSON lines.
+
+    Each converted file, progress every few seconds and a summary at the end are written as
+    one JSON object per line, with a "type" of "file", "progress" or "summary".
+    """
+
+    # Seconds between progress lines
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, f, num_slowest=10):
+        self.f = f
+        self.num_slowest = num_slowest
+        self.start = time.perf_counter()
+        self.num_files = 0
+        self.num_failed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.stages = collections.Counter()
+        self.failures = collections.Counter()
+        self.slowest = []
+
+        # Progress is written by a thread, so that it is also written while a large file is converted
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._write_progress, daemon=True)
+        self._thread.start()
+
+    def _write(self, line):
+        with self._lock:
+            self.f.write(json.dumps(line) + '\n')
+            self.f.flush()
+
+    def _write_progress(self):
+        while not self._stop.wait(self.PROGRESS_INTERVAL):
+            self._write({'type': 'progress', **self._rates()})
+
+    def _rates(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'elapsed': elapsed,
+            'files': self.num_files,
+            'failed': self.num_failed,
+            'files_per_s': self.num_files / elapsed if elapsed > 0 else 0,
+            'input_mb_per_s': self.input_bytes / elapsed / 1e6 if elapsed > 0 else 0,
+            'output_mb_per_s': self.output_bytes / elapsed / 1e6 if elapsed > 0 else 0,
+        }
+
+    def add_file(self, filename, input_bytes, output, metrics):
+        self.num_files += 1
+        self.input_bytes += input_bytes
+        self.output_bytes += metrics.get('output_bytes', 0)
+        for stage in ('queue', 'hash', 'load', 'save'):
+            if stage in metrics:
+                self.stages[stage] += metrics[stage]
+
+        # Stages of loading, e.g. decryption, are part of 'load'
+        for stage, seconds in metrics.get('load_stages', {}).items():
+            self.stages['load.' + stage] += seconds
+
+        if not output:
+            self.num_failed += 1
+            self.failures[metrics.get('error', 'unknown')] += 1
+
+        entry = (metrics['total'], filename)
+        if len(self.slowest) < self.num_slowest:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+        self._write({'type': 'file', 'filename': filename, 'input_bytes': input_bytes, 'output': output or None, **metrics})
+
+    def summary(self):
+        self._stop.set()
+        self._thread.join()
+
+        summary = {
+            'type': 'summary',
+            **self._rates(),
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'stages': dict(self.stages),
+            'failures': dict(self.failures),
+            'slowest': [{'filename': filename, 'total': total} for total, filename in sorted(self.slowest, reverse=True)],
+        }
+        self._write(summary)
+        return summary
+
+
+def scan_dir(path, file_filter):
+    # Returns (filename, stat) for each file in a directory, with stat None if the file is ignored,
+    # and the subdirectories
+    files = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    # Symbolic links to directories are not followed, like os.walk() does not
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+
+                if file_filter != 'none' and not recording.is_recording(entry.path, file_filter == 'sniff'):
+                    files.append((entry.path, None))
+                    continue
+
+                # The stat result is cached by the DirEntry, or costs one call here instead of one later
+                files.append((entry.path, entry.stat()))
+
+            except OSError as e:
+                print(f"'{entry.path}': could not read file: {e}")
+
+    return files, subdirs
+
+
+def iter_files(paths, file_filter, walkers):
+    # Yields (filename, stat) for each file given or found in a directory, with stat None if the file
+    # is ignored by file_filter. Files given explicitly are never ignored.
+    # Directories are scanned in parallel, since listing a directory is slow on network filesystems.
+    # At most MAX_SCANS_PER_WALKER scans per walker are submitted at a time, the other directories
+    # wait in a stack, so that memory use does not depend on the width of the directory tree
+    with concurrent.futures.ThreadPoolExecutor(max_workers=walkers) as executor:
+        pending = {}
+        directories = []
+        for path in paths:
+            if os.path.isdir(path):
+                directories.append(path)
+                continue
+
+            try:
+                yield path, os.stat(path)
+            except OSError as e:
+                print(f"'{path}': could not read file: {e}")
+
+        # Scan the directories in the order they were given
+        directories.reverse()
+
+        while pending or directories:
+            while directories and len(pending) < walkers * MAX_SCANS_PER_WALKER:
+                path = directories.pop()
+                pending[executor.submit(scan_dir, path, file_filter)] = path
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    files, subdirs = future.result()
+                except OSError as e:
+                    print(f"'{path}': could not read directory: {e}")
+                    continue
+
+                directories.extend(reversed(subdirs))
+
+                yield from files
+
+
+def batched(tasks, jobs):
+    # Groups small files together, a large file gets a batch of its own
+    # The files for a full batch per worker are read ahead, so that the last files (or all of them,
+    # if there are only a few) are split evenly over the workers instead of put in one batch
+    tasks = iter(tasks)
+    pending = collections.deque()
+    pending_size = 0
+    while True:
+        while len(pending) < jobs * BATCH_MAX_FILES and pending_size < jobs * BATCH_MAX_SIZE:
+            task = next(tasks, None)
+            if task is None:
+                break
+
+            pending.append(task)
+            pending_size += task[2]
+
+        if not pending:
+            return
+
+        max_files = min(BATCH_MAX_FILES, -(-len(pending) // jobs))
+        max_size = min(BATCH_MAX_SIZE, -(-pending_size // jobs))
+
+        batch = []
+        batch_size = 0
+        while pending and len(batch) < max_files and batch_size < max_size:
+            task = pending.popleft()
+            batch.append(task)
+            batch_size += task[2]
+
+        pending_size -= batch_size
+        yield batch
+
+
+def run_batches(executor, batches, max_pending, *args):
+    # Yields (batch, results) as batches complete, with at most max_pending batches submitted at a time
+    # so that the files are found while the first ones are converted, and memory use does not depend
+    # on the number of files
+    pending = {}
+    for batch in batches:
+        if len(pending) >= max_pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+        pending[executor.submit(convert_files, batch, *args, time.time())] = batch
+
+    for future in concurrent.futures.as_completed(pending):
+        yield pending[future], future.result()
 
 
 if __name__ == '__main__':
@@ -91,6 +530,14 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--overwrite", help="always use the version provided with -v/--version, even if a version was automatically detected", action='store_true')
     parser.add_argument("-r", "--rename", help="if an output file already exist, append a number to the end of it", action='store_true')
     parser.add_argument("-d", "--delete", help="delete source file if it was converted successfully", action='store_true')
+    parser.add_argument("-F", "--fsync", help="make sure that each output file is written to disk before continuing. The directory entries are written to disk once per batch of files", action='store_true')
+    parser.add_argument("-i", "--index", help="also write an index (.trpi) for each output file, for seeking in the recording", action='store_true')
+    parser.add_argument("-m", "--manifest", help="record converted files in this database, and skip files that are already converted and not changed since")
+    parser.add_argument("-f", "--filter", help="which files found in directories to convert: files with the extension of a supported format ('extension'), "
+                                               "those and files with the content of one ('sniff', the default), or all files ('none')",
+                        choices=('extension', 'sniff', 'none'), default='sniff')
+    parser.add_argument("-w", "--walkers", help="scan this many directories in parallel", type=int, default=8)
+    parser.add_argument("-M", "--metrics", help="write metrics about the conversion as JSON lines to this file, - for stdout (the messages are then written to stderr)")
     parser.add_argument("-j", "--jobs", help="convert files in parallel using this many workers", type=int, default=1)
     parser.add_argument("OUTPUT_DIR", help="output files will be placed in this directory")
     parser.add_argument("FILE", help="file(s) to convert or directory to scan for files", nargs='+')
@@ -102,6 +549,12 @@ if __name__ == '__main__':
     overwrite = args.overwrite
     rename = args.rename
     delete = args.delete
+    fsync = args.fsync
+    index = args.index
+    manifest = args.manifest
+    file_filter = args.filter
+    walkers = args.walkers
+    metrics_filename = args.metrics
     jobs = args.jobs
     output_dir = args.OUTPUT_DIR
     filenames = args.FILE
@@ -110,6 +563,12 @@ if __name__ == '__main__':
         print("-v/--version must be set when -o/--overwrite is set")
         sys.exit(1)
 
+    metrics_file = None
+    if metrics_filename == '-':
+        # Keep stdout for the metrics
+        metrics_file = sys.stdout
+        sys.stdout = sys.stderr
+
     print("Converting with the following options:")
     print(f"\tallow_partial = {allow_partial}")
     print(f"\tsubfolder     = {subfolder}")
@@ -117,29 +576,102 @@ if __name__ == '__main__':
     print(f"\toverwrite     = {overwrite}")
     print(f'\trename        = {rename}')
     print(f"\tdelete        = {delete}")
+    print(f"\tfsync         = {fsync}")
+    print(f"\tindex         = {index}")
+    print(f"\tmanifest      = {manifest if manifest is not None else "<not set>"}")
+    print(f"\tfilter        = {file_filter}")
+    print(f"\tmetrics       = {metrics_filename if metrics_filename is not None else "<not set>"}")
     print(f"\tOUTPUT_DIR    = {output_dir}")
 
     if not os.path.isdir(output_dir):
         print(f"'{output_dir}' does not exist, creating directory")
         os.mkdir(output_dir)
 
-    filenames_to_process = []
-    for filename in filenames:
-        if os.path.isdir(filename):
-            for current_dir, _, current_filenames in os.walk(filename):
-                filenames_to_process += [os.path.join(current_dir, filename) for filename in current_filenames]
-        else:
-            filenames_to_process.append(filename)
+    db = None
+    if manifest is not None:
+        db = open_manifest(manifest)
+
+    num_processed = 0
+    num_skipped = 0
+    num_ignored = 0
+
+    def iter_tasks():
+        # Yields (filename, source, size, mtime, previous) for each file that should be converted
+        global num_processed, num_skipped, num_ignored
+        for filename, stat in iter_files(filenames, file_filter, walkers):
+            if stat is None:
+                print(f"'{filename}': ignored, not a recording")
+                num_ignored += 1
+                continue
+
+            num_processed += 1
+            source = os.path.abspath(filename)
+
+            # Skip files that were converted and have the same size and mtime as then
+            # Files that failed are converted again, and changed files replace their previous output
+            row = db.execute('SELECT size, mtime, hash, output FROM conversions WHERE source = ?', (source, )).fetchone() if db is not None else None
+            size, mtime, file_hash, output = row or (None, None, None, None)
+            if output is not None and (size, mtime) == (stat.st_size, stat.st_mtime_ns) and os.path.isfile(output):
+                num_skipped += 1
+                continue
+
+            previous = (file_hash, output) if output is not None else None
+            yield filename, source, stat.st_size, stat.st_mtime_ns, previous
+
+    convert_args = (allow_partial, version, overwrite, rename, delete, fsync, index, output_dir)
+
+    run_metrics = None
+    if metrics_filename is not None:
+        run_metrics = RunMetrics(metrics_file or open(metrics_filename, 'w'))
 
     num_converted = 0
-    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=terminate_if_parent_dies, initargs=(os.getpid(), )) as executor:
-        futures = {
-            executor.submit(convert_file, filename, allow_partial, version, overwrite, rename, delete, output_dir): filename for filename in filenames_to_process
-        }
-        for future in concurrent.futures.as_completed(futures):
-            if future.result():
-                num_converted += 1
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(os.getpid(), metrics_file is not None)) as executor:
+            for batch, results in run_batches(executor, batched(iter_tasks(), jobs), jobs * MAX_BATCHES_PER_WORKER, convert_args, manifest is not None, metrics_filename is not None):
+                for (filename, source, size, mtime, _), (output, file_hash, metrics) in zip(batch, results):
+                    if output:
+                        num_converted += 1
 
-    print(f'Number of files processed: {len(filenames_to_process)}')
+                    if run_metrics is not None:
+                        run_metrics.add_file(filename, size, output, metrics)
+
+                    if db is None or file_hash is None:
+                        continue
+
+                    # Commit each file, so that an interrupted run can be resumed without converting it again
+                    db.execute('INSERT OR REPLACE INTO conversions (source, size, mtime, hash, output) VALUES (?, ?, ?, ?, ?)',
+                               (source, size, mtime, file_hash, os.path.abspath(output) if output else None))
+                    db.commit()
+
+    finally:
+        if db is not None:
+            db.commit()
+            db.close()
+
+    if file_filter != 'none':
+        print(f'Number of files ignored: {num_ignored}')
+    print(f'Number of files processed: {num_processed}')
+    if manifest is not None:
+        print(f'Number of files skipped: {num_skipped}')
     print(f'Number of files converted: {num_converted}')
-    print(f'Number of files failed: {len(filenames_to_process) - num_converted}')
+    print(f'Number of files failed: {num_processed - num_skipped - num_converted}')
+
+    if run_metrics is not None:
+        summary = run_metrics.summary()
+        if run_metrics.f is not metrics_file:
+            run_metrics.f.close()
+
+        print(f"Files per second: {summary['files_per_s']:.1f}")
+        print(f"Input MB per second: {summary['input_mb_per_s']:.1f}")
+        print(f"Output MB per second: {summary['output_mb_per_s']:.1f}")
+        print("Time spent per stage (summed over all workers):")
+        width = max(map(len, summary['stages']), default=0)
+        for stage, seconds in summary['stages'].items():
+            print(f"\t{stage:<{width}} = {seconds:.2f}s")
+        if summary['failures']:
+            print("Failures:")
+            for reason, count in sorted(summary['failures'].items(), key=lambda failure: -failure[1]):
+                print(f"\t{reason}: {count}")
+        print("Slowest files:")
+        for slow in summary['slowest']:
+            print(f"\t{slow['total']:.3f}s {slow['filename']}")
@@ -40,6 +40,10 @@ def print_bytes(data):
         offset += 16
 
 
+def or_unknown(value, suffix=''):
+    return "UNKNOWN" if value is None else f"{value}{suffix}"
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--full", help="dump all frames", action='store_true')
@@ -52,14 +56,25 @@ if __name__ == '__main__':
     filenames = args.FILE
 
     for filename in filenames:
+        if not full:
+            # Only the header is needed
+            try:
+                info = recording.probe(filename)
+            except Exception as e:
+                print(f"'{filename}': could not load file: {e}")
+                continue
+
+            print(f"'{filename}': Format: {info.recording_format.extension} Version: {or_unknown(info.version)} Length: {or_unknown(info.length, 'ms')} "
+                  f"Number of frames: {or_unknown(info.num_frames)} File size: {info.file_size} Data size: {or_unknown(info.data_size)}")
+            continue
+
         try:
-            r = recording.load(filename, allow_partial)
+            r = recording.load(filename, allow_partial, use_mmap=True)
         except Exception as e:
             print(f"'{filename}': could not load file: {e}")
             continue
 
         print(f"'{filename}': Version: {r.version} Length: {r.length}ms Number of frames: {len(r.frames)}")
-        if full:
-            for i, frame in enumerate(r.frames):
-                print(f"'{filename}': Frame: {i} Time: {frame.time} Length: {len(frame.data)}")
-                print_bytes(frame.data)
+        for i, frame in enumerate(r.frames):
+            print(f"'{filename}': Frame: {i} Time: {frame.time} Length: {len(frame.data)}")
+            print_bytes(frame.data)
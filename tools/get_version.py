@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 
-from oldschooltibia import recording, utils
+from oldschooltibia import recording
 
 
 if __name__ == '__main__':
@@ -13,12 +13,9 @@ if __name__ == '__main__':
 
     for filename in filenames:
         try:
-            r = recording.load(filename, True)
+            info = recording.probe(filename)
         except Exception as e:
             print(f"'{filename}': could not load file: {e}")
             continue
 
-        if r.version is None:
-            r.version = utils.guess_version(r.frames)
-
-        print(f'{filename}: {"UNKNOWN" if r.version is None else r.version}')
+        print(f'{filename}: {"UNKNOWN" if info.version is None else info.version}')
@@ -13,10 +13,9 @@ if __name__ == '__main__':
 
     for filename in filenames:
         try:
-            r = recording.load(filename, True)
+            world = utils.guess_world(recording.iter_frames(filename, True, use_mmap=True))
         except Exception as e:
             print(f"'{filename}': could not load file: {e}")
             continue
 
-        world = utils.guess_world(r.frames)
         print(f'{filename}: {"UNKNOWN" if world is None else world}')
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import struct
+
+from oldschooltibia import recording, _utils
+
+
+# The cache is a directory with one file for each decoded recording, named after a hash of the
+# recording's path, size and modification time. A file starts with the magic 'OSTC', the version
+# (0 if unknown) and length of the recording and the number of frames, followed by the frames.
+# The files are written atomically, so several processes can use the same cache directory
+_HEADER = struct.Struct('<4sHII')
+
+# Frame time and frame length
+_FRAME_HEADER = struct.Struct('<IH')
+
+# Increase this if the format of the cache files changes, so that old files are not used
+_CACHE_VERSION = 1
+
+_CACHE_EXTENSION = '.ostc'
+
+# Environment variables for the cache directory, and for the maximum size of it in MiB
+CACHE_DIR_ENV = 'OLDSCHOOLTIBIA_CACHE_DIR'
+CACHE_SIZE_ENV = 'OLDSCHOOLTIBIA_CACHE_SIZE'
+
+_DEFAULT_CACHE_SIZE = 1024
+
+
+class RecordingFormatCache(recording.RecordingFormat):
+    """Reads the cache files, which are not recordings that can be loaded on their own.
+    """
+
+    extension = _CACHE_EXTENSION
+
+    def _read_frames(filename, rec, use_mmap):
+        with _utils.open_reader(filename, use_mmap) as reader:
+
+            magic, version, rec.length, num_frames = reader.unpack(_HEADER)
+            if magic != b'OSTC':
+                raise recording.InvalidFileError(f"invalid magic={magic}")
+
+            rec.version = version if version != 0 else None
+
+            for _ in range(num_frames):
+                frame = recording.Frame()
+                frame.time, frame_length = reader.unpack(_FRAME_HEADER)
+                frame.data = reader.read(frame_length)
+                if len(frame.data) != frame_length:
+                    raise EOFError("EOF")
+
+                yield frame
+
+
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        return _utils.measure_frames(stats, 'read', RecordingFormatCache._read_frames(filename, rec, use_mmap))
+
+
+class Cache:
+    """A directory of decoded recordings, with a maximum size.
+
+    When the cache is larger than max_size bytes the least recently used recordings are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        # Size of the cache directory, from the last time it was scanned plus the files stored since,
+        # None until it is scanned. Files stored by other processes are found on the next scan
+        self._size = None
+
+    def _cache_filename(self, filename, recording_format):
+        # A changed file gets a new cache file, the old one is eventually evicted
+        stat = os.stat(filename)
+        key = f'{_CACHE_VERSION}\0{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{recording_format.extension}'
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() + _CACHE_EXTENSION)
+
+    def lookup(self, filename, recording_format):
+        """Returns the cache file for a recording, or None if it is not cached.
+        """
+        cache_filename = self._cache_filename(filename, recording_format)
+        try:
+            # The modification time of a cache file is the last time it was used
+            os.utime(cache_filename)
+        except OSError:
+            return None
+
+        return cache_filename
+
+    def remove(self, filename, recording_format):
+        """Removes a recording from the cache, e.g. because its cache file is broken.
+        """
+        try:
+            os.remove(self._cache_filename(filename, recording_format))
+        except OSError:
+            # Not cached, or removed by another process
+            pass
+
+    def store_frames(self, filename, recording_format, rec, frames):
+        """Yields the frames from frames, while writing them to the cache.
+
+        The cache file is only kept if all frames could be read.
+        """
+        cache_filename = self._cache_filename(filename, recording_format)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Note: another process may store the same recording at the same time, which is fine
+        with _utils.open_atomic(cache_filename, overwrite=True) as f:
+
+            # Reserve space for the header
+            f.write(bytes(_HEADER.size))
+
+            # The version is set by the format before the first frame, later it may be guessed
+            version = rec.version
+            num_frames = 0
+            size = _HEADER.size
+            for frame in frames:
+                if num_frames == 0:
+                    version = rec.version
+
+                f.write(_FRAME_HEADER.pack(frame.time, len(frame.data)))
+                f.write(frame.data)
+                num_frames += 1
+                size += _FRAME_HEADER.size + len(frame.data)
+
+                yield frame
+
+            f.seek(0)
+            f.write(_HEADER.pack(b'OSTC', version or 0, rec.length, num_frames))
+
+        # The directory is only scanned when the cache may be too large, not for every stored file
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size:
+            self._evict()
+
+    def store(self, filename, recording_format, rec):
+        """Writes a loaded recording to the cache.
+        """
+        for _ in self.store_frames(filename, recording_format, rec, rec.frames):
+            pass
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(_CACHE_EXTENSION):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed by another process
+                    continue
+
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by another process, or in use on Windows
+                pass
+
+            size -= entry_size
+
+        self._size = size
+
+
+# Cache for each (directory, max_size), see get_cache()
+_caches = {}
+
+
+def get_cache(cache_dir=None):
+    """Returns the cache in cache_dir, or in the directory set in the environment, or None.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+
+    if not cache_dir:
+        return None
+
+    # The same Cache is returned for the same directory, so that its size is only scanned once
+    max_size = int(os.environ.get(CACHE_SIZE_ENV, _DEFAULT_CACHE_SIZE)) * 1024 * 1024
+    key = (os.path.abspath(cache_dir), max_size)
+    if key not in _caches:
+        _caches[key] = Cache(cache_dir, max_size)
+
+    return _caches[key]
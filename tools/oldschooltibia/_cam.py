@@ -1,86 +1,169 @@
-import io
 import lzma
+import struct
 
 from oldschooltibia import recording, _utils
 
 
+# Tibia version (three digits) and one unknown byte
+_VERSION = struct.Struct('<4B')
+
+# Frame length and frame time
+_FRAME_HEADER = struct.Struct('<HI')
+
+# LZMA properties, dictionary size and decompressed length
+_LZMA_HEADER = struct.Struct('<BIQ')
+
+# The compressed data is read in chunks of this size
+_READ_SIZE = 64 * 1024
+
+
+class _Decompressor:
+    """A file object with the decompressed data of the LZMA data read from reader.
+
+    The compressed data is read and decompressed a chunk at a time, so that neither the
+    compressed nor the decompressed data needs to be in memory at once.
+    """
+
+    def __init__(self, reader, compressed_len):
+        self._reader = reader
+        self._remaining = compressed_len
+        self._decompressor = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+
+    def read(self, size):
+        while not self._decompressor.eof:
+            data = b''
+            if self._decompressor.needs_input:
+                data = self._reader.read(min(self._remaining, _READ_SIZE))
+                if not data:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                self._remaining -= len(data)
+
+            decompressed = self._decompressor.decompress(data, max_length=size)
+            if decompressed:
+                return decompressed
+
+        return b''
+
+
 class RecordingFormatCam(recording.RecordingFormat):
 
     extension = '.cam'
-    has_magic = False
 
-    def load(filename):
+    def sniff(data):
+        if len(data) < 32 + _VERSION.size + 4:
+            return 0
+
+        # Same calculation as in _read_frames()
+        major, minor, patch, _ = _VERSION.unpack_from(data, 32)
+        version = ((major * 10) | minor) * 10 | patch
+        if version < 700 or version > 1200:
+            return 0
+
+        # The compressed data starts with the LZMA properties byte, which is (pb * 5 + lp) * 9 + lc
+        # and almost always 0x5D (the default properties)
+        metadata_len = struct.unpack_from('<I', data, 32 + _VERSION.size)[0]
+        properties_offset = 32 + _VERSION.size + 4 + metadata_len + 4
+        if properties_offset >= len(data):
+            return 30
+
+        properties = data[properties_offset]
+        if properties >= 9 * 5 * 5:
+            return 0
+
+        return 80 if properties == 0x5D else 60
+
+
+    def _read_header(reader):
+        # Returns Tibia version and the length of the compressed data (without the LZMA header)
         # This implementation is based on https://github.com/tibiacast/tibiarc/blob/main/lib/formats/cam.c
         # and https://github.com/tulio150/tibia-ttm/blob/master/File%20Formats.txt
 
-        rec = recording.Recording()
-        exception = None
+        # Skip header
+        reader.skip(32)
+
+        # Read Tibia version
+        major, minor, patch, _ = reader.unpack(_VERSION)
+        version = major
+        version *= 10
+        version |= minor
+        version *= 10
+        version |= patch
+
+        # No idea what versions are valid...
+        if version < 700 or version > 1200:
+            raise recording.InvalidFileError(f"invalid version={version}")
+
+        # Skip metadata
+        metadata_len = reader.read_u32()
+        reader.skip(metadata_len)
+
+        compressed_len = reader.read_u32()
+
+        return version, compressed_len
+
+
+    def probe(filename, info):
+        with _utils.open_reader(filename, use_mmap=True) as reader:
+            info.version, _ = RecordingFormatCam._read_header(reader)
+
+            # The LZMA header contains the decompressed length, if it is known
+            lzma_header = reader.read(_LZMA_HEADER.size)
+            _, _, decompressed_len = _LZMA_HEADER.unpack(lzma_header)
+            if decompressed_len != 0xFFFFFFFFFFFFFFFF:
+                info.data_size = decompressed_len
 
-        try:
-            with open(filename, 'rb') as f:
-                # Skip header
-                f.read(32)
+            # Only decompress enough to get the number of frames
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+            try:
+                data = decompressor.decompress(bytes(lzma_header) + reader.read(4096), max_length=6)
+            except lzma.LZMAError as e:
+                raise recording.InvalidFileError(f"could not decompress data: {e}")
 
-                # Read Tibia version
-                version = _utils.read_u8(f)
-                version *= 10
-                version |= _utils.read_u8(f)
-                version *= 10
-                version |= _utils.read_u8(f)
-                f.read(1)
-                rec.version = version
+            if len(data) == 6:
+                info.num_frames = max(struct.unpack_from('<I', data, 2)[0] - 57, 0)
 
-                # No idea what versions are valid...
-                if rec.version < 700 or rec.version > 1200:
-                    raise recording.InvalidFileError(f"invalid version={rec.version}")
 
-                # Skip metadata
-                metadata_len = _utils.read_u32(f)
-                f.read(metadata_len)
+    def _read_frames(filename, rec, use_mmap):
+        with _utils.open_reader(filename, use_mmap) as reader:
 
-                # Read compressed data
-                compressed_len = _utils.read_u32(f)
+            rec.version, compressed_len = RecordingFormatCam._read_header(reader)
 
-                # Note: this includes the LZMA header (properties, dictionary size and decompressed length)
-                compressed_data = f.read(1 + 4 + 8 + compressed_len)
-                compressed_data_buffer = io.BytesIO(compressed_data)
+            # Decompress and parse, while the compressed data is read
+            # Note: the compressed data starts with the LZMA header (properties, dictionary size and decompressed length)
+            reader = _utils.Reader(_Decompressor(reader, _LZMA_HEADER.size + compressed_len))
 
-                # Decompress and parse
-                with lzma.open(compressed_data_buffer) as ff:
-                    # Skip bogus (?) container version
-                    ff.read(2)
+            # Skip bogus (?) container version
+            reader.skip(2)
 
-                    # Read number of frames
-                    frame_count = _utils.read_u32(ff)
-                    if frame_count <= 57:
-                        raise recording.InvalidFileError(f"invalid frame_count={frame_count}")
-                    frame_count -= 57
+            # Read number of frames
+            frame_count = reader.read_u32()
+            if frame_count <= 57:
+                raise recording.InvalidFileError(f"invalid frame_count={frame_count}")
+            frame_count -= 57
 
-                    for _ in range(frame_count):
-                        frame = recording.Frame()
-                        frame_length = _utils.read_u16(ff)
-                        frame.time = _utils.read_u32(ff)
+            for _ in range(frame_count):
+                frame = recording.Frame()
+                frame_length, frame.time = reader.unpack(_FRAME_HEADER)
 
-                        # Note: we include 2 byte header here, as we want to
-                        #       call merge_frames later
-                        frame.data = ff.read(frame_length)
+                # Note: we include 2 byte header here, as we want to
+                #       call merge_frames later
+                frame.data = reader.read(frame_length)
 
-                        # Skip bogus checksum/size/trash/???
-                        ff.read(4)
+                # Skip bogus checksum/size/trash/???
+                reader.skip(4)
 
-                        rec.frames.append(frame)
+                yield frame
 
-        except Exception as e:
-            exception = e
 
-        if len(rec.frames) > 0:
-            # Fix frame times
-            _utils.fix_frame_times(rec.frames)
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        frames = RecordingFormatCam._read_frames(filename, rec, use_mmap)
+        frames = _utils.measure_frames(stats, 'read', frames)
 
-            # Set recording's total time ( = last frame's time)
-            rec.length = rec.frames[-1].time
+        # Fix frame times
+        frames = _utils.measure_frames(stats, 'fix_frame_times', _utils.fix_frame_times(frames))
 
-            # Merge frames
-            rec.frames = _utils.merge_frames(rec.frames)
+        # Set recording's total time ( = last frame's time)
+        frames = _utils.measure_frames(stats, 'update_length', _utils.update_length(frames, rec))
 
-        return rec, exception
+        # Merge frames
+        return _utils.measure_frames(stats, 'merge_frames', _utils.merge_frames(frames))
@@ -1,28 +1,101 @@
+import functools
+import struct
 import zlib
 
 from Crypto.Cipher import AES
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from oldschooltibia import recording, _utils
 
 
+# Frame length and frame time, for rec_version 259 and for later versions
+_FRAME_HEADER_259 = struct.Struct('<II')
+_FRAME_HEADER = struct.Struct('<HI')
+
+
+# ECB mode does not keep any state between blocks, so the same cipher can be used for all frames
+_AES = AES.new(b'\x54\x68\x79\x20\x6B\x65\x79\x20\x69\x73\x20\x6D\x69\x6E\x65\x20\xA9\x20\x32\x30\x30\x36\x20\x47\x42\x20\x4D\x6F\x6E\x61\x63\x6F', AES.MODE_ECB)
+
+
+# Modulo used by the simple encryption, for each file format version
+_SIMPLE_MODULOS = {
+    515: 5,
+    516: 8,
+    517: 8,
+    518: 6,
+}
+
+
+def _simple_subtrahend(value, modulo):
+    # The value that TibiCAM subtracts from a byte, given (key + 33 * i) & 0xFF
+    minus = value - 256 if value > 127 else value
+    if minus % modulo != 0:
+        minus += modulo - (minus % modulo)
+    return minus
+
+
+@functools.lru_cache(maxsize=None)
+def _simple_keystream(key, modulo):
+    # Since 33 is odd, (key + 33 * i) & 0xFF repeats itself every 256 bytes, so
+    # the keystream for a (key, modulo) pair is only 256 bytes long
+    # Note: the keystream contains the additive inverse of each subtrahend, so that
+    #       decryption becomes a byte-wise addition
+    return bytes(-_simple_subtrahend((key + 33 * i) & 0xFF, modulo) & 0xFF for i in range(256))
+
+
 class RecordingFormatRec(recording.RecordingFormat):
 
     extension = '.rec'
-    has_magic = False
 
-    def _aes_decrypt(encrypted_data):
-        decrypted_data = b''
+    def sniff(data):
+        if len(data) < 6:
+            return 0
+
+        rec_version, num_frames = struct.unpack_from('<HI', data)
+        if rec_version not in (259, 515, 516, 517, 518):
+            return 0
+
+        if rec_version == 259:
+            if num_frames <= 0:
+                return 0
+
+            if len(data) >= 6 + _FRAME_HEADER_259.size:
+                frame_length, _ = _FRAME_HEADER_259.unpack_from(data, 6)
+                if frame_length <= 0:
+                    return 0
+
+            return 50
+
+        if num_frames <= 57:
+            return 0
 
-        aes = AES.new(b'\x54\x68\x79\x20\x6B\x65\x79\x20\x69\x73\x20\x6D\x69\x6E\x65\x20\xA9\x20\x32\x30\x30\x36\x20\x47\x42\x20\x4D\x6F\x6E\x61\x63\x6F', AES.MODE_ECB)
+        if len(data) < 6 + _FRAME_HEADER.size:
+            return 40
 
+        frame_length, _ = _FRAME_HEADER.unpack_from(data, 6)
+        if frame_length <= 0 or (rec_version in (517, 518) and frame_length % 16 != 0):
+            return 0
+
+        # If the whole first frame is available we can verify its checksum
+        frame_end = 6 + _FRAME_HEADER.size + frame_length
+        if frame_end + 4 > len(data):
+            return 50
+
+        checksum = struct.unpack_from('<I', data, frame_end)[0]
+        return 90 if zlib.adler32(data[6 + _FRAME_HEADER.size:frame_end], 1) == checksum else 0
+
+
+    def _aes_decrypt(encrypted_data):
         # The frame data length needs to be divisible by 16
         if len(encrypted_data) % 16 != 0:
             raise recording.InvalidFileError(f"len(encrypted_data)={len(encrypted_data)} is not divisible by 16")
 
-        # Decrypt each block (of 16 bytes)
-        for block in range(len(encrypted_data) // 16):
-            block_data_encrypted = encrypted_data[block * 16 : (block * 16) + 16]
-            decrypted_data += aes.decrypt(block_data_encrypted)
+        # Decrypt all blocks (of 16 bytes) at once
+        decrypted_data = _AES.decrypt(encrypted_data)
 
         # Check and verify padding
         # The value used for padding also denotes how many padding bytes there are
@@ -32,9 +105,9 @@ class RecordingFormatRec(recording.RecordingFormat):
         no_padding = decrypted_data[-1]
 
         # Check that all padding bytes has this value
-        for padding_byte in decrypted_data[-no_padding:]:
-            if padding_byte != no_padding:
-                raise recording.InvalidFileError("invalid padding bytes")
+        padding = decrypted_data[-no_padding:]
+        if padding.count(no_padding) != len(padding):
+            raise recording.InvalidFileError("invalid padding bytes")
 
         return decrypted_data[:-no_padding]
 
@@ -45,42 +118,37 @@ class RecordingFormatRec(recording.RecordingFormat):
         if calculated_checksum != checksum:
             raise recording.InvalidFileError(f"invalid checksum (calculated: 0x{calculated_checksum:08X} read: 0x{checksum:08X})")
 
-        # Decrypt frame data
-        decrypted_data = b''
+        # Different modulos for different file format versions
+        if rec_version not in _SIMPLE_MODULOS:
+            raise recording.InvalidFileError(f"invalid rec_version={rec_version}")
 
         # Different keys for each frame
         key = (len(frame.data) + frame.time + 2) & 0xFF
 
-        # Different modulos for different file format versions
-        if rec_version == 515:
-            modulo = 5
-        elif rec_version in (516, 517):
-            modulo = 8
-        elif rec_version == 518:
-            modulo = 6
-        else:
-            raise recording.InvalidFileError("invalid rec_version={rec_version}")
-
-        # Decrypt each byte
-        for i, byte in enumerate(frame.data):
-            minus = (key + 33 * i) & 0xFF
-            if minus > 127:
-                minus -= 256
-            if minus % modulo != 0:
-                minus += modulo - (minus % modulo)
+        # Decrypt all bytes at once by adding the keystream, byte by byte without carry
+        length = len(frame.data)
+        keystream = _simple_keystream(key, _SIMPLE_MODULOS[rec_version])
+        keystream = (keystream * (length // len(keystream) + 1))[:length]
 
-            result = (byte - minus) & 0xFF
+        if numpy is not None:
+            # uint8 addition wraps around, i.e. it is modulo 256
+            return (numpy.frombuffer(frame.data, numpy.uint8) + numpy.frombuffer(keystream, numpy.uint8)).tobytes()
 
-            decrypted_data += result.to_bytes(1, byteorder='little', signed=False)
+        # Without NumPy we treat the data as one large integer and add the lower 7 bits of each byte
+        # separately from the highest bit, so that no carry is propagated to the next byte
+        low_mask = int.from_bytes(b'\x7F' * length, byteorder='little')
+        high_mask = int.from_bytes(b'\x80' * length, byteorder='little')
+        a = int.from_bytes(frame.data, byteorder='little')
+        b = int.from_bytes(keystream, byteorder='little')
+        result = ((a & low_mask) + (b & low_mask)) ^ ((a ^ b) & high_mask)
 
-        return decrypted_data
+        return result.to_bytes(length, byteorder='little')
 
 
     def _remove_login_server_frames(frames):
         def is_latin_1(c):
             return (c >= 32 and c <= 126) or (c >= 160 and c <= 255)
 
-        ret = []
         for frame in frames:
             keep = True
             if len(frame.data) > 3 and frame.data[0] == 0x0a:
@@ -94,78 +162,89 @@ class RecordingFormatRec(recording.RecordingFormat):
                         keep = False
 
             if keep:
-                ret.append(frame)
-        return ret
+                yield frame
 
 
-    def load(filename):
-        rec = recording.Recording()
-        exception = None
+    def _read_header(reader):
+        # Returns file format version and number of frames
 
-        try:
-            with open(filename, 'rb') as f:
+        # This may or may not be correct
+        # 259 = 7.21 - 7.24
+        # 515 = 7.30 - 7.60
+        # 516 = 7.70
+        # 517 = 7.70 - 7.92
+        # 518 = 8.00 - ?.??
+        # (TibiCAM reads the two values separately, but whatever...)
+        rec_version = reader.read_u16()
 
-                # This may or may not be correct
-                # 259 = 7.21 - 7.24
-                # 515 = 7.30 - 7.60
-                # 516 = 7.70
-                # 517 = 7.70 - 7.92
-                # 518 = 8.00 - ?.??
-                # (TibiCAM reads the two values separately, but whatever...)
-                rec_version = _utils.read_u16(f)
+        if rec_version not in (259, 515, 516, 517, 518):
+            raise recording.InvalidFileError(f"invalid rec_version={rec_version}")
 
-                if rec_version not in (259, 515, 516, 517, 518):
-                    raise recording.InvalidFileError(f"invalid rec_version={rec_version}")
+        num_frames = reader.read_u32()
+        if rec_version in (515, 516, 517, 518):
+            num_frames -= 57  # wtf
+
+        return rec_version, num_frames
+
+
+    def probe(filename, info):
+        # The Tibia version and the recording length are not stored in the file
+        with _utils.open_reader(filename, use_mmap=True) as reader:
+            _, info.num_frames = RecordingFormatRec._read_header(reader)
 
-                num_frames = _utils.read_u32(f)
-                if rec_version in (515, 516, 517, 518):
-                    num_frames -= 57  # wtf
 
-                # Read each frame
-                for i in range(num_frames):
-                    frame = recording.Frame()
+    def _read_frames(filename, rec, use_mmap, stats):
+        simple_decrypt = RecordingFormatRec._simple_decrypt
+        aes_decrypt = RecordingFormatRec._aes_decrypt
+        if stats is not None:
+            simple_decrypt = stats.call('simple_decrypt', simple_decrypt)
+            aes_decrypt = stats.call('aes_decrypt', aes_decrypt)
 
-                    if rec_version == 259:
-                        frame_length = _utils.read_u32(f)
-                    else:
-                        frame_length = _utils.read_u16(f)
+        with _utils.open_reader(filename, use_mmap) as reader:
 
-                    if frame_length <= 0:
-                        raise recording.InvalidFileError(f"invalid frame_length={frame_length} for frame number={i}")
+            rec_version, num_frames = RecordingFormatRec._read_header(reader)
 
-                    frame.time = _utils.read_u32(f)
-                    frame.data = f.read(frame_length)
+            frame_header = _FRAME_HEADER_259 if rec_version == 259 else _FRAME_HEADER
 
-                    # For file type 2 there is first a simple encryption
-                    if rec_version in (515, 516, 517, 518):
-                        checksum = _utils.read_u32(f)
-                        frame.data = RecordingFormatRec._simple_decrypt(rec_version, checksum, frame)
-                        # Then, file type 517 and later has AES encryption
-                        if rec_version in (517, 518):
-                            frame.data = RecordingFormatRec._aes_decrypt(frame.data)
+            # Read each frame
+            for i in range(num_frames):
+                frame = recording.Frame()
+
+                frame_length, frame.time = reader.unpack(frame_header)
+                if frame_length <= 0:
+                    raise recording.InvalidFileError(f"invalid frame_length={frame_length} for frame number={i}")
+
+                frame.data = reader.read(frame_length)
+
+                # For file type 2 there is first a simple encryption
+                if rec_version in (515, 516, 517, 518):
+                    checksum = reader.read_u32()
+                    frame.data = simple_decrypt(rec_version, checksum, frame)
+                    # Then, file type 517 and later has AES encryption
+                    if rec_version in (517, 518):
+                        frame.data = aes_decrypt(frame.data)
 
-                    rec.frames.append(frame)
+                # Set recording's total time ( = last frame's time)
+                rec.length = frame.time
 
-        except Exception as e:
-            exception = e
+                yield frame
 
-        if len(rec.frames) > 0:
-            # Set recording's total time ( = last frame's time)
-            rec.length = rec.frames[-1].time
 
-            # Merge frames
-            rec.frames = _utils.merge_frames(rec.frames)
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        frames = RecordingFormatRec._read_frames(filename, rec, use_mmap, stats)
+        frames = _utils.measure_frames(stats, 'read', frames)
 
-            # TibiCAM had a bug (?) where it incorrectly saved packets from the login server
-            # in the recording, e.g. on failed login attempts. Let's try to detect and remove those
-            # Note: this issue was first found and handled by tibiarc:
-            # https://github.com/tibiacast/tibiarc/blob/9e82d914f92b8995e0fa3d5625e9c76c1126b006/lib/formats/rec.cpp#L204
-            rec.frames = RecordingFormatRec._remove_login_server_frames(rec.frames)
+        # Merge frames
+        frames = _utils.measure_frames(stats, 'merge_frames', _utils.merge_frames(frames))
 
-            # Fix frame times
-            _utils.fix_frame_times(rec.frames)
+        # TibiCAM had a bug (?) where it incorrectly saved packets from the login server
+        # in the recording, e.g. on failed login attempts. Let's try to detect and remove those
+        # Note: this issue was first found and handled by tibiarc:
+        # https://github.com/tibiacast/tibiarc/blob/9e82d914f92b8995e0fa3d5625e9c76c1126b006/lib/formats/rec.cpp#L204
+        frames = _utils.measure_frames(stats, 'remove_login_server_frames', RecordingFormatRec._remove_login_server_frames(frames))
 
-            # Remove empty frames (TODO: do this in merge_frames? maybe it's caused by merge_frames...)
-            rec.frames = [frame for frame in rec.frames if len(frame.data) > 0]
+        # Fix frame times
+        frames = _utils.measure_frames(stats, 'fix_frame_times', _utils.fix_frame_times(frames))
 
-        return rec, exception
+        # Remove empty frames (TODO: do this in merge_frames? maybe it's caused by merge_frames...)
+        return _utils.measure_frames(stats, 'remove_empty_frames', _utils.remove_empty_frames(frames))
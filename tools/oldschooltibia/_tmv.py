@@ -1,14 +1,39 @@
 import gzip
+import struct
+import zlib
 
 from oldschooltibia import recording, _utils
 
 
+# Tibia version and recording length
+_HEADER = struct.Struct('<HI')
+
+# Time since previous frame and frame length
+_FRAME_HEADER = struct.Struct('<IH')
+
+
 class RecordingFormatTmv(recording.RecordingFormat):
 
     extension = '.tmv'
-    has_magic = False
 
-    def load(filename):
+    def sniff(data):
+        if data[:2] != b'\x1f\x8b':
+            return 0
+
+        # Decompress as much as possible of the data, to check the format version
+        try:
+            decompressed_data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+        except zlib.error:
+            return 0
+
+        if len(decompressed_data) < 2:
+            return 50
+
+        return 90 if decompressed_data[:2] == b'\x02\x00' else 0
+
+
+    def _read_header(filename, reader):
+        # Returns Tibia version and recording length
         # This implementation is based on https://github.com/tulio150/tibia-ttm/blob/master/File%20Formats.txt
         # There seems to exist two different .tmv formats, TibiaMovie and TibiaMovie2
         # For now only TibiaMovie is implemented
@@ -18,59 +43,69 @@ class RecordingFormatTmv(recording.RecordingFormat):
             if f.read(4) == b'TMV2':
                 raise recording.InvalidFileError("TibiaMovie2 is not implemented yet")
 
-        rec = recording.Recording()
-        exception = None
+        format_version = reader.read_u16()
+        if format_version != 2:
+            raise recording.InvalidFileError(f"invalid format_version={format_version}")
+
+        return reader.unpack(_HEADER)
+
+
+    def probe(filename, info):
+        with gzip.open(filename, 'rb') as f:
+            # Only decompress the header
+            reader = _utils.Reader(f.read(2 + _HEADER.size))
+            info.version, info.length = RecordingFormatTmv._read_header(filename, reader)
+
+        # Note: the gzip trailer contains the decompressed length, but it can not be
+        #       trusted without decompressing everything, e.g. if the file is truncated
 
-        try:
-            with gzip.open(filename, 'rb') as f:
-                format_version = _utils.read_u16(f)
-                if format_version != 2:
-                    raise recording.InvalidFileError("invalid format_version={format_version}")
 
-                rec.version = _utils.read_u16(f)
-                rec.length = _utils.read_u32(f)
+    def _read_frames(filename, rec):
+        with gzip.open(filename, 'rb') as f:
+            reader = _utils.Reader(f)
 
-                current_timestamp = 0
-                while True:
-                    try:
-                        data_type = _utils.read_u8(f)
-                    except EOFError:
-                        break
+            rec.version, rec.length = RecordingFormatTmv._read_header(filename, reader)
 
-                    if data_type == 0:
-                        current_timestamp += _utils.read_u32(f)
+            current_timestamp = 0
+            while True:
+                try:
+                    data_type = reader.read_u8()
+                except EOFError:
+                    break
 
-                        frame_length = _utils.read_u16(f)
-                        if frame_length == 0:
-                            continue
+                if data_type == 0:
+                    delay, frame_length = reader.unpack(_FRAME_HEADER)
+                    current_timestamp += delay
+                    if frame_length == 0:
+                        continue
 
-                        frame = recording.Frame()
-                        frame.time = current_timestamp
+                    frame = recording.Frame()
+                    frame.time = current_timestamp
 
-                        # Note: we include 2 byte header here, as we want to
-                        #       call merge_frames later
-                        frame.data = f.read(frame_length)
+                    # Note: we include 2 byte header here, as we want to
+                    #       call merge_frames later
+                    frame.data = reader.read(frame_length)
 
-                        rec.frames.append(frame)
+                    yield frame
 
-                    elif data_type == 1:
-                        # play marker?
-                        pass
+                elif data_type == 1:
+                    # play marker?
+                    pass
 
-                    else:
-                        raise recording.InvalidFileError(f'invalid data_type={data_type}')
+                else:
+                    raise recording.InvalidFileError(f'invalid data_type={data_type}')
 
-        except Exception as e:
-            exception = e
 
-        if len(rec.frames) > 0:
-            # Fix frame times
-            _utils.fix_frame_times(rec.frames)
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        # Note: use_mmap is ignored, as the whole file is compressed
+        frames = RecordingFormatTmv._read_frames(filename, rec)
+        frames = _utils.measure_frames(stats, 'read', frames)
 
-            # Set recording's total time ( = last frame's time)
-            rec.length = rec.frames[-1].time
+        # Fix frame times
+        frames = _utils.measure_frames(stats, 'fix_frame_times', _utils.fix_frame_times(frames))
 
-            # Merge frames
-            rec.frames = _utils.merge_frames(rec.frames)
+        # Set recording's total time ( = last frame's time)
+        frames = _utils.measure_frames(stats, 'update_length', _utils.update_length(frames, rec))
 
-        return rec, exception
+        # Merge frames
+        return _utils.measure_frames(stats, 'merge_frames', _utils.merge_frames(frames))
@@ -1,68 +1,207 @@
+import bisect
 import os
+import struct
 
 from oldschooltibia import recording, _utils
 
 
+# Tibia version, recording length and number of frames
+_HEADER = struct.Struct('<HII')
+
+# Frame time and frame length
+_FRAME_HEADER = struct.Struct('<IH')
+
+# Frames are written in chunks of (at least) this size
+# Note: must be larger than the largest possible frame (header + 65535 bytes)
+_WRITE_BUFFER_SIZE = 1024 * 1024
+
+# The optional index is stored in a sidecar file (e.g. "file.trpi" for "file.trp")
+# It starts with a magic, the size and modification time (in ns) of the .trp file and its number
+# of frames, which are used to detect a stale index, and the number of entries. Each entry is the
+# frame time, file offset and frame number of a frame, with at most one entry per _INDEX_INTERVAL ms
+_INDEX_HEADER = struct.Struct('<4sQQII')
+_INDEX_ENTRY = struct.Struct('<IQI')
+_INDEX_INTERVAL = 10000
+
+
 class RecordingFormatTrp(recording.RecordingFormat):
 
     extension = '.trp'
-    has_magic = True
 
-    def load(filename):
-        rec = recording.Recording()
-        exception = None
+    # Decoding a .trp file is as fast as reading a cache file
+    cacheable = False
+
+    def sniff(data):
+        return 100 if data[:4] == b'TRP\0' else 0
 
+
+    def index_filename(filename):
+        return os.path.splitext(filename)[0] + '.trpi'
+
+
+    def _read_index(filename, num_frames):
+        # Returns the index entries, or None if there is no (valid) index
         try:
-            with open(filename, 'rb') as f:
-                magic = f.read(4)
-                if magic != b'TRP\0':
-                    raise recording.InvalidFileError(f"invalid magic={magic}")
+            with open(RecordingFormatTrp.index_filename(filename), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        if len(data) < _INDEX_HEADER.size:
+            return None
+
+        magic, trp_size, trp_mtime, index_num_frames, num_entries = _INDEX_HEADER.unpack_from(data)
+        stat = os.stat(filename)
+        if magic != b'TRPI' or \
+           trp_size != stat.st_size or \
+           trp_mtime != stat.st_mtime_ns or \
+           index_num_frames != num_frames or \
+           len(data) != _INDEX_HEADER.size + num_entries * _INDEX_ENTRY.size:
+            return None
+
+        return list(_INDEX_ENTRY.iter_unpack(memoryview(data)[_INDEX_HEADER.size:]))
+
+
+    def _write_index(filename, num_frames, entries, fsync):
+        # The index is written after the .trp file, so that it gets its final size and modification time
+        # Note: an existing (stale) index is overwritten
+        with _utils.open_atomic(RecordingFormatTrp.index_filename(filename), fsync, overwrite=True) as f:
+            stat = os.stat(filename)
+            f.write(_INDEX_HEADER.pack(b'TRPI', stat.st_size, stat.st_mtime_ns, num_frames, len(entries)))
+            f.write(b''.join(_INDEX_ENTRY.pack(*entry) for entry in entries))
+
+
+    def save_index(filename, fsync=False):
+        """Writes an index for an existing .trp file.
+        """
+        entries = []
+        with _utils.open_reader(filename) as reader:
+
+            _, _, num_frames = RecordingFormatTrp._read_header(reader)
+
+            # Only the frame headers are read, the frame data is skipped
+            for frame_number in range(num_frames):
+                offset = reader.tell()
+                frame_time, frame_length = reader.unpack(_FRAME_HEADER)
+                if not entries or frame_time >= entries[-1][0] + _INDEX_INTERVAL:
+                    entries.append((frame_time, offset, frame_number))
+                reader.skip(frame_length)
+
+        RecordingFormatTrp._write_index(filename, num_frames, entries, fsync)
+
+
+    def _read_header(reader):
+        # Returns Tibia version, recording length and number of frames
+        magic = reader.read(4)
+        if magic != b'TRP\0':
+            raise recording.InvalidFileError(f"invalid magic={bytes(magic)}")
+
+        return reader.unpack(_HEADER)
+
 
-                rec.version = _utils.read_u16(f)
-                rec.length = _utils.read_u32(f)
+    def probe(filename, info):
+        with _utils.open_reader(filename, use_mmap=True) as reader:
+            info.version, info.length, info.num_frames = RecordingFormatTrp._read_header(reader)
 
-                num_frames = _utils.read_u32(f)
+        info.data_size = info.file_size
 
-                # Read each frame
-                for _ in range(num_frames):
-                    frame = recording.Frame()
 
-                    frame.time = _utils.read_u32(f)
-                    if frame.time < 0 or frame.time > rec.length:
-                        raise recording.InvalidFileError(f"invalid frame.time={frame.time}")
+    def _read_frames(filename, rec, use_mmap, start_ms):
+        with _utils.open_reader(filename, use_mmap) as reader:
 
-                    frame_length = _utils.read_u16(f)
-                    if frame_length <= 0:
-                        raise recording.InvalidFileError(f"invalid frame_length={frame_length}")
+            rec.version, rec.length, num_frames = RecordingFormatTrp._read_header(reader)
 
-                    frame.data = f.read(frame_length)
+            # If there is an index we can start at the last entry before start_ms,
+            # instead of reading all frames before it
+            first_frame = 0
+            if start_ms > 0:
+                entries = RecordingFormatTrp._read_index(filename, num_frames)
+                if entries:
+                    i = bisect.bisect_right(entries, start_ms, key=lambda entry: entry[0]) - 1
+                    if i >= 0:
+                        _, offset, first_frame = entries[i]
+                        reader.seek(offset)
 
-                    rec.frames.append(frame)
+            # Read each frame
+            for _ in range(first_frame, num_frames):
+                frame = recording.Frame()
 
-        except Exception as e:
-            exception = e
+                frame.time, frame_length = reader.unpack(_FRAME_HEADER)
+                if frame.time < 0 or frame.time > rec.length:
+                    raise recording.InvalidFileError(f"invalid frame.time={frame.time}")
 
-        return rec, exception
+                if frame_length <= 0:
+                    raise recording.InvalidFileError(f"invalid frame_length={frame_length}")
 
+                frame.data = reader.read(frame_length)
 
-    def save(recording, filename):
+                yield frame
+
+
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        return _utils.measure_frames(stats, 'read', RecordingFormatTrp._read_frames(filename, rec, use_mmap, start_ms))
+
+
+    def save_frames(rec, filename, frames, fsync=False, index=False):
+        # Write the frames as they are read from frames, which can be any iterable
+        # The header is written last, so rec.version and rec.length may be set while
+        # the frames are read, e.g. by RecordingFormat.iter_frames()
         if os.path.isfile(filename):
             raise IOError(f"file already exist")
 
-        if recording.version is None:
-            raise Exception(f"recording.version is None")
+        with _utils.open_atomic(filename, fsync) as f:
+
+            # Reserve space for magic and recording info
+            f.write(bytes(4 + _HEADER.size))
+
+            # Pack frames into a large buffer, and only write when it is full
+            num_frames = 0
+            buffer = bytearray(_WRITE_BUFFER_SIZE)
+            buffer_view = memoryview(buffer)
+            offset = 0
+
+            # Offset in the file of the start of the buffer, and the index entries
+            file_offset = 4 + _HEADER.size
+            entries = []
+
+            for frame in frames:
+                frame_length = len(frame.data)
+                if offset + _FRAME_HEADER.size + frame_length > len(buffer):
+                    f.write(buffer_view[:offset])
+                    file_offset += offset
+                    offset = 0
+
+                if index and (not entries or frame.time >= entries[-1][0] + _INDEX_INTERVAL):
+                    entries.append((frame.time, file_offset + offset, num_frames))
 
-        with open(filename, 'wb') as f:
+                _FRAME_HEADER.pack_into(buffer, offset, frame.time, frame_length)
+                offset += _FRAME_HEADER.size
+                buffer[offset:offset + frame_length] = frame.data
+                offset += frame_length
+                num_frames += 1
+
+            f.write(buffer_view[:offset])
+            buffer_view.release()
+
+            if rec.version is None:
+                raise Exception(f"recording.version is None")
 
             # Magic
+            f.seek(0)
             f.write(b'TRP\0')
 
             # Recording info
-            _utils.write_u16(f, recording.version)
-            _utils.write_u32(f, recording.length)
-            _utils.write_u32(f, len(recording.frames))
-
-            for frame in recording.frames:
-                _utils.write_u32(f, frame.time)
-                _utils.write_u16(f, len(frame.data))
-                f.write(frame.data)
+            f.write(_HEADER.pack(rec.version, rec.length, num_frames))
+
+        if index:
+            RecordingFormatTrp._write_index(filename, num_frames, entries, fsync)
+
+
+    def save(recording, filename, fsync=False, index=False):
+        if os.path.isfile(filename):
+            raise IOError(f"file already exist")
+
+        if recording.version is None:
+            raise Exception(f"recording.version is None")
+
+        RecordingFormatTrp.save_frames(recording, filename, recording.frames, fsync, index)
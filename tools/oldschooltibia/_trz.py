@@ -0,0 +1,258 @@
+import bisect
+import lzma
+import os
+import struct
+import zlib
+
+from oldschooltibia import recording, _utils
+
+
+# A .trz file is a .trp file where the frames are stored in independently compressed chunks:
+#
+#   magic 'TRZ\0', format version and compression method
+#   chunks: chunk header followed by the compressed frames
+#   chunk index: one entry per chunk
+#   footer: recording info, chunk index position and magic 'TRZI'
+#
+# Each chunk can be decompressed on its own, since the frame times in a chunk are stored as deltas
+# from the previous frame in the same chunk, and the first one from the chunk's first frame time.
+# The chunk index makes it possible to start reading at any chunk, e.g. for start_ms.
+
+# Format version and compression method
+_HEADER = struct.Struct('<HB')
+
+# Compressed length, first frame time and number of frames
+_CHUNK_HEADER = struct.Struct('<III')
+
+# Frame time delta and frame length
+_FRAME_HEADER = struct.Struct('<iH')
+
+# Chunk offset, first frame time and first frame number
+_INDEX_ENTRY = struct.Struct('<QII')
+
+# Tibia version, recording length, number of frames, number of chunks, chunk index offset and magic
+_FOOTER = struct.Struct('<HIIIQ4s')
+
+_FORMAT_VERSION = 1
+
+_COMPRESSION_ZLIB = 0
+_COMPRESSION_LZMA = 1
+
+_COMPRESSIONS = {
+    'zlib': _COMPRESSION_ZLIB,
+    'lzma': _COMPRESSION_LZMA,
+}
+
+# Frames are compressed in chunks of (at least) this size, uncompressed
+_CHUNK_SIZE = 256 * 1024
+
+
+class RecordingFormatTrz(recording.RecordingFormat):
+
+    extension = '.trz'
+
+    def sniff(data):
+        return 100 if data[:4] == b'TRZ\0' else 0
+
+
+    def _compress(compression, data):
+        if compression == _COMPRESSION_ZLIB:
+            return zlib.compress(data)
+
+        return lzma.compress(data)
+
+
+    def _decompress(compression, data):
+        try:
+            if compression == _COMPRESSION_ZLIB:
+                return zlib.decompress(data)
+
+            return lzma.decompress(data)
+
+        except (zlib.error, lzma.LZMAError) as e:
+            raise recording.InvalidFileError(f"could not decompress chunk: {e}")
+
+
+    def _read_footer(reader, filename):
+        # Returns the footer, or None if the file is truncated
+        file_size = os.path.getsize(filename)
+        if file_size < 4 + _HEADER.size + _FOOTER.size:
+            return None
+
+        offset = reader.tell()
+        reader.seek(file_size - _FOOTER.size)
+        footer = reader.unpack(_FOOTER)
+        reader.seek(offset)
+
+        if footer[-1] != b'TRZI':
+            return None
+
+        return footer
+
+
+    def _read_index(reader, num_chunks, index_offset):
+        offset = reader.tell()
+        reader.seek(index_offset)
+        entries = [reader.unpack(_INDEX_ENTRY) for _ in range(num_chunks)]
+        reader.seek(offset)
+
+        return entries
+
+
+    def _read_header(reader):
+        # Returns the compression method
+        magic = reader.read(4)
+        if magic != b'TRZ\0':
+            raise recording.InvalidFileError(f"invalid magic={bytes(magic)}")
+
+        format_version, compression = reader.unpack(_HEADER)
+        if format_version != _FORMAT_VERSION:
+            raise recording.InvalidFileError(f"invalid format_version={format_version}")
+
+        if compression not in _COMPRESSIONS.values():
+            raise recording.InvalidFileError(f"invalid compression={compression}")
+
+        return compression
+
+
+    def probe(filename, info):
+        with _utils.open_reader(filename, use_mmap=True) as reader:
+            RecordingFormatTrz._read_header(reader)
+
+            # Nothing is known if the file is truncated
+            footer = RecordingFormatTrz._read_footer(reader, filename)
+            if footer is not None:
+                info.version, info.length, info.num_frames, _, _, _ = footer
+
+
+    def _read_frames(filename, rec, use_mmap, start_ms, stats):
+        decompress = RecordingFormatTrz._decompress
+        if stats is not None:
+            decompress = stats.call('decompress', decompress)
+
+        with _utils.open_reader(filename, use_mmap) as reader:
+
+            compression = RecordingFormatTrz._read_header(reader)
+
+            # The recording info is in the footer, which is missing if the file is truncated
+            # In that case we read chunks until the end of the file, and only the frames are returned
+            footer = RecordingFormatTrz._read_footer(reader, filename)
+            num_chunks = None
+            if footer is not None:
+                rec.version, rec.length, _, num_chunks, index_offset, _ = footer
+
+                # Start at the last chunk that starts before start_ms
+                if start_ms > 0 and num_chunks > 0:
+                    entries = RecordingFormatTrz._read_index(reader, num_chunks, index_offset)
+                    i = max(bisect.bisect_right(entries, start_ms, key=lambda entry: entry[1]) - 1, 0)
+                    reader.seek(entries[i][0])
+                    num_chunks -= i
+
+            # Read each chunk
+            chunk_number = 0
+            while num_chunks is None or chunk_number < num_chunks:
+                compressed_length, frame_time, chunk_frames = reader.unpack(_CHUNK_HEADER)
+                compressed_data = reader.read(compressed_length)
+                if len(compressed_data) != compressed_length:
+                    raise EOFError("EOF")
+
+                data = memoryview(decompress(compression, compressed_data))
+
+                # Read each frame in the chunk
+                offset = 0
+                for _ in range(chunk_frames):
+                    if offset + _FRAME_HEADER.size > len(data):
+                        raise recording.InvalidFileError("invalid chunk")
+
+                    frame = recording.Frame()
+
+                    time_delta, frame_length = _FRAME_HEADER.unpack_from(data, offset)
+                    offset += _FRAME_HEADER.size
+
+                    frame_time += time_delta
+                    frame.time = frame_time
+                    if frame.time < 0 or (footer is not None and frame.time > rec.length):
+                        raise recording.InvalidFileError(f"invalid frame.time={frame.time}")
+
+                    if frame_length <= 0 or offset + frame_length > len(data):
+                        raise recording.InvalidFileError(f"invalid frame_length={frame_length}")
+
+                    frame.data = data[offset:offset + frame_length]
+                    offset += frame_length
+
+                    yield frame
+
+                chunk_number += 1
+
+
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        return _utils.measure_frames(stats, 'read', RecordingFormatTrz._read_frames(filename, rec, use_mmap, start_ms, stats))
+
+
+    def save_frames(rec, filename, frames, fsync=False, index=False, compression='zlib'):
+        # The frames are written as they are read from frames, like for .trp
+        # The chunk index is always written, so index is ignored
+        if os.path.isfile(filename):
+            raise IOError(f"file already exist")
+
+        if compression not in _COMPRESSIONS:
+            raise ValueError(f"invalid compression={compression}")
+        compression = _COMPRESSIONS[compression]
+
+        with _utils.open_atomic(filename, fsync) as f:
+
+            f.write(b'TRZ\0')
+            f.write(_HEADER.pack(_FORMAT_VERSION, compression))
+            file_offset = 4 + _HEADER.size
+
+            entries = []
+            num_frames = 0
+
+            chunk = bytearray()
+            chunk_time = 0
+            chunk_frames = 0
+            frame_time = 0
+
+            def write_chunk():
+                nonlocal file_offset
+                compressed_data = RecordingFormatTrz._compress(compression, chunk)
+                f.write(_CHUNK_HEADER.pack(len(compressed_data), chunk_time, chunk_frames))
+                f.write(compressed_data)
+                file_offset += _CHUNK_HEADER.size + len(compressed_data)
+
+            for frame in frames:
+                if chunk_frames == 0:
+                    entries.append((file_offset, frame.time, num_frames))
+                    chunk_time = frame.time
+                    frame_time = frame.time
+
+                chunk += _FRAME_HEADER.pack(frame.time - frame_time, len(frame.data))
+                chunk += frame.data
+                frame_time = frame.time
+                chunk_frames += 1
+                num_frames += 1
+
+                if len(chunk) >= _CHUNK_SIZE:
+                    write_chunk()
+                    chunk.clear()
+                    chunk_frames = 0
+
+            if chunk_frames > 0:
+                write_chunk()
+
+            if rec.version is None:
+                raise Exception(f"recording.version is None")
+
+            index_offset = file_offset
+            f.write(b''.join(_INDEX_ENTRY.pack(*entry) for entry in entries))
+            f.write(_FOOTER.pack(rec.version, rec.length, num_frames, len(entries), index_offset, b'TRZI'))
+
+
+    def save(recording, filename, fsync=False, index=False):
+        if os.path.isfile(filename):
+            raise IOError(f"file already exist")
+
+        if recording.version is None:
+            raise Exception(f"recording.version is None")
+
+        RecordingFormatTrz.save_frames(recording, filename, recording.frames, fsync, index)
@@ -1,53 +1,97 @@
+import struct
+
 from oldschooltibia import recording, _utils
 
 
+# Tibia version and server name length
+_HEADER = struct.Struct('<HB')
+
+
 class RecordingFormatTtm(recording.RecordingFormat):
 
     extension = '.ttm'
-    has_magic = False
 
-    def load(filename):
+    def sniff(data):
+        if len(data) < _HEADER.size:
+            return 0
+
+        # There is no magic, but the Tibia version should be plausible and the server name printable
+        version, server_name_len = _HEADER.unpack_from(data)
+        if version < 700 or version > 1200:
+            return 0
+
+        offset = _HEADER.size
+        if server_name_len > 0:
+            server_name = data[offset:offset + server_name_len]
+            if not all(32 <= c <= 126 for c in server_name):
+                return 0
+            offset += server_name_len + 2
+
+        # Skip recording length, then check the first frame and the next packet type if they are available
+        offset += 4
+        if offset + 2 > len(data):
+            return 30
+
+        frame_length = struct.unpack_from('<H', data, offset)[0]
+        if frame_length == 0:
+            return 0
+
+        offset += 2 + frame_length
+        if offset >= len(data):
+            return 40
+
+        return 70 if data[offset] in (0, 1) else 0
+
+
+    def _read_header(reader):
+        # Returns Tibia version and recording length
         # This implementation is based on https://github.com/tulio150/tibia-ttm/blob/master/File%20Formats.txt
+        version = reader.read_u16()
+
+        server_name_len = reader.read_u8()
+        if server_name_len > 0:
+            reader.skip(server_name_len)
+            reader.read_u16()
+
+        length = reader.read_u32()
+
+        return version, length
+
+
+    def probe(filename, info):
+        with _utils.open_reader(filename, use_mmap=True) as reader:
+            info.version, info.length = RecordingFormatTtm._read_header(reader)
 
-        rec = recording.Recording()
-        exception = None
 
-        try:
-            with open(filename, 'rb') as f:
-                rec.version = _utils.read_u16(f)
+    def _read_frames(filename, rec, use_mmap):
+        with _utils.open_reader(filename, use_mmap) as reader:
 
-                server_name_len = _utils.read_u8(f)
-                if server_name_len > 0:
-                    f.read(server_name_len)
-                    _utils.read_u16(f)
+            rec.version, rec.length = RecordingFormatTtm._read_header(reader)
 
-                rec.length = _utils.read_u32(f)
+            current_timestamp = 0
+            while True:
+                frame = recording.Frame()
+                frame.time = current_timestamp
+                frame_length = reader.read_u16()
+                frame.data = reader.read(frame_length)
 
-                current_timestamp = 0
-                while True:
-                    frame = recording.Frame()
-                    frame.time = current_timestamp
-                    frame_length = _utils.read_u16(f)
-                    frame.data = f.read(frame_length)
-                    rec.frames.append(frame)
+                # Make sure that recording's total time is correct ( = last frame's time)
+                rec.length = frame.time
 
-                    try:
-                        next_packet_type = _utils.read_u8(f)
-                    except EOFError:
-                        break
+                yield frame
 
-                    if next_packet_type == 0:
-                        current_timestamp += _utils.read_u16(f)
-                    elif next_packet_type == 1:
-                        current_timestamp += 1000
-                    else:
-                        raise recording.InvalidFileError(f"invalid next_packet_type={next_packet_type}")
+                try:
+                    next_packet_type = reader.read_u8()
+                except EOFError:
+                    break
 
-        except Exception as e:
-            exception = e
+                if next_packet_type == 0:
+                    current_timestamp += reader.read_u16()
+                elif next_packet_type == 1:
+                    current_timestamp += 1000
+                else:
+                    raise recording.InvalidFileError(f"invalid next_packet_type={next_packet_type}")
 
-        if len(rec.frames) > 0:
-            # Make sure that recording's total time is correct ( = last frame's time)
-            rec.length = rec.frames[-1].time
 
-        return rec, exception
+    def iter_frames(filename, rec, use_mmap=False, start_ms=0, stats=None):
+        return _utils.measure_frames(stats, 'read', RecordingFormatTtm._read_frames(filename, rec, use_mmap))
@@ -1,83 +1,280 @@
-from datetime import date, datetime
+import bisect
+import contextlib
+from datetime import date
+import errno
+import itertools
+import mmap
+import os
 import re
+import struct
+import uuid
 
 from oldschooltibia import recording
 
 
-def read_u8(f):
-    """Reads an unsigned byte from the file object f.
-    """
-    temp = f.read(1)
-    if not temp:
-        raise EOFError("EOF")
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
 
-    return int.from_bytes(temp, byteorder='little', signed=False)
 
+class Reader:
+    """Reads little-endian values from a buffer.
 
-def read_u16(f):
-    """Reads a two byte unsigned value from the file object f.
+    The source is either a bytes-like object, or a file object that is read in large
+    chunks. Values are decoded directly from the buffer with precompiled structs, instead
+    of doing one read() call per value.
     """
-    temp = f.read(2)
-    if not temp:
-        raise EOFError("EOF")
 
-    return int.from_bytes(temp, byteorder='little', signed=False)
+    def __init__(self, source, chunk_size=65536):
+        if hasattr(source, 'read'):
+            # Note: read1() does at most one read on the underlying stream, which means that
+            #       a truncated compressed stream will not raise before the data that could be
+            #       decompressed has been returned
+            self._file = source
+            self._read = getattr(source, 'read1', source.read)
+            self._buffer = b''
+        else:
+            self._file = None
+            self._read = None
+            self._buffer = source
+
+        self._chunk_size = chunk_size
+
+        # Position in the buffer, and offset of the buffer in the source
+        self._position = 0
+        self._offset = 0
+
+    def _fill(self, size):
+        # Try to make sure that there are at least size bytes left in the buffer
+        if self._read is None:
+            return
+
+        chunks = [self._buffer[self._position:]]
+        available = len(chunks[0])
+        while available < size:
+            data = self._read(max(size - available, self._chunk_size))
+            if not data:
+                break
+
+            chunks.append(data)
+            available += len(data)
+
+        self._buffer = b''.join(chunks)
+        self._offset += self._position
+        self._position = 0
+
+    def unpack(self, s):
+        """Decodes the values of the struct.Struct s at the current position.
+        """
+        if len(self._buffer) - self._position < s.size:
+            self._fill(s.size)
+            if len(self._buffer) - self._position < s.size:
+                raise EOFError("EOF")
+
+        values = s.unpack_from(self._buffer, self._position)
+        self._position += s.size
+        return values
+
+    def read_u8(self):
+        """Reads an unsigned byte.
+        """
+        if len(self._buffer) - self._position < 1:
+            self._fill(1)
+            if len(self._buffer) - self._position < 1:
+                raise EOFError("EOF")
+
+        value = self._buffer[self._position]
+        self._position += 1
+        return value
+
+    def read_u16(self):
+        """Reads a two byte unsigned value.
+        """
+        return self.unpack(_U16)[0]
+
+    def read_u32(self):
+        """Reads a four byte unsigned value.
+        """
+        return self.unpack(_U32)[0]
+
+    def read_u64(self):
+        """Reads an eight byte unsigned value.
+        """
+        return self.unpack(_U64)[0]
+
+    def read(self, size):
+        """Reads at most size bytes. Less than size bytes are returned on EOF, like file.read().
+        """
+        if len(self._buffer) - self._position < size:
+            self._fill(size)
+
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def skip(self, size):
+        """Skips at most size bytes.
+        """
+        if len(self._buffer) - self._position < size:
+            self._fill(size)
+
+        self._position = min(self._position + size, len(self._buffer))
+
+    def tell(self):
+        """Returns the current offset in the source.
+        """
+        return self._offset + self._position
+
+    def seek(self, offset):
+        """Moves to the given offset in the source.
+        """
+        if self._file is None:
+            self._position = offset
+            return
+
+        self._file.seek(offset)
+        self._buffer = b''
+        self._position = 0
+        self._offset = offset
+
+
+@contextlib.contextmanager
+def open_reader(filename, use_mmap=False):
+    """Opens the file filename and yields a Reader for it.
+
+    If use_mmap is True the file is memory-mapped instead of read, and Reader.read()
+    returns memoryview slices of the mapping instead of copies of the data.
+    """
+    with open(filename, 'rb') as f:
+        if not use_mmap:
+            yield Reader(f)
+            return
 
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped
+            mapping = b''
 
-def read_u32(f):
-    """Reads a four byte unsigned value from the file object f.
-    """
-    temp = f.read(4)
-    if not temp:
-        raise EOFError("EOF")
+        # Note: the mapping is not closed here, as frames may still refer to it.
+        #       It is closed when the last memoryview of it has been released
+        yield Reader(memoryview(mapping))
 
-    return int.from_bytes(temp, byteorder='little', signed=False)
 
+# Directories that open_atomic() has moved files into, while in a fsync_batch(), otherwise None
+_fsync_directories = None
 
-def read_u64(f):
-    """Reads an eight byte unsigned value from the file object f.
-    """
-    temp = f.read(8)
-    if not temp:
-        raise EOFError("EOF")
 
-    return int.from_bytes(temp, byteorder='little', signed=False)
+def fsync_directory(directory):
+    # Flushes the directory entries of directory to disk, where that is possible
+    if os.name != 'posix':
+        return
 
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
 
-def write_u8(f, v):
-    """Writes the value v as an unsigned byte to the file object f.
-    """
-    f.write(v.to_bytes(1, byteorder='little', signed=False))
 
+def fsync_directory_deferred(directory):
+    # Flushes the directory entries of directory to disk, at the end of the fsync_batch() if there is one
+    if _fsync_directories is not None:
+        _fsync_directories.add(directory)
+    else:
+        fsync_directory(directory)
 
-def write_u16(f, v):
-    """Writes the value v as a two byte unsigned value to the file object f.
-    """
-    f.write(v.to_bytes(2, byteorder='little', signed=False))
 
+@contextlib.contextmanager
+def fsync_batch():
+    """Defers the fsync of the directory entries of files written with open_atomic(fsync=True).
 
-def write_u32(f, v):
-    """Writes the value v as a four byte unsigned value to the file object f.
+    Each directory is flushed to disk once, when the with block ends, instead of once per file.
+    The data of each file is still flushed before it is moved, so a file is never seen with
+    data that is not on disk.
+    """
+    global _fsync_directories
+    outer = _fsync_directories
+    _fsync_directories = set()
+    try:
+        yield
+    finally:
+        directories, _fsync_directories = _fsync_directories, outer
+        for directory in sorted(directories):
+            fsync_directory(directory)
+
+
+@contextlib.contextmanager
+def open_atomic(filename, fsync=False, overwrite=False):
+    """Opens a temporary file for writing, in the same directory as filename.
+
+    When the with block ends without an exception the temporary file is moved to filename,
+    otherwise it is removed. This means that filename is never seen half-written. An existing
+    filename is only overwritten if overwrite is True, otherwise FileExistsError is raised.
+    If fsync is True the file is flushed to disk before it is moved, and the directory after,
+    or at the end of the fsync_batch() if there is one.
     """
-    f.write(v.to_bytes(4, byteorder='little', signed=False))
+    directory, basename = os.path.split(os.path.abspath(filename))
+
+    # Note: not using tempfile.mkstemp() since it ignores umask
+    temp_filename = os.path.join(directory, f'.{basename}.{uuid.uuid4().hex}.tmp')
+    fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        if overwrite:
+            os.replace(temp_filename, filename)
+        else:
+            try:
+                # A hard link fails if filename already exists, which a rename does not
+                os.link(temp_filename, filename)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Not all file systems support hard links, fall back to a rename
+                if os.path.exists(filename):
+                    raise FileExistsError(errno.EEXIST, "file already exist", filename)
+                os.replace(temp_filename, filename)
 
+        if fsync:
+            # Make sure that the directory entry is on disk as well
+            fsync_directory_deferred(directory)
 
-def write_u64(f, v):
-    """Writes the value v as an eight byte unsigned value to the file object f.
-    """
-    f.write(v.to_bytes(8, byteorder='little', signed=False))
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def measure_frames(stats, name, frames):
+    # Measures a stage of loading a recording if stats is set, see recording.LoadStats
+    return frames if stats is None else stats.frames(name, frames)
+
+
+def remove_empty_frames(frames):
+    return (frame for frame in frames if len(frame.data) > 0)
 
 
 def fix_frame_times(frames):
     # Fix frame times (first frame should start at time = 0)
-    if len(frames) == 0:
-        return
+    diff = None
+    for frame in frames:
+        if diff is None:
+            diff = frame.time
+
+        frame.time -= diff
+        yield frame
 
-    if frames[0].time != 0:
-        diff = frames[0].time
 
-        for frame in frames:
-            frame.time -= diff
+def update_length(frames, rec):
+    # Set recording's total time ( = last frame's time) while passing the frames through
+    for frame in frames:
+        rec.length = frame.time
+        yield frame
 
 
 def merge_frames(frames):
@@ -102,173 +299,221 @@ def merge_frames(frames):
     # This frame can be merged with frame 3 (and possible more), since the frame length is 8
     # but the Tibia packet length is 18 (2 + 16). The rest of the Tibia packet data is in frame
     # 4 (and possibly frame 5, 6, ...)
+    #
+    # The frames are merged while they are read, only the data of the current, incomplete,
+    # Tibia packet is kept between recording-frames
 
-    if len(frames) == 0:
-        return frames
+    # Data and time of a Tibia packet that continues in the next recording-frame(s)
+    pending_data = b''
+    pending_time = 0
 
-    # Put together all recording-packet's data into one large list
-    recording_frames_data = b''.join([ frame.data for frame in frames ])
+    exception = None
+    try:
+        for recording_frame in frames:
+            # Continue from where the previous recording-frame ended
+            recording_frames_data = pending_data + recording_frame.data
 
-    # And a list with recording-frame's time for each byte
-    recording_frames_time = []
-    for frame in frames:
-        recording_frames_time.extend([ frame.time ] * len(frame.data))
+            index = 0
+            while index + 2 <= len(recording_frames_data):
 
-    merged_frames = []
-    index = 0
-    while index < len(recording_frames_data):
+                # Read next Tibia packet's length
+                packet_length = recording_frames_data[index] | recording_frames_data[index + 1] << 8
 
-        # Read next Tibia packet's length
-        packet_length = recording_frames_data[index] | recording_frames_data[index + 1] << 8
+                # Wait for more data if the Tibia packet continues in the next recording-frame
+                if index + 2 + packet_length > len(recording_frames_data):
+                    break
 
-        # Create corrected frame
-        frame = recording.Frame()
+                # Create corrected frame
+                frame = recording.Frame()
 
-        # Use time from where the frame started
-        frame.time = recording_frames_time[index]
+                # Use time from where the frame started
+                frame.time = pending_time if index == 0 and pending_data else recording_frame.time
 
-        # Extract data (but skip Tibia packet length bytes)
-        frame.data = recording_frames_data[index + 2 : index + 2 + packet_length]
+                # Extract data (but skip Tibia packet length bytes)
+                frame.data = recording_frames_data[index + 2 : index + 2 + packet_length]
 
-        # Insert corrected frame
-        merged_frames.append(frame)
+                # Return corrected frame
+                yield frame
 
-        # Jump to next Tibia packet
-        index += 2 + packet_length
+                # Jump to next Tibia packet
+                index += 2 + packet_length
 
-    # Return fixed frames
-    return merged_frames
+            if index > 0 or not pending_data:
+                pending_time = recording_frame.time
+            pending_data = recording_frames_data[index:]
 
+    except Exception as e:
+        exception = e
 
-def get_all_strings(frames, min_len, unique, smart):
-    strings = []
+    # The last Tibia packet is incomplete if the recording is truncated, return what we have of it
+    # (but skip it if not even the Tibia packet length could be read)
+    if len(pending_data) >= 2:
+        frame = recording.Frame()
+        frame.time = pending_time
+        frame.data = pending_data[2:]
+        yield frame
 
-    def is_latin_1(c):
-        return (c >= 32 and c <= 126) or (c >= 160 and c <= 255)
+    if exception is not None:
+        raise exception
 
 
-    for frame in frames:
-        offset = 0
-        while offset < len(frame.data) - 2:
-            string_length = (frame.data[offset + 1] << 8) | frame.data[offset]
-            if string_length >= min_len and string_length < 1024 and (offset + 2 + string_length - 1 < len(frame.data)):
-                string_raw = frame.data[offset + 2:offset + 2 + string_length]
-                if all(is_latin_1(char) for char in string_raw):
-                    strings.append(string_raw.decode('latin-1'))
+# A sequence of printable Latin-1 characters, preceded by a byte that can be the high byte of
+# a string length (less than 1024)
+_LATIN_1_RUN = re.compile(rb'[\x00-\x03]([\x20-\x7e\xa0-\xff]+)')
 
-                    # note: subtract 1 here because we add 1 below
-                    offset += 2 + string_length - 1
+# Numbers in common messages, see get_all_strings()
+_SMART_PATTERN = re.compile(r'You lose \d+ (?P<lose>hitpoint|mana)|Using one of \d+ .+\.\.\.')
 
-            offset += 1
 
-    if smart:
-        temp = []
-        for string in strings:
-            new = re.sub(r'You lose \d+ hitpoint', r'You lose X hitpoint', string)
-            new = re.sub(r'You lose \d+ mana', r'You lose X mana', new)
-            new = re.sub(r'Using one of \d+ .+\.\.\.', r'Using one of X Y...', new)
-            temp.append(new)
+def _smart_replace(match):
+    if match['lose'] is not None:
+        return f"You lose X {match['lose']}"
 
-        strings = temp
+    return 'Using one of X Y...'
 
-    if unique:
-        # nice
-        strings = list(set(strings))
-        strings.sort()
 
-    return strings
+def _iter_strings(frames, min_len):
+    # A string is a 2 byte length followed by that many printable Latin-1 characters, at most 1023
+    # Since the high byte of the length is less than 4, which is not printable, a string can only
+    # start where a run of printable characters starts. So instead of trying every offset we find
+    # all such runs with a regex, and only check the length before each run
+    for frame in frames:
+        data = frame.data
+
+        # Strings do not overlap, the frame is scanned from the start
+        next_offset = 0
+        for run in _LATIN_1_RUN.finditer(data):
+            start, end = run.span(1)
+            offset = start - 2
+            if offset < next_offset:
+                continue
 
+            string_length = (data[offset + 1] << 8) | data[offset]
+            if string_length >= min_len and string_length < 1024 and string_length <= end - start:
+                yield str(data[start:start + string_length], 'latin-1')
+                next_offset = start + string_length
 
-def guess_world_from_frame(frame):
-    # Updates
-    updates = [
-        (date(2002,  8, 28), 700),
-        (date(2002, 10, 22), 701),
-        (date(2002, 11, 21), 702),
-        (date(2002, 12, 17), 710),
-        (date(2003,  7, 27), 711),
-        (date(2003, 12, 16), 720),
-        (date(2004,  1, 21), 721),
-        (date(2004,  3,  9), 723), # test server client
-        (date(2004,  3, 14), 724),
-        (date(2004,  5,  4), 726),
-        (date(2004,  7, 22), 727),
-        (date(2004,  8, 11), 730),
-        (date(2004, 12, 10), 735), # test server client
-        (date(2004, 12, 14), 740),
-        (date(2005,  7,  7), 741),
-        (date(2005,  8,  9), 750),
-        (date(2005, 11, 16), 755),
-        (date(2005, 12, 12), 760),
-        (date(2006,  5,  5), 761), # test server client
-        (date(2006,  5, 17), 770),
-        (date(2006,  5, 31), 771),
-        (date(2006,  6,  8), 772),
-        (date(2006,  8,  1), 780),
-        (date(2006,  8, 29), 781),
-        (date(2006, 10, 13), 782), # Linux client release
-        (date(2006, 12, 12), 790),
-        (date(2007,  1,  8), 792),
-        (date(2007,  6, 26), 800),
-        (date(2007, 12, 11), 810),
-        (date(2008,  4,  8), 811),
-        (date(2008,  7,  2), 820),
-        (date(2008,  7, 24), 821),
-        (date(2008,  8, 12), 822),
-        (date(2008,  9, 30), 830),
-        (date(2008, 10,  1), 831),
-        (date(2008, 12, 10), 840),
-        (date(2009,  3, 18), 841),
-        (date(2009,  4, 22), 842),
-        (date(2009,  7,  1), 850),
-        (date(2009, 10,  1), 852),  # 8.51 was released the same day
-        (date(2009, 11,  5), 853),
-        (date(2009, 12,  9), 854),
-        (date(2010,  3, 17), 855),
-        (date(2010,  5,  5), 856),
-        (date(2010,  5,  6), 857),
-        (date(2010,  6, 30), 860),
-        (date(2010,  8, 23), 861),
-        (date(2010,  9, 22), 862),
-        (date(2010, 12,  8), 870),
-        (date(2011,  1, 27), 871),
-        (date(2011,  4, 20), 872),
-        (date(2011,  4,  4), 873),
-        (date(2011,  4, 12), 874),
-        (date(2011,  6,  9), 900),
-    ]
-
-    # Compile regex
-    regex = re.compile(r'Your last visit in Tibia: (\d+)\. (\S{3}) (\d{4})')
-    for i in range(0, len(frame.data) - 4):
-        # Version 7.1 has 0xb4 0x11
-        # Version 7.2 has 0xb4 0x13
-        # Version 7.26 - 8.10 have 0xb4 0x14
-        # Version 8.2? - ?.?? have 0xb4 0x16
-        if frame.data[i] == 0xb4 and frame.data[i + 1] in (0x11, 0x13, 0x14, 0x16):
-            # Possibly a text message
-            try:
-                text_length = frame.data[i + 2] | frame.data[i + 3] << 8
-                if text_length > 255:
-                    continue
-
-                # Extract, decode and match against regex
-                text = frame.data[i + 4:i + 4 + text_length].decode('ascii')
-                m = regex.search(text)
-                if m is None:
-                    continue
-            except:
-                # ignore
-                continue
 
-            # Parse date
-            d = datetime.strptime(f'{m.group(3)}-{m.group(2)}-{m.group(1)}', '%Y-%b-%d').date()
+def get_all_strings(frames, min_len, unique, smart):
+    # Note: empty strings are never returned, even if min_len is 0
+    strings = _iter_strings(frames, max(min_len, 1))
 
-            # Guess version
-            for vi in range(1, len(updates)):
-                version_date, _ = updates[vi]
-                if version_date > d:
-                    _, version = updates[vi - 1]
-                    return version
+    if smart:
+        strings = (_SMART_PATTERN.sub(_smart_replace, string) for string in strings)
 
-    return None
\ No newline at end of file
+    if unique:
+        # nice
+        strings = sorted(set(strings))
+
+    yield from strings
+
+
+# Tibia updates, release date and version
+_UPDATES = [
+    (date(2002,  8, 28), 700),
+    (date(2002, 10, 22), 701),
+    (date(2002, 11, 21), 702),
+    (date(2002, 12, 17), 710),
+    (date(2003,  7, 27), 711),
+    (date(2003, 12, 16), 720),
+    (date(2004,  1, 21), 721),
+    (date(2004,  3,  9), 723), # test server client
+    (date(2004,  3, 14), 724),
+    (date(2004,  5,  4), 726),
+    (date(2004,  7, 22), 727),
+    (date(2004,  8, 11), 730),
+    (date(2004, 12, 10), 735), # test server client
+    (date(2004, 12, 14), 740),
+    (date(2005,  7,  7), 741),
+    (date(2005,  8,  9), 750),
+    (date(2005, 11, 16), 755),
+    (date(2005, 12, 12), 760),
+    (date(2006,  5,  5), 761), # test server client
+    (date(2006,  5, 17), 770),
+    (date(2006,  5, 31), 771),
+    (date(2006,  6,  8), 772),
+    (date(2006,  8,  1), 780),
+    (date(2006,  8, 29), 781),
+    (date(2006, 10, 13), 782), # Linux client release
+    (date(2006, 12, 12), 790),
+    (date(2007,  1,  8), 792),
+    (date(2007,  6, 26), 800),
+    (date(2007, 12, 11), 810),
+    (date(2008,  4,  8), 811),
+    (date(2008,  7,  2), 820),
+    (date(2008,  7, 24), 821),
+    (date(2008,  8, 12), 822),
+    (date(2008,  9, 30), 830),
+    (date(2008, 10,  1), 831),
+    (date(2008, 12, 10), 840),
+    (date(2009,  3, 18), 841),
+    (date(2009,  4, 22), 842),
+    (date(2009,  7,  1), 850),
+    (date(2009, 10,  1), 852),  # 8.51 was released the same day
+    (date(2009, 11,  5), 853),
+    (date(2009, 12,  9), 854),
+    (date(2010,  3, 17), 855),
+    (date(2010,  5,  5), 856),
+    (date(2010,  5,  6), 857),
+    (date(2010,  6, 30), 860),
+    (date(2010,  8, 23), 861),
+    (date(2010,  9, 22), 862),
+    (date(2010, 12,  8), 870),
+    (date(2011,  1, 27), 871),
+    (date(2011,  4, 20), 872),
+    (date(2011,  4,  4), 873),
+    (date(2011,  4, 12), 874),
+    (date(2011,  6,  9), 900),
+]
+
+# The version for a date is the version of the update before the first update (after the first one)
+# that was released after the date. The dates are not sorted (e.g. 8.72 - 8.74), so we use the
+# latest date so far for each update, which makes it possible to use bisect
+_UPDATE_DATES = list(itertools.accumulate((update_date for update_date, _ in _UPDATES[1:]), max))
+_UPDATE_VERSIONS = [version for _, version in _UPDATES[:-1]]
+
+_MONTHS = {month: i + 1 for i, month in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))}
+
+# Opcode of a text message, followed by the message type
+# Version 7.1 has 0xb4 0x11
+# Version 7.2 has 0xb4 0x13
+# Version 7.26 - 8.10 have 0xb4 0x14
+# Version 8.2? - ?.?? have 0xb4 0x16
+_TEXT_MESSAGE = re.compile(rb'\xb4[\x11\x13\x14\x16]')
+
+_LAST_VISIT = re.compile(r'Your last visit in Tibia: (\d+)\. (\S{3}) (\d{4})')
+
+
+def guess_world_from_frame(frame):
+    data = frame.data
+
+    # Note: the text length and at least one character must fit after the message type
+    for message in _TEXT_MESSAGE.finditer(data, 0, len(data) - 3):
+        i = message.start()
+
+        # Possibly a text message
+        text_length = data[i + 2] | data[i + 3] << 8
+        if text_length > 255:
+            continue
+
+        # Extract, decode and match against regex
+        text_raw = bytes(data[i + 4:i + 4 + text_length])
+        if not text_raw.isascii():
+            continue
+
+        m = _LAST_VISIT.search(str(text_raw, 'ascii'))
+        if m is None:
+            continue
+
+        # Parse date
+        try:
+            d = date(int(m.group(3)), _MONTHS[m.group(2).lower()], int(m.group(1)))
+        except (KeyError, ValueError):
+            continue
+
+        # Guess version
+        i = bisect.bisect_right(_UPDATE_DATES, d)
+        if i < len(_UPDATE_VERSIONS):
+            return _UPDATE_VERSIONS[i]
+
+    return None
@@ -1,3 +1,10 @@
+import array
+from collections.abc import Iterator, Sequence
+import itertools
+import os
+import time
+
+
 class Frame:
     """Represents one frame in a Tibia recording.
 
@@ -6,24 +13,213 @@ class Frame:
         data: The frame data. Contains one or more Tibia packets, without the 2 byte header (data length).
     """
 
+    __slots__ = ('time', 'data')
+
     def __init__(self):
        self.time: int = 0
        self.data: bytes = bytes()
 
 
+class CompactFrameList(Sequence):
+    """A list of Frames, stored compactly.
+
+    The data of all frames is stored in one contiguous buffer, and the frame times and data offsets
+    in arrays, instead of as one Frame object and one bytes object per frame. Frame objects are
+    created when they are accessed, so changing a Frame that was returned does not change the list.
+    """
+
+    def __init__(self, frames: Iterator[Frame] = ()):
+        self._times = array.array('I')
+        self._offsets = array.array('I', [0])
+        self._data = bytearray()
+        self.extend(frames)
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self._times)
+        if index < 0 or index >= len(self._times):
+            raise IndexError("frame index out of range")
+
+        frame = Frame()
+        frame.time = self._times[index]
+        frame.data = bytes(self._data[self._offsets[index]:self._offsets[index + 1]])
+        return frame
+
+    def __iter__(self) -> Iterator[Frame]:
+        for index in range(len(self._times)):
+            yield self[index]
+
+    def append(self, frame: Frame) -> None:
+        self._times.append(frame.time)
+        self._data += frame.data
+        self._offsets.append(len(self._data))
+
+    def extend(self, frames: Iterator[Frame]) -> None:
+        for frame in frames:
+            self.append(frame)
+
+
 class Recording:
     """Represents a Tibia recording.
 
     Attributes:
         version: The Tibia version used to record this recording, if the file contains this information.
         length: The length of this recording in milliseconds.
-        frames: A list of Frames.
+        frames: A list of Frames, or a CompactFrameList if the recording was created with compact=True.
     """
 
-    def __init__(self):
+    def __init__(self, compact: bool = False):
         self.version: int = None
         self.length: int = 0
-        self.frames: list[Frame] = []
+        self.frames: list[Frame] = CompactFrameList() if compact else []
+
+
+class RecordingInfo:
+    """Information about a Tibia recording, from its header.
+
+    Attributes:
+        recording_format: The RecordingFormat of the file.
+        version: The Tibia version stored in the file, or guessed from the login message.
+        length: The length in milliseconds stored in the file, or None if it is not stored.
+        num_frames: The number of frames stored in the file, or None if it is not stored. Note that
+                    this is before the frames are merged, so it may differ from len(Recording.frames).
+        file_size: The size of the file in bytes.
+        data_size: The size of the data in the file when it is not compressed, or None if it is not known.
+    """
+
+    def __init__(self):
+        self.recording_format: type[RecordingFormat] = None
+        self.version: int = None
+        self.length: int = None
+        self.num_frames: int = None
+        self.file_size: int = 0
+        self.data_size: int = None
+
+
+class StageStats:
+    """Statistics for one stage of loading a recording, see LoadStats.
+
+    Attributes:
+        time: The time in seconds spent in this stage, not including the stages it reads from.
+        frames: The number of frames this stage produced, or the number of calls for a stage that
+                processes one frame at a time, e.g. decryption.
+        bytes_in: The number of bytes of frame data this stage got, or None if it reads from the file.
+        bytes_out: The number of bytes of frame data this stage produced.
+    """
+
+    __slots__ = ('time', 'frames', 'bytes_in', 'bytes_out')
+
+    def __init__(self):
+        self.time: float = 0.0
+        self.frames: int = 0
+        self.bytes_in: int = None
+        self.bytes_out: int = 0
+
+
+class LoadStats:
+    """Time spent, and frames and bytes produced, in each stage of loading a recording.
+
+    Pass a LoadStats object as stats to load() or iter_frames() to fill it in. Which stages there
+    are depends on the format, e.g. 'read', 'simple_decrypt', 'aes_decrypt' and 'merge_frames'
+    for .rec files. The time of a stage does not include the time of the stages it reads from,
+    so the times add up to the time spent loading. One LoadStats object can be used for several
+    files, the statistics are then summed. Without stats nothing is measured.
+
+    Attributes:
+        stages: dict of stage name to StageStats, in the order the stages were created.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, StageStats] = {}
+
+        # The stages that are currently measured, the last one called the others
+        self._active = []
+
+        # Time spent in stages called from the stage that is currently measured
+        self._nested = 0.0
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats()
+        return stage
+
+    def _measure(self, stage, function, *args):
+        outer = self._nested
+        self._nested = 0.0
+        self._active.append(stage)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._active.pop()
+            stage.time += elapsed - self._nested
+            self._nested = outer + elapsed
+
+    def frames(self, name: str, frames: Iterator[Frame]) -> Iterator[Frame]:
+        """Returns frames, measuring the time spent producing each frame as the stage name.
+        """
+        return self._frames(self._stage(name), iter(frames))
+
+    def _frames(self, stage, frames):
+        try:
+            while True:
+                try:
+                    frame = self._measure(stage, next, frames)
+                except StopIteration:
+                    return
+
+                stage.frames += 1
+                stage.bytes_out += len(frame.data)
+
+                # The frame is input to the stage that is reading from this one, if it is measured
+                if self._active:
+                    consumer = self._active[-1]
+                    consumer.bytes_in = (consumer.bytes_in or 0) + len(frame.data)
+
+                yield frame
+
+        finally:
+            # Close the stages we read from if we are closed early
+            if hasattr(frames, 'close'):
+                frames.close()
+
+    def call(self, name: str, function):
+        """Returns function, measuring each call to it as the stage name.
+
+        The frame data is the last argument, which can also be a Frame, and the result.
+        """
+        def measured(*args):
+            stage = self._stage(name)
+            data = args[-1].data if isinstance(args[-1], Frame) else args[-1]
+            result = self._measure(stage, function, *args)
+
+            stage.frames += 1
+            stage.bytes_in = (stage.bytes_in or 0) + len(data)
+            stage.bytes_out += len(result)
+            return result
+
+        return measured
+
+    def run(self, name: str, function, *args):
+        """Returns function(*args), measuring the call as the stage name, e.g. for guessing the version.
+        """
+        stage = self._stage(name)
+        result = self._measure(stage, function, *args)
+        stage.frames += 1
+        return result
+
+    def report(self) -> dict:
+        """Returns a dict of stage name to a dict with time, frames, bytes_in and bytes_out.
+        """
+        return {name: {attribute: getattr(stage, attribute) for attribute in StageStats.__slots__} for name, stage in self.stages.items()}
 
 
 class RecordingFormat:
@@ -31,20 +227,114 @@ class RecordingFormat:
     """
 
     extension: str = None
-    has_magic: bool = False
 
-    def load(filename: str) -> tuple[Recording, Exception]:
+    # Whether decoded recordings in this format are kept in the cache, see load()
+    cacheable: bool = True
+
+    def sniff(data: bytes) -> int:
+        """Check if a file could be in this format, from the first bytes of the file.
+
+        Returns a score from 0 to 100, where 0 means that the file is not in this format
+        and 100 means that it certainly is, e.g. because of a matching magic. data is the
+        first 512 bytes of the file, or the whole file if it is shorter.
+        """
+        return 0
+
+    @classmethod
+    def has_magic(cls, data: bytes) -> bool:
+        """Check if a file could be in this format, from the first bytes of the file.
+
+        Kept for compatibility, see sniff().
+        """
+        return cls.sniff(data) > 0
+
+    def iter_frames(filename: str, rec: Recording, use_mmap: bool = False, start_ms: int = 0, stats: LoadStats = None) -> Iterator[Frame]:
+        """Iterate over the frames in a Tibia recording.
+
+        Yields the frames one by one, as they would be in Recording.frames, i.e. decrypted and merged.
+        Information from the file, e.g. version and length, is set in rec while the frames are read.
+        Exceptions are raised as they occur, after all frames before that point have been yielded.
+
+        If use_mmap is True the file is memory-mapped instead of read, if the format allows it. Frame
+        data that does not need to be decrypted or decompressed is then a memoryview of the mapping.
+
+        If start_ms is set, frames before that time may be skipped, if the format can seek, e.g. using
+        an index. This is only a hint: frames before start_ms may still be yielded.
+
+        If stats is set, the time spent in each stage of reading and decoding is measured in it.
+        """
+        raise NotImplementedError
+
+    def probe(filename: str, info: RecordingInfo) -> None:
+        """Read information about a Tibia recording, without reading the frames.
+
+        Information from the file header is set in info. Fields that the header does not contain
+        are left as they are.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, filename: str, compact: bool = False, use_mmap: bool = False, start_ms: int = 0,
+             max_frames: int = None, max_ms: int = None, max_bytes: int = None, stats: LoadStats = None) -> tuple[Recording, Exception]:
         """Load a Tibia recording.
 
+        If compact is True, the frames are stored in a CompactFrameList.
+        See iter_frames() for use_mmap. Only frames from start_ms and later are loaded.
+
+        Loading stops after max_frames frames, before the first frame that is max_ms or more after
+        start_ms, or before the frame that would make the total frame data larger than max_bytes.
+        The rest of the file is then not read at all. Note that rec.length is only the length of the
+        frames read so far, unless the length is stored in the file. See iter_frames() for stats.
+
         Return: tuple of Recording and Exception
                 Recording should be set if something from the file could be parsed
                 Exception should be set if an exception was raised during loading
                 Note that both Recording and Exception can be set, if loading was
                 partially successful
         """
-        return None, NotImplementedError()
+        rec = Recording(compact)
+        exception = None
+
+        frames = cls.iter_frames(filename, rec, use_mmap, start_ms, stats)
+        num_bytes = 0
+        try:
+            # max_frames is checked before the next frame is read, so that no frame is decoded in vain
+            while max_frames is None or len(rec.frames) < max_frames:
+                frame = next(frames, None)
+                if frame is None:
+                    break
+
+                if frame.time < start_ms:
+                    continue
+
+                if max_ms is not None and frame.time - start_ms >= max_ms:
+                    break
+
+                num_bytes += len(frame.data)
+                if max_bytes is not None and num_bytes > max_bytes:
+                    break
+
+                rec.frames.append(frame)
 
-    def save(filename: str, recording: Recording) -> None:
+        except Exception as e:
+            exception = e
+
+        finally:
+            # Stop decoding, and close the file, if we stopped early
+            frames.close()
+
+        return rec, exception
+
+    def save(recording: Recording, filename: str, fsync: bool = False, index: bool = False) -> None:
+        raise NotImplementedError
+
+    def save_frames(rec: Recording, filename: str, frames: Iterator[Frame], fsync: bool = False, index: bool = False) -> None:
+        """Save a Tibia recording, frame by frame.
+
+        The frames are written as they are read from frames, which can be any iterable, e.g. the
+        generator returned by iter_frames() with the same rec. rec.version and rec.length are only
+        used after all frames have been written.
+        """
         raise NotImplementedError
 
 
@@ -53,15 +343,18 @@ class InvalidFileError(Exception):
 
 
 from oldschooltibia._trp import RecordingFormatTrp
+from oldschooltibia._trz import RecordingFormatTrz
 from oldschooltibia._rec import RecordingFormatRec
 from oldschooltibia._cam import RecordingFormatCam
 from oldschooltibia._ttm import RecordingFormatTtm
 from oldschooltibia._tmv import RecordingFormatTmv
 from oldschooltibia import utils
+from oldschooltibia import _cache
 
 
 recording_formats: list[RecordingFormat] = [
     RecordingFormatTrp,
+    RecordingFormatTrz,
     RecordingFormatRec,
     RecordingFormatCam,
     RecordingFormatTtm,
@@ -69,19 +362,206 @@ recording_formats: list[RecordingFormat] = [
 ]
 
 
-def _load(filename, allow_partial, recording_format, guess_version):
-    recording, exception = recording_format.load(filename)
+# Number of bytes read from the start of a file for RecordingFormat.sniff()
+_SNIFF_SIZE = 512
+
+
+def _recording_formats(filename):
+    with open(filename, 'rb') as f:
+        data = f.read(_SNIFF_SIZE)
+
+    # First try the formats that the file could be in, best score first
+    # On equal scores, the format matching the file extension is tried first
+    candidates = []
+    for recording_format in recording_formats:
+        score = recording_format.sniff(data)
+        if score > 0:
+            candidates.append((score, filename.lower().endswith(recording_format.extension), recording_format))
+
+    candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+    for _, _, recording_format in candidates:
+        yield recording_format
+
+    # Then try the formats matching the file extension, if they were not candidates,
+    # in case the file is valid but does not look like it
+    for recording_format in recording_formats:
+        if filename.lower().endswith(recording_format.extension) and \
+           all(recording_format is not candidate[2] for candidate in candidates):
+            yield recording_format
+
+
+def is_recording(filename: str, sniff: bool = True) -> bool:
+    """Checks if a file could be a Tibia recording
+
+    Returns True if the file has the extension of a supported format, or if sniff is True and
+    the first bytes of the file look like a supported format. A file for which this returns
+    False can not be loaded, but one for which it returns True may still be invalid.
+
+    Arguments:
+        filename: The filename of the file to check.
+        sniff: if False, only check the file extension and do not read the file.
+    """
+
+    if filename.lower().endswith(tuple(recording_format.extension for recording_format in recording_formats)):
+        return True
+
+    if not sniff:
+        return False
+
+    with open(filename, 'rb') as f:
+        data = f.read(_SNIFF_SIZE)
+
+    return any(recording_format.sniff(data) > 0 for recording_format in recording_formats)
+
+
+def _try_formats(filename, function, warn=True):
+    # Returns function(recording_format) for the first format that the file could be in for which it
+    # does not raise an exception. If it raises for all of them, the exception is raised
+    original_exception = None
+    for recording_format in _recording_formats(filename):
+        try:
+            result = function(recording_format)
+        except Exception as e:
+            if filename.lower().endswith(recording_format.extension) or original_exception is None:
+                # Save exception so that we can throw it if loading with other formats also fails
+                # Prefer the exception from the format matching the file extension
+                original_exception = e
+            continue
+
+        if warn and not filename.lower().endswith(recording_format.extension):
+            print(f"'{filename}': warning, file extension does not match file content, but was loaded successfully as '{recording_format.extension}'")
+
+        return result
+
+    if original_exception:
+        raise original_exception
+
+    raise InvalidFileError("unsupported file format")
+
+
+def _first_frames(filename, recording_format, use_mmap):
+    # Returns the first frames of the recording, for guessing the version, ignoring any exception
+    # Note: utils.guess_version only checks the first 10 frames
+    recording, _ = recording_format.load(filename, use_mmap=use_mmap, max_frames=10)
+    return recording.frames
+
+
+def _guess_version(filename, recording_format, frames, use_mmap, reload):
+    # The login message is in the first frames, which may not have been loaded if start_ms or a limit is set
+    if reload:
+        frames = _first_frames(filename, recording_format, use_mmap)
+
+    return utils.guess_version(frames)
+
+
+def _load(filename, allow_partial, recording_format, guess_version, compact, use_mmap, start_ms, max_frames, max_ms, max_bytes, cache, stats):
+    if not recording_format.cacheable:
+        cache = None
+
+    cache_filename = cache.lookup(filename, recording_format) if cache is not None else None
+    if cache_filename is not None:
+        recording, exception = _cache.RecordingFormatCache.load(cache_filename, compact, use_mmap, start_ms, max_frames, max_ms, max_bytes, stats)
+        if exception is not None:
+            # Broken cache file, or removed by another process, decode the recording instead
+            cache.remove(filename, recording_format)
+            cache_filename = None
+
+    if cache_filename is None:
+        recording, exception = recording_format.load(filename, compact, use_mmap, start_ms, max_frames, max_ms, max_bytes, stats)
+
+        # Only cache complete recordings, before the version is guessed
+        if cache is not None and exception is None and start_ms == 0 and (max_frames, max_ms, max_bytes) == (None, None, None):
+            if stats is None:
+                cache.store(filename, recording_format, recording)
+            else:
+                stats.run('store_cache', cache.store, filename, recording_format, recording)
+
     if exception is None or (allow_partial and len(recording.frames) > 0):
         if exception is not None:
             print(f"'{filename}': warning, only partial recording was loaded: {exception}")
 
-        recording.version = utils.guess_version(recording.frames) if recording.version is None and guess_version else recording.version
-        return recording, exception
+        if recording.version is None and guess_version:
+            reload = start_ms > 0 or (len(recording.frames) < 10 and (max_frames, max_ms, max_bytes) != (None, None, None))
+            if stats is None:
+                recording.version = _guess_version(filename, recording_format, recording.frames, use_mmap, reload)
+            else:
+                recording.version = stats.run('guess_version', _guess_version, filename, recording_format, recording.frames, use_mmap, reload)
+
+        return recording
+
+    raise exception
+
+
+def _iter_format_frames(filename, recording_format, rec, use_mmap, start_ms, cache, stats):
+    # Yields the frames of a recording in recording_format, from the cache if it is there
+    # If the cache file can not be read, e.g. because it is broken, it is removed and the frames
+    # that were not read from it are decoded from the file instead
+    if not recording_format.cacheable:
+        cache = None
+
+    num_frames = 0
+    cache_filename = cache.lookup(filename, recording_format) if cache is not None else None
+    if cache_filename is not None:
+        frames = _cache.RecordingFormatCache.iter_frames(cache_filename, rec, use_mmap, start_ms, stats)
+        try:
+            for frame in frames:
+                yield frame
+                num_frames += 1
+            return
+
+        except Exception:
+            cache.remove(filename, recording_format)
+
+        finally:
+            frames.close()
+
+    if num_frames > 0:
+        # The cache has all frames from the start of the recording, skip the ones already yielded
+        frames = recording_format.iter_frames(filename, rec, use_mmap, 0, stats)
+        try:
+            yield from itertools.islice(frames, num_frames, None)
+        finally:
+            frames.close()
+        return
+
+    frames = recording_format.iter_frames(filename, rec, use_mmap, start_ms, stats)
+
+    # The recording is cached if all frames are read
+    if cache is not None and start_ms == 0:
+        frames = cache.store_frames(filename, recording_format, rec, frames)
+
+    yield from frames
+
+
+def _start_frames(filename, allow_partial, recording_format, rec, use_mmap, start_ms, cache, stats):
+    # Returns the frames of a recording in recording_format, the first (up to 10) of them, and the
+    # exception raised while reading them, if any
+    # The first frames are read before anything is yielded, so that the next format can be tried
+    # if this one fails, and so that the version can be guessed
+    # Note: utils.guess_version only checks the first 10 frames
+    rec.version = None
+    rec.length = 0
+
+    frames = _iter_format_frames(filename, recording_format, rec, use_mmap, start_ms, cache, stats)
+    first_frames = []
+    exception = None
+    try:
+        for frame in itertools.islice(frames, 10):
+            first_frames.append(frame)
+
+    except Exception as e:
+        exception = e
 
-    return None, exception
+    if exception is not None and (not allow_partial or len(first_frames) == 0):
+        frames.close()
+        raise exception
 
+    return frames, first_frames, exception
 
-def load(filename: str, allow_partial: bool = True, guess_version: bool = True) -> Recording:
+
+def load(filename: str, allow_partial: bool = True, guess_version: bool = True, compact: bool = False, use_mmap: bool = False, start_ms: int = 0,
+         max_frames: int = None, max_ms: int = None, max_bytes: int = None, cache_dir: str = None, stats: LoadStats = None,
+         recording_format: type[RecordingFormat] = None) -> Recording:
     """Loads a Tibia recording
 
     Loads a Tibia recording file and returns a Recording object and the format it was loaded with.
@@ -93,43 +573,169 @@ def load(filename: str, allow_partial: bool = True, guess_version: bool = True)
                        as at least one frame could be read
         guess_version: if True, try to guess the Tibia version used for this recording,
                        unless the file already contains the version
+        compact: if True, store the frames in a CompactFrameList instead of a list, which uses
+                 a lot less memory for long recordings
+        use_mmap: if True, memory-map the file instead of reading it, when the format allows it.
+                  Frame data that is not encrypted or compressed in the file is then a memoryview
+                  of the mapping instead of a copy, e.g. for .trp files
+        start_ms: if set, only load the frames from this time (in milliseconds) and later.
+                  The frame times and the recording length are not changed. For .trp files
+                  with an index (see save()) the frames before start_ms are not even read
+        max_frames: if set, load at most this many frames
+        max_ms: if set, only load the frames within this many milliseconds from start_ms
+        max_bytes: if set, load at most this many bytes of frame data.
+                   The file is only read and decoded until one of the limits is reached,
+                   e.g. for previews. Note that the recording length may then be incomplete
+        cache_dir: if set, keep decoded recordings in this directory, so that loading the same file
+                   again does not need to decrypt or decompress it. If not set, the directory in the
+                   OLDSCHOOLTIBIA_CACHE_DIR environment variable is used, if any. The least recently
+                   used recordings are removed when the cache is larger than OLDSCHOOLTIBIA_CACHE_SIZE
+                   MiB (default 1024). .trp files are never cached, they are as fast to read as the cache
+        stats: if set, a LoadStats object in which the time spent in each stage of loading is measured,
+               e.g. reading, decryption and merging of frames. If the file is tried as several formats
+               the stages of all of them are included
+        recording_format: if set, load the file in this format, e.g. RecordingInfo.recording_format from
+                          probe(), instead of detecting the format. No other format is tried
     """
 
-    # First try loading with the format matching the file extension
-    for recording_format in filter(lambda recording_format: filename.lower().endswith(recording_format.extension), recording_formats):
-        recording, exception = _load(filename, allow_partial, recording_format, guess_version)
-        if recording is not None:
-            return recording
+    cache = _cache.get_cache(cache_dir)
 
-        # Save exception so that we can throw it if loading with other formats also fails
-        original_exception = exception
+    if recording_format is not None:
+        return _load(filename, allow_partial, recording_format, guess_version, compact, use_mmap, start_ms, max_frames, max_ms, max_bytes, cache, stats)
 
-    # Try loading with other formats (only try formats that have magic identifier)
-    for recording_format in filter(lambda recording_format: not filename.lower().endswith(recording_format.extension) and recording_format.has_magic, recording_formats):
-        recording, _ = _load(filename, allow_partial, recording_format, guess_version)
-        if recording is not None:
-            print(f"'{filename}': warning, file extension does not match file content, but was loaded successfully as '{recording_format.extension}'")
-            return recording
+    return _try_formats(filename, lambda recording_format: _load(filename, allow_partial, recording_format, guess_version, compact, use_mmap,
+                                                                 start_ms, max_frames, max_ms, max_bytes, cache, stats))
 
-    if original_exception:
-        raise original_exception
 
-    raise InvalidFileError("unsupported file format")
+def iter_frames(filename: str, allow_partial: bool = True, guess_version: bool = True, rec: Recording = None, use_mmap: bool = False, start_ms: int = 0,
+                cache_dir: str = None, stats: LoadStats = None) -> Iterator[Frame]:
+    """Iterates over the frames in a Tibia recording
+
+    Like load(), but yields the frames one by one instead of returning a Recording object,
+    so that the whole recording does not need to be kept in memory.
+
+    Note that if allow_partial is False, some frames may already have been yielded
+    when the exception is raised.
+
+    Arguments:
+        filename: The filename of the Tibia recording to iterate over.
+        allow_partial: see load()
+        guess_version: see load()
+        rec: if set, the version and length of the recording are set in this Recording object.
+             Note that for some formats the length is not known until all frames have been read.
+        use_mmap: see load()
+        start_ms: see load()
+        cache_dir: see load()
+        stats: see load()
+    """
+
+    if rec is None:
+        rec = Recording()
+
+    cache = _cache.get_cache(cache_dir)
+
+    frames, first_frames, exception = _try_formats(filename, lambda recording_format: _start_frames(filename, allow_partial, recording_format, rec,
+                                                                                                      use_mmap, start_ms, cache, stats))
+
+    if rec.version is None and guess_version:
+        # Note: formats without a version in the file can not skip frames, so the first
+        #       frames are always read from the start of the recording
+        if stats is None:
+            rec.version = utils.guess_version(first_frames)
+        else:
+            rec.version = stats.run('guess_version', utils.guess_version, first_frames)
+
+    yield from (frame for frame in first_frames if frame.time >= start_ms)
+
+    try:
+        if exception is None:
+            yield from (frame for frame in frames if frame.time >= start_ms)
+
+    except Exception as e:
+        if not allow_partial:
+            raise
+
+        exception = e
+
+    finally:
+        # Stop decoding, and close the file, if we are closed early
+        frames.close()
+
+    if exception is not None:
+        print(f"'{filename}': warning, only partial recording was loaded: {exception}")
+
+
+def _probe(filename, recording_format, guess_version):
+    info = RecordingInfo()
+    info.recording_format = recording_format
+    info.file_size = os.path.getsize(filename)
+
+    recording_format.probe(filename, info)
 
+    if info.version is None and guess_version:
+        info.version = utils.guess_version(_first_frames(filename, recording_format, True))
 
-def save(recording: Recording, filename: str) -> None:
+    return info
+
+
+def probe(filename: str, guess_version: bool = True) -> RecordingInfo:
+    """Reads information about a Tibia recording
+
+    Reads the header of a Tibia recording file and returns a RecordingInfo object, without
+    decrypting or decompressing the frames. This is a lot faster than load() for large files.
+
+    Arguments:
+        filename: The filename of the Tibia recording to probe.
+        guess_version: if True, try to guess the Tibia version used for this recording, unless
+                       the file already contains the version. Only the first frames are read.
+    """
+
+    return _try_formats(filename, lambda recording_format: _probe(filename, recording_format, guess_version), warn=False)
+
+
+def save(recording: Recording, filename: str, fsync: bool = False, index: bool = False) -> None:
     """Saves a Tibia recording
 
-    Saves a Tibia recording to a file.
+    Saves a Tibia recording to a file. The file is first written to a temporary file, which
+    is moved to filename when it is complete. An existing file is never overwritten.
 
     Arguments:
         recording: The Recording object to save.
         filename: The filename of the file.
+        fsync: if True, make sure that the file is written to disk before returning.
+        index: if True, also write an index of frame times to file offsets, so that
+               load() with start_ms can seek directly to a frame. Only supported for .trp
+               files, where the index is written to a sidecar .trpi file
+    """
+
+    for recording_format in recording_formats:
+        if filename.lower().endswith(recording_format.extension):
+            recording_format.save(recording, filename, fsync, index)
+            return
+
+    raise InvalidFileError("unsupported file format")
+
+
+def save_frames(rec: Recording, filename: str, frames: Iterator[Frame], fsync: bool = False, index: bool = False) -> None:
+    """Saves a Tibia recording, frame by frame
+
+    Like save(), but the frames are written as they are read from frames, e.g. the generator
+    returned by iter_frames() with the same rec, so that the whole recording does not need to
+    be kept in memory. rec.version and rec.length are only used after all frames have been
+    written, so they may be set while the frames are read. If reading the frames raises an
+    exception, no file is written.
+
+    Arguments:
+        rec: The Recording object with the version and length of the recording. Its frames are not used.
+        filename: The filename of the file.
+        frames: The frames to write.
+        fsync: see save()
+        index: see save()
     """
 
     for recording_format in recording_formats:
         if filename.lower().endswith(recording_format.extension):
-            recording_format.save(recording, filename)
+            recording_format.save_frames(rec, filename, frames, fsync, index)
             return
 
     raise InvalidFileError("unsupported file format")
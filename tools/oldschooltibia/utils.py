@@ -1,6 +1,308 @@
+import functools
+import hashlib
+import re
+
 from oldschooltibia import _utils
 
 
+WORLDS = [
+    # From https://tibia.fandom.com/wiki/Game_Worlds
+
+    # Active worlds
+    "Ambra",
+    "Antica",
+    "Astera",
+    "Axera",
+    "Belobra",
+    "Bombra",
+    "Bona",
+    "Calmera",
+    "Castela",
+    "Celebra",
+    "Celesta",
+    "Collabra",
+    "Damora",
+    "Descubra",
+    # Dia gives a lot of false positives
+    # Since it was released in 2023 we simply ignore it
+    #"Dia",
+    "Epoca",
+    "Esmera",
+    "Etebra",
+    "Ferobra",
+    "Firmera",
+    "Flamera",
+    "Gentebra",
+    "Gladera",
+    "Gravitera",
+    "Guerribra",
+    "Harmonia",
+    "Havera",
+    "Honbra",
+    "Impulsa",
+    "Inabra",
+    "Issobra",
+    "Jacabra",
+    "Jadebra",
+    "Jaguna",
+    "Kalibra",
+    "Kardera",
+    "Kendria",
+    "Lobera",
+    "Luminera",
+    "Lutabra",
+    "Menera",
+    "Monza",
+    "Mykera",
+    "Nadora",
+    "Nefera",
+    "Nevia",
+    "Obscubra",
+    "Oceanis",
+    "Ombra",
+    "Ousabra",
+    "Pacera",
+    "Peloria",
+    "Premia",
+    "Pulsera",
+    "Quelibra",
+    "Quintera",
+    "Rasteibra",
+    "Refugia",
+    "Retalia",
+    "Runera",
+    "Secura",
+    "Serdebra",
+    "Solidera",
+    "Stralis",
+    "Syrena",
+    "Talera",
+    "Thyria",
+    "Tornabra",
+    "Ulera",
+    "Unebra",
+    "Ustebra",
+    "Utobra",
+    "Vandera",
+    "Venebra",
+    "Victoris",
+    "Vitera",
+    "Vunira",
+    "Wadira",
+    "Wildera",
+    "Wintera",
+    "Yara",
+    "Yonabra",
+    "Yovera",
+    "Yubra",
+    "Zephyra",
+    "Zuna",
+    "Zunera",
+
+    # Old worlds"
+    "Adra",
+    "Aldora",
+    "Alumbra",
+    "Amera",
+    "Arcania",
+    "Ardera",
+    "Askara",
+    "Assombra",
+    "Aurea",
+    "Aurera",
+    "Aurora",
+    "Azura",
+    "Balera",
+    "Bastia",
+    "Batabra",
+    "Bellona",
+    "Belluma",
+    "Beneva",
+    "Berylia",
+    "Cadebra",
+    "Calva",
+    "Calvera",
+    "Candia",
+    "Carnera",
+    "Chimera",
+    "Chrona",
+    "Concorda",
+    "Cosera",
+    "Danera",
+    "Danubia",
+    "Dibra",
+    "Dolera",
+    "Duna",
+    "Efidia",
+    "Eldera",
+    "Elera",
+    "Elysia",
+    "Emera",
+    "Empera",
+    "Estela",
+    "Eternia",
+    "Faluna",
+    "Famosa",
+    "Fera",
+    "Fervora",
+    "Fidera",
+    "Fortera",
+    "Funera",
+    "Furia",
+    "Furora",
+    "Galana",
+    "Garnera",
+    "Grimera",
+    "Guardia",
+    "Helera",
+    "Hiberna",
+    "Honera",
+    "Hydera",
+    "Illusera",
+    "Impera",
+    "Inferna",
+    "Iona",
+    "Iridia",
+    "Irmada",
+    "Isara",
+    "Jamera",
+    "Javibra",
+    "Jonera",
+    "Julera",
+    "Justera",
+    "Juva",
+    "Karna",
+    "Keltera",
+    "Kenora",
+    "Kronera",
+    "Kyra",
+    "Laudera",
+    "Libera",
+    "Libertabra",
+    "Lucera",
+    "Lunara",
+    "Macabra",
+    "Magera",
+    "Malvera",
+    "Marbera",
+    "Marcia",
+    "Mercera",
+    "Mitigera",
+    "Morgana",
+    "Morta",
+    "Mortera",
+    "Mudabra",
+    "Mythera",
+    "Nebula",
+    "Neptera",
+    "Nerana",
+    "Nexa",
+    "Nika",
+    "Noctera",
+    "Nossobra",
+    "Nova",
+    "Obsidia",
+    "Ocebra",
+    "Ocera",
+    "Olera",
+    "Olima",
+    "Olympa",
+    "Optera",
+    "Osera",
+    "Pacembra",
+    "Pandoria",
+    "Panthebra",
+    "Panthena",
+    "Panthera",
+    "Pyra",
+    "Pythera",
+    "Quilia",
+    "Ragna",
+    "Reinobra",
+    "Relania",
+    "Relembra",
+    "Rowana",
+    "Rubera",
+    "Samera",
+    "Saphira",
+    "Seanera",
+    "Selena",
+    "Serenebra",
+    "Shanera",
+    "Shivera",
+    "Silvera",
+    "Solera",
+    "Suna",
+    "Tavara",
+    "Tembra",
+    "Tenebra",
+    "Thera",
+    "Thoria",
+    "Titania",
+    "Torpera",
+    "Tortura",
+    "Trimera",
+    "Trona",
+    "Umera",
+    "Unica",
+    "Unisera",
+    "Unitera",
+    "Valoria",
+    "Veludera",
+    "Verlana",
+    "Versa",
+    "Vinera",
+    "Visabra",
+    "Vita",
+    "Wizera",
+    "Xandebra",
+    "Xantera",
+    "Xerena",
+    "Xylana",
+    "Xylona",
+    "Yanara",
+    "Ysolera",
+    "Zanera",
+    "Zeluna",
+    "Zenobra",
+]
+
+
+# Letters, i.e. word characters that are not digits or underscore
+_LETTER = r'[^\W\d_]'
+
+
+def _trie_pattern(words):
+    # Builds a regex alternation shaped like a trie of the words, e.g. "a(?:b|cd?)" for "ab", "ac" and "acd",
+    # so that the regex engine only needs to follow one branch per character, like an Aho-Corasick automaton
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def to_pattern(node):
+        branches = [re.escape(c) + to_pattern(child) for c, child in sorted(node.items()) if c]
+        if not branches:
+            return ''
+
+        if '' in node:
+            # A word ends here, the rest is optional (and greedy, so the longest word is tried first)
+            return '(?:' + '|'.join(branches) + ')?'
+
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return to_pattern(trie)
+
+
+@functools.lru_cache(maxsize=None)
+def _world_pattern():
+    # Matches a (lowercase) world name that is not part of a longer word, e.g. "nova" in "nova." but not in
+    # "jenova" or "novas", optionally preceded by "of ", "in " or "de "
+    return re.compile(f'(?P<prefix>(?:of|in|de) )?(?<!{_LETTER})(?P<world>{_trie_pattern(world.lower() for world in WORLDS)})(?!{_LETTER})')
+
+
 def guess_version(frames, select_alternative_version=True):
     if len(frames) == 0:
         return
@@ -40,295 +342,47 @@ def guess_world(frames):
      - Add release dates to all worlds so that the script can cross-reference
        the Recording (Tibia) version's release date against world release dates
        and remove/skip worlds that can't possibly be correct.
-
-     - Improve the string check to not match on things like 'Jenova' -> 'Nova'
-       It should still match if it ends with a dot, comma or other separator (including EOL)
-       Example for the world 'Nova':
-       'Jenova' -> no match
-       'Nova.' -> match
-       'Nova$' -> match
-       'Novas' -> no match
     """
 
-    WORLDS = [
-        # From https://tibia.fandom.com/wiki/Game_Worlds
-
-        # Active worlds
-        "Ambra",
-        "Antica",
-        "Astera",
-        "Axera",
-        "Belobra",
-        "Bombra",
-        "Bona",
-        "Calmera",
-        "Castela",
-        "Celebra",
-        "Celesta",
-        "Collabra",
-        "Damora",
-        "Descubra",
-        # Dia gives a lot of false positives
-        # Since it was released in 2023 we simply ignore it
-        #"Dia",
-        "Epoca",
-        "Esmera",
-        "Etebra",
-        "Ferobra",
-        "Firmera",
-        "Flamera",
-        "Gentebra",
-        "Gladera",
-        "Gravitera",
-        "Guerribra",
-        "Harmonia",
-        "Havera",
-        "Honbra",
-        "Impulsa",
-        "Inabra",
-        "Issobra",
-        "Jacabra",
-        "Jadebra",
-        "Jaguna",
-        "Kalibra",
-        "Kardera",
-        "Kendria",
-        "Lobera",
-        "Luminera",
-        "Lutabra",
-        "Menera",
-        "Monza",
-        "Mykera",
-        "Nadora",
-        "Nefera",
-        "Nevia",
-        "Obscubra",
-        "Oceanis",
-        "Ombra",
-        "Ousabra",
-        "Pacera",
-        "Peloria",
-        "Premia",
-        "Pulsera",
-        "Quelibra",
-        "Quintera",
-        "Rasteibra",
-        "Refugia",
-        "Retalia",
-        "Runera",
-        "Secura",
-        "Serdebra",
-        "Solidera",
-        "Stralis",
-        "Syrena",
-        "Talera",
-        "Thyria",
-        "Tornabra",
-        "Ulera",
-        "Unebra",
-        "Ustebra",
-        "Utobra",
-        "Vandera",
-        "Venebra",
-        "Victoris",
-        "Vitera",
-        "Vunira",
-        "Wadira",
-        "Wildera",
-        "Wintera",
-        "Yara",
-        "Yonabra",
-        "Yovera",
-        "Yubra",
-        "Zephyra",
-        "Zuna",
-        "Zunera",
-
-        # Old worlds"
-        "Adra",
-        "Aldora",
-        "Alumbra",
-        "Amera",
-        "Arcania",
-        "Ardera",
-        "Askara",
-        "Assombra",
-        "Aurea",
-        "Aurera",
-        "Aurora",
-        "Azura",
-        "Balera",
-        "Bastia",
-        "Batabra",
-        "Bellona",
-        "Belluma",
-        "Beneva",
-        "Berylia",
-        "Cadebra",
-        "Calva",
-        "Calvera",
-        "Candia",
-        "Carnera",
-        "Chimera",
-        "Chrona",
-        "Concorda",
-        "Cosera",
-        "Danera",
-        "Danubia",
-        "Dibra",
-        "Dolera",
-        "Duna",
-        "Efidia",
-        "Eldera",
-        "Elera",
-        "Elysia",
-        "Emera",
-        "Empera",
-        "Estela",
-        "Eternia",
-        "Faluna",
-        "Famosa",
-        "Fera",
-        "Fervora",
-        "Fidera",
-        "Fortera",
-        "Funera",
-        "Furia",
-        "Furora",
-        "Galana",
-        "Garnera",
-        "Grimera",
-        "Guardia",
-        "Helera",
-        "Hiberna",
-        "Honera",
-        "Hydera",
-        "Illusera",
-        "Impera",
-        "Inferna",
-        "Iona",
-        "Iridia",
-        "Irmada",
-        "Isara",
-        "Jamera",
-        "Javibra",
-        "Jonera",
-        "Julera",
-        "Justera",
-        "Juva",
-        "Karna",
-        "Keltera",
-        "Kenora",
-        "Kronera",
-        "Kyra",
-        "Laudera",
-        "Libera",
-        "Libertabra",
-        "Lucera",
-        "Lunara",
-        "Macabra",
-        "Magera",
-        "Malvera",
-        "Marbera",
-        "Marcia",
-        "Mercera",
-        "Mitigera",
-        "Morgana",
-        "Morta",
-        "Mortera",
-        "Mudabra",
-        "Mythera",
-        "Nebula",
-        "Neptera",
-        "Nerana",
-        "Nexa",
-        "Nika",
-        "Noctera",
-        "Nossobra",
-        "Nova",
-        "Obsidia",
-        "Ocebra",
-        "Ocera",
-        "Olera",
-        "Olima",
-        "Olympa",
-        "Optera",
-        "Osera",
-        "Pacembra",
-        "Pandoria",
-        "Panthebra",
-        "Panthena",
-        "Panthera",
-        "Pyra",
-        "Pythera",
-        "Quilia",
-        "Ragna",
-        "Reinobra",
-        "Relania",
-        "Relembra",
-        "Rowana",
-        "Rubera",
-        "Samera",
-        "Saphira",
-        "Seanera",
-        "Selena",
-        "Serenebra",
-        "Shanera",
-        "Shivera",
-        "Silvera",
-        "Solera",
-        "Suna",
-        "Tavara",
-        "Tembra",
-        "Tenebra",
-        "Thera",
-        "Thoria",
-        "Titania",
-        "Torpera",
-        "Tortura",
-        "Trimera",
-        "Trona",
-        "Umera",
-        "Unica",
-        "Unisera",
-        "Unitera",
-        "Valoria",
-        "Veludera",
-        "Verlana",
-        "Versa",
-        "Vinera",
-        "Visabra",
-        "Vita",
-        "Wizera",
-        "Xandebra",
-        "Xantera",
-        "Xerena",
-        "Xylana",
-        "Xylona",
-        "Yanara",
-        "Ysolera",
-        "Zanera",
-        "Zeluna",
-        "Zenobra",
-    ]
 
 
+    worlds = {world.lower(): world for world in WORLDS}
+    world_order = {world: i for i, world in enumerate(WORLDS)}
+    world_pattern = _world_pattern()
+
     points = dict()
     for string in _utils.get_all_strings(frames, 4, False, True):
         string_lower = string.lower()
-        for world in WORLDS:
-            world_lower = world.lower()
-            if world_lower in string_lower:
 
-                # This results in many false positives...
-                if world_lower == 'vita' and ('exura vita' in string_lower or 'utamo vita' in string_lower or 'adori vita vis' in string_lower):
-                    continue
+        # Find all worlds in the string in one pass, and whether they are preceded by "of", "in" or "de"
+        found = dict()
+        for match in world_pattern.finditer(string_lower):
+            world = worlds[match['world']]
+            found[world] = found.get(world, False) or match['prefix'] is not None
 
-                if world not in points:
-                    points[world] = 0
-                points[world] += 1
+        # Within a string the worlds are counted in the order of WORLDS, as before the regex was used,
+        # since that decides which world wins a tie
+        for world, has_prefix in sorted(found.items(), key=lambda item: world_order[item[0]]):
 
-                if ('of ' + world_lower) in string_lower or ('in ' + world_lower) in string_lower or ('de ' + world_lower) in string_lower:
-                    points[world] += 10
+            # This results in many false positives...
+            if world == 'Vita' and ('exura vita' in string_lower or 'utamo vita' in string_lower or 'adori vita vis' in string_lower):
+                continue
 
-    return max(points, key=points.get) if len(points) > 0 else None
\ No newline at end of file
+            if world not in points:
+                points[world] = 0
+            points[world] += 1
+
+            if has_prefix:
+                points[world] += 10
+
+    return max(points, key=points.get) if len(points) > 0 else None
+
+
+def hash_file(filename):
+    """Returns the SHA-1 of the content of a file, as a hex string.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,32 @@
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording
+
+
+# Number of Tibia packets in each recording of the test corpus
+NUM_PACKETS = 2000
+
+
+def frames(frames):
+    """Returns frames as (time, data) tuples, for comparing them."""
+    return [(frame.time, bytes(frame.data)) for frame in frames]
+
+
+@pytest.fixture(scope='session')
+def corpus_paths(tmp_path_factory):
+    """The benchmark corpus: the same recording in each supported format."""
+    return corpus.generate(str(tmp_path_factory.mktemp('corpus')), NUM_PACKETS)
+
+
+@pytest.fixture(scope='session')
+def reference(corpus_paths):
+    """The recording as (time, data) tuples, from the .trp file, which stores the packets as they are."""
+    rec = recording.load(corpus_paths['trp.trp'])
+    return rec.length, frames(rec.frames)
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    # Tests that use the cache set cache_dir themselves
+    monkeypatch.delenv('OLDSCHOOLTIBIA_CACHE_DIR', raising=False)
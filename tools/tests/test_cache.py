@@ -0,0 +1,181 @@
+import os
+
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording, _cache
+
+from tests.conftest import frames
+
+
+# All formats except .trp, which is never cached
+CACHED_FILES = [name for name in corpus.FILES if not name.endswith('.trp')]
+
+
+def cache_files(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.ostc')]
+
+
+def load_stages(filename, cache_dir, **kwargs):
+    # Returns the frames and the stages that loading them went through
+    stats = recording.LoadStats()
+    rec = recording.load(filename, cache_dir=cache_dir, stats=stats, **kwargs)
+    return frames(rec.frames), set(stats.stages)
+
+
+def iter_stages(filename, cache_dir):
+    stats = recording.LoadStats()
+    iter_frames = frames(recording.iter_frames(filename, cache_dir=cache_dir, stats=stats))
+    return iter_frames, set(stats.stages)
+
+
+def assert_from_cache(filename, cache_dir, reference_frames):
+    # Only the cache file is read, the recording is not decoded
+    loaded_frames, stages = load_stages(filename, cache_dir)
+    assert loaded_frames == reference_frames
+    assert stages <= {'read', 'guess_version'}
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+@pytest.mark.parametrize('name', CACHED_FILES)
+def test_load(corpus_paths, reference, cache_dir, name):
+    _, reference_frames = reference
+
+    loaded_frames, stages = load_stages(corpus_paths[name], cache_dir)
+    assert loaded_frames == reference_frames
+    assert 'store_cache' in stages
+    assert len(cache_files(cache_dir)) == 1
+
+    assert_from_cache(corpus_paths[name], cache_dir, reference_frames)
+
+    iter_frames, stages = iter_stages(corpus_paths[name], cache_dir)
+    assert iter_frames == reference_frames
+    assert stages <= {'read', 'guess_version'}
+
+    assert recording.load(corpus_paths[name], cache_dir=cache_dir).version == recording.load(corpus_paths[name]).version
+
+
+@pytest.mark.parametrize('name', CACHED_FILES)
+def test_iter_frames(corpus_paths, reference, cache_dir, name):
+    _, reference_frames = reference
+
+    # Nothing is stored until all frames have been read
+    frames_iter = recording.iter_frames(corpus_paths[name], cache_dir=cache_dir)
+    next(frames_iter)
+    frames_iter.close()
+    assert cache_files(cache_dir) == []
+
+    assert iter_stages(corpus_paths[name], cache_dir)[0] == reference_frames
+    assert len(cache_files(cache_dir)) == 1
+    assert_from_cache(corpus_paths[name], cache_dir, reference_frames)
+
+
+def test_trp_not_cached(corpus_paths, reference, cache_dir):
+    _, reference_frames = reference
+
+    assert frames(recording.load(corpus_paths['trp.trp'], cache_dir=cache_dir).frames) == reference_frames
+    assert frames(recording.iter_frames(corpus_paths['trp.trp'], cache_dir=cache_dir)) == reference_frames
+    assert cache_files(cache_dir) == []
+
+
+def test_limits_not_cached(corpus_paths, reference, cache_dir):
+    length, reference_frames = reference
+
+    recording.load(corpus_paths['rec517.rec'], cache_dir=cache_dir, max_frames=10)
+    recording.load(corpus_paths['rec517.rec'], cache_dir=cache_dir, start_ms=length // 2)
+    assert cache_files(cache_dir) == []
+
+    # But they are read from the cache
+    recording.load(corpus_paths['rec517.rec'], cache_dir=cache_dir)
+    loaded_frames, stages = load_stages(corpus_paths['rec517.rec'], cache_dir, start_ms=length // 2, max_frames=10)
+    assert loaded_frames == [frame for frame in reference_frames if frame[0] >= length // 2][:10]
+    assert 'store_cache' not in stages
+
+
+def test_eviction(corpus_paths, cache_dir, monkeypatch):
+    monkeypatch.setenv('OLDSCHOOLTIBIA_CACHE_SIZE', '0')
+
+    recording.load(corpus_paths['rec517.rec'], cache_dir=cache_dir)
+
+    assert cache_files(cache_dir) == []
+
+
+def scan_counter(cache_dir, monkeypatch):
+    # Returns a list that gets cache_dir each time the cache directory is scanned
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        if path == cache_dir:
+            scans.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    return scans
+
+
+def test_eviction_scans(corpus_paths, cache_dir, monkeypatch):
+    # The cache directory is scanned once, and then only when it may be larger than its maximum size
+    scans = scan_counter(cache_dir, monkeypatch)
+    for name in CACHED_FILES:
+        recording.load(corpus_paths[name], cache_dir=cache_dir)
+
+    assert len(cache_files(cache_dir)) == len(CACHED_FILES)
+    assert len(scans) == 1
+
+
+def test_eviction_size(corpus_paths, cache_dir, monkeypatch):
+    # Room for about two recordings
+    size = os.path.getsize(corpus_paths['trp.trp'])
+    cache = _cache.Cache(cache_dir, 2 * size + size // 2)
+    monkeypatch.setattr(_cache, 'get_cache', lambda cache_dir=None: cache)
+    scans = scan_counter(cache_dir, monkeypatch)
+
+    for name in CACHED_FILES:
+        recording.load(corpus_paths[name], cache_dir=cache_dir)
+
+    assert len(cache_files(cache_dir)) == 2
+    assert sum(os.path.getsize(filename) for filename in cache_files(cache_dir)) <= cache.max_size
+    assert len(scans) < len(CACHED_FILES)
+
+
+def test_cache_dir_env(corpus_paths, cache_dir, monkeypatch):
+    monkeypatch.setenv('OLDSCHOOLTIBIA_CACHE_DIR', cache_dir)
+
+    recording.load(corpus_paths['rec517.rec'])
+
+    assert len(cache_files(cache_dir)) == 1
+
+
+def break_magic(filename):
+    with open(filename, 'r+b') as f:
+        f.write(b'XXXX')
+
+
+def truncate(filename):
+    os.truncate(filename, os.path.getsize(filename) // 2)
+
+
+@pytest.mark.parametrize('name', CACHED_FILES)
+@pytest.mark.parametrize('break_cache_file', (break_magic, truncate, os.remove))
+@pytest.mark.parametrize('load', (load_stages, iter_stages))
+def test_broken_cache_file(corpus_paths, reference, cache_dir, name, break_cache_file, load):
+    # The source file is decoded instead, with all frames and no frame twice
+    _, reference_frames = reference
+    recording.load(corpus_paths[name], cache_dir=cache_dir)
+    cache_filename, = cache_files(cache_dir)
+    break_cache_file(cache_filename)
+
+    assert load(corpus_paths[name], cache_dir)[0] == reference_frames
+
+    # The broken cache file is removed, and the recording cached again if all of it was decoded
+    if os.path.isfile(cache_filename):
+        assert_from_cache(corpus_paths[name], cache_dir, reference_frames)
+    assert load(corpus_paths[name], cache_dir)[0] == reference_frames
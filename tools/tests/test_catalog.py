@@ -0,0 +1,135 @@
+import argparse
+import os
+import shutil
+
+import pytest
+
+import catalog
+
+
+@pytest.fixture
+def sources(corpus_paths, tmp_path):
+    directory = tmp_path / 'sources'
+    (directory / 'nested').mkdir(parents=True)
+    for name, path in corpus_paths.items():
+        shutil.copy(path, directory / 'nested' if name.endswith('.rec') else directory)
+    return str(directory)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = catalog.open_catalog(str(tmp_path / 'catalog.db'))
+    yield db
+    db.close()
+
+
+def scan(db, paths, capsys):
+    # Returns the number of files found, to scan and removed
+    catalog.scan(db, paths, 1)
+    output = capsys.readouterr().out
+    return tuple(int(line.split(': ')[1]) for line in output.splitlines()
+                 if line.startswith(('Number of files found', 'Number of files to scan', 'Number of files removed')))
+
+
+def query(db, capsys, **conditions):
+    # Returns the names of the files matching conditions
+    args = argparse.Namespace(version=None, world=None, format=None, min_length=None, max_length=None,
+                              duplicates=False, errors=False, long=False, null=False)
+    for name, value in conditions.items():
+        setattr(args, name, value)
+
+    catalog.query(db, args)
+    return sorted(os.path.basename(path) for path in capsys.readouterr().out.splitlines())
+
+
+def row(db, filename):
+    cursor = db.execute('SELECT * FROM recordings WHERE path = ?', (os.path.abspath(filename), ))
+    return dict(zip(catalog.COLUMNS, cursor.fetchone()))
+
+
+def test_scan(corpus_paths, reference, sources, db, capsys):
+    length, reference_frames = reference
+
+    assert scan(db, [sources], capsys) == (len(corpus_paths), len(corpus_paths), 0)
+
+    for name in corpus_paths:
+        scanned = row(db, os.path.join(sources, 'nested' if name.endswith('.rec') else '', name))
+        assert scanned['error'] is None
+        assert scanned['format'] == os.path.splitext(name)[1]
+        assert (scanned['world'], scanned['length'], scanned['num_frames']) == ('Antica', length, len(reference_frames))
+        assert scanned['version'] is not None
+
+
+def test_rescan(corpus_paths, sources, db, capsys):
+    num_files = len(corpus_paths)
+    scan(db, [sources], capsys)
+
+    # Unchanged files are skipped
+    assert scan(db, [sources], capsys) == (num_files, 0, 0)
+
+    # Changed files are scanned again
+    filename = os.path.join(sources, 'trp.trp')
+    num_frames = row(db, filename)['num_frames']
+    os.truncate(filename, os.path.getsize(filename) // 2)
+    assert scan(db, [sources], capsys) == (num_files, 1, 0)
+    assert 0 < row(db, filename)['num_frames'] < num_frames
+    assert row(db, filename)['size'] == os.path.getsize(filename)
+
+
+def test_removed(corpus_paths, sources, db, tmp_path, capsys):
+    # Files that no longer exist are removed, but only under the scanned directories
+    other = str(tmp_path / 'other.trp')
+    shutil.copy(corpus_paths['trp.trp'], other)
+    scan(db, [sources, other], capsys)
+
+    os.remove(os.path.join(sources, 'nested', 'rec517.rec'))
+    os.remove(other)
+    assert scan(db, [sources], capsys) == (len(corpus_paths) - 1, 0, 1)
+
+    assert 'rec517.rec' not in query(db, capsys)
+    assert 'other.trp' in query(db, capsys)
+
+
+def test_errors(sources, db, capsys):
+    with open(os.path.join(sources, 'broken.rec'), 'wb') as f:
+        f.write(b'\xff' * 1024)
+
+    scan(db, [sources], capsys)
+
+    broken = row(db, os.path.join(sources, 'broken.rec'))
+    assert broken['error']
+    assert broken['hash']
+    assert query(db, capsys, errors=True) == ['broken.rec']
+    assert 'broken.rec' not in query(db, capsys)
+
+    # Files with errors are not scanned again until they change
+    assert scan(db, [sources], capsys)[1] == 0
+
+
+def test_query(corpus_paths, reference, sources, db, capsys):
+    length, _ = reference
+    scan(db, [sources], capsys)
+    all_files = sorted(corpus_paths)
+
+    assert query(db, capsys) == all_files
+    assert query(db, capsys, world='aNTICA') == all_files
+    assert query(db, capsys, world='Nova') == []
+    assert query(db, capsys, version=row(db, os.path.join(sources, 'trp.trp'))['version']) == sorted(name for name in all_files if name != 'cam.cam')
+
+    assert query(db, capsys, format='rec') == sorted(name for name in all_files if name.endswith('.rec'))
+    assert query(db, capsys, format='.cam') == ['cam.cam']
+
+    # Lengths are given in seconds, and stored in milliseconds
+    assert query(db, capsys, min_length=length // 1000) == all_files
+    assert query(db, capsys, min_length=length // 1000 + 1) == []
+    assert query(db, capsys, max_length=length // 1000 + 1) == all_files
+    assert query(db, capsys, max_length=length // 1000) == []
+
+
+def test_query_duplicates(corpus_paths, sources, db, capsys):
+    shutil.copy(corpus_paths['cam.cam'], os.path.join(sources, 'copy.cam'))
+    scan(db, [sources], capsys)
+
+    assert query(db, capsys, duplicates=True) == ['cam.cam', 'copy.cam']
+    assert query(db, capsys, duplicates=True, format='rec') == []
+
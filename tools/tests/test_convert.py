@@ -0,0 +1,317 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip("convert.py needs Python 3.12", allow_module_level=True)
+
+import convert
+
+
+CONVERT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'convert.py')
+
+
+def run_convert(*args):
+    result = subprocess.run([sys.executable, CONVERT, *args], capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def count(output, message):
+    # Returns the number from a "Number of files ...: N" line of the output
+    line, = (line for line in output.splitlines() if line.startswith(f'Number of files {message}: '))
+    return int(line.split(': ')[1])
+
+
+def output_files(output_dir):
+    return {name: os.path.getmtime(os.path.join(output_dir, name)) for name in sorted(os.listdir(output_dir))}
+
+
+@pytest.fixture
+def sources(corpus_paths, tmp_path):
+    directory = tmp_path / 'sources'
+    directory.mkdir()
+    for path in corpus_paths.values():
+        shutil.copy(path, directory)
+    return str(directory)
+
+
+def test_manifest(sources, tmp_path):
+    output_dir = str(tmp_path / 'output')
+    manifest = str(tmp_path / 'manifest.db')
+
+    output = run_convert('-m', manifest, '-j', '2', output_dir, sources)
+    assert (count(output, 'converted'), count(output, 'failed')) == (len(os.listdir(sources)), 0)
+    outputs = output_files(output_dir)
+    assert len(outputs) == len(os.listdir(sources))
+
+    # Converted files are skipped
+    output = run_convert('-m', manifest, '-j', '2', output_dir, sources)
+    assert (count(output, 'skipped'), count(output, 'converted'), count(output, 'failed')) == (len(os.listdir(sources)), 0, 0)
+    assert output_files(output_dir) == outputs
+
+
+@pytest.mark.parametrize('rename', (False, True))
+def test_manifest_interrupted(sources, tmp_path, rename):
+    # A run that was interrupted after writing output files, but before recording them in the
+    # manifest, is resumed without failures or extra output files
+    output_dir = str(tmp_path / 'output')
+    manifest = str(tmp_path / 'manifest.db')
+    options = ('-r', ) if rename else ()
+
+    run_convert('-m', manifest, *options, output_dir, sources)
+    outputs = output_files(output_dir)
+    with sqlite3.connect(manifest) as db:
+        db.execute('DELETE FROM conversions')
+    db.close()
+
+    output = run_convert('-m', manifest, *options, output_dir, sources)
+    assert (count(output, 'converted'), count(output, 'failed')) == (len(os.listdir(sources)), 0)
+    assert output_files(output_dir) == outputs
+
+    output = run_convert('-m', manifest, *options, output_dir, sources)
+    assert count(output, 'skipped') == len(os.listdir(sources))
+
+
+def test_manifest_changed(sources, tmp_path):
+    # A changed file is converted again, and replaces its previous output
+    output_dir = str(tmp_path / 'output')
+    manifest = str(tmp_path / 'manifest.db')
+
+    run_convert('-m', manifest, output_dir, sources)
+    outputs = output_files(output_dir)
+    os.truncate(os.path.join(sources, 'trp.trp'), os.path.getsize(os.path.join(sources, 'trp.trp')) // 2)
+
+    output = run_convert('-m', manifest, output_dir, sources)
+    assert (count(output, 'skipped'), count(output, 'converted'), count(output, 'failed')) == (len(os.listdir(sources)) - 1, 1, 0)
+    assert output_files(output_dir).keys() == outputs.keys()
+    assert os.path.getsize(os.path.join(output_dir, 'trp.trp')) < os.path.getsize(os.path.join(sources, 'trp.trp'))
+
+
+@pytest.mark.parametrize('to_stdout', (False, True))
+def test_metrics(sources, tmp_path, to_stdout):
+    # With -M - only the metrics are written to stdout, the messages to stderr
+    output_dir = str(tmp_path / 'output')
+    metrics_filename = str(tmp_path / 'metrics.jsonl')
+    result = subprocess.run([sys.executable, CONVERT, '-M', '-' if to_stdout else metrics_filename, output_dir, sources],
+                            capture_output=True, text=True, check=True)
+
+    if to_stdout:
+        lines = result.stdout.splitlines()
+        assert count(result.stderr, 'converted') == len(os.listdir(sources))
+    else:
+        with open(metrics_filename) as f:
+            lines = f.read().splitlines()
+        assert count(result.stdout, 'converted') == len(os.listdir(sources))
+
+    metrics = [json.loads(line) for line in lines]
+    assert sorted(os.path.basename(line['filename']) for line in metrics if line['type'] == 'file') == sorted(os.listdir(sources))
+    assert all(line['output'] and line['output_bytes'] > 0 for line in metrics if line['type'] == 'file')
+    assert metrics[-1]['type'] == 'summary'
+    assert metrics[-1]['files'] == len(os.listdir(sources))
+    assert metrics[-1]['failures'] == {}
+
+
+def test_manifest_changed_failed(sources, tmp_path):
+    # A changed file that can not be converted keeps its previous output
+    output_dir = str(tmp_path / 'output')
+    manifest = str(tmp_path / 'manifest.db')
+
+    run_convert('-n', '-m', manifest, output_dir, sources)
+    outputs = output_files(output_dir)
+    os.truncate(os.path.join(sources, 'rec517.rec'), os.path.getsize(os.path.join(sources, 'rec517.rec')) // 2)
+
+    output = run_convert('-n', '-m', manifest, output_dir, sources)
+    assert (count(output, 'converted'), count(output, 'failed')) == (0, 1)
+    assert output_files(output_dir) == outputs
+
+
+def test_manifest_changed_subfolder(sources, tmp_path):
+    # A changed file that is converted to another version subfolder removes its previous output
+    output_dir = str(tmp_path / 'output')
+    manifest = str(tmp_path / 'manifest.db')
+
+    run_convert('-s', '-m', manifest, output_dir, sources)
+    assert os.path.isfile(os.path.join(output_dir, '7.40', 'trp.trp'))
+    os.truncate(os.path.join(sources, 'trp.trp'), os.path.getsize(os.path.join(sources, 'trp.trp')) // 2)
+
+    output = run_convert('-s', '-v', '760', '-o', '-m', manifest, output_dir, sources)
+    assert (count(output, 'converted'), count(output, 'failed')) == (1, 0)
+    assert not os.path.exists(os.path.join(output_dir, '7.40', 'trp.trp'))
+    assert os.listdir(os.path.join(output_dir, '7.60')) == ['trp.trp']
+
+    output = run_convert('-s', '-v', '760', '-o', '-m', manifest, output_dir, sources)
+    assert count(output, 'skipped') == len(os.listdir(sources))
+
+
+def test_load_error(sources, tmp_path):
+    # A source that fails after its first frames is reported as a load error, not a write error
+    output_dir = str(tmp_path / 'output')
+    metrics_filename = str(tmp_path / 'metrics.jsonl')
+    filename = os.path.join(sources, 'rec517.rec')
+    os.truncate(filename, os.path.getsize(filename) // 2)
+
+    output = run_convert('-n', '-M', metrics_filename, output_dir, filename)
+    assert count(output, 'failed') == 1
+    assert f"'{filename}': could not load file: " in output
+    assert 'could not write file' not in output
+    assert os.listdir(output_dir) == []
+
+    with open(metrics_filename) as f:
+        metrics = [json.loads(line) for line in f]
+    assert metrics[-1]['failures'] == {'EOFError': 1}
+
+
+def test_existing_output(sources, tmp_path):
+    # Without a manifest an existing output file is never replaced
+    output_dir = str(tmp_path / 'output')
+
+    run_convert(output_dir, sources)
+    outputs = output_files(output_dir)
+
+    output = run_convert(output_dir, sources)
+    assert (count(output, 'converted'), count(output, 'failed')) == (0, len(os.listdir(sources)))
+    assert output_files(output_dir) == outputs
+
+    output = run_convert('-r', output_dir, sources)
+    assert count(output, 'converted') == len(os.listdir(sources))
+    assert len(output_files(output_dir)) == 2 * len(outputs)
+
+
+@pytest.fixture
+def tree(corpus_paths, tmp_path):
+    root = tmp_path / 'tree'
+    (root / 'a' / 'b').mkdir(parents=True)
+    shutil.copy(corpus_paths['trp.trp'], root)
+    shutil.copy(corpus_paths['rec517.rec'], root / 'a')
+    shutil.copy(corpus_paths['cam.cam'], root / 'a' / 'b')
+    shutil.copy(corpus_paths['rec259.rec'], root / 'a' / 'b' / 'recording')
+    (root / 'readme.txt').write_text('This is not a Tibia recording.\n' * 100)
+    os.symlink(root / 'a', root / 'link')
+    return str(root)
+
+
+def walk(tree, paths, file_filter):
+    # Returns the files found in paths, relative to tree, and whether they are to be converted
+    return sorted((os.path.relpath(filename, tree), stat is not None) for filename, stat in convert.iter_files(paths, file_filter, 2))
+
+
+def test_iter_files(tree):
+    # Symbolic links to directories are not followed, nor returned as files
+    assert walk(tree, [tree], 'none') == [
+        ('a/b/cam.cam', True),
+        ('a/b/recording', True),
+        ('a/rec517.rec', True),
+        ('readme.txt', True),
+        ('trp.trp', True),
+    ]
+    assert walk(tree, [tree], 'extension') == [
+        ('a/b/cam.cam', True),
+        ('a/b/recording', False),
+        ('a/rec517.rec', True),
+        ('readme.txt', False),
+        ('trp.trp', True),
+    ]
+    assert walk(tree, [tree], 'sniff') == [
+        ('a/b/cam.cam', True),
+        ('a/b/recording', True),
+        ('a/rec517.rec', True),
+        ('readme.txt', False),
+        ('trp.trp', True),
+    ]
+
+
+def test_iter_files_explicit(tree):
+    # Files given explicitly are never ignored, and directories are scanned
+    paths = [os.path.join(tree, 'readme.txt'), os.path.join(tree, 'a', 'b'), os.path.join(tree, 'missing.rec')]
+    assert walk(tree, paths, 'sniff') == [
+        ('a/b/cam.cam', True),
+        ('a/b/recording', True),
+        ('readme.txt', True),
+    ]
+
+
+def test_iter_files_unreadable(tree, monkeypatch, capsys):
+    # The tests may run as root, who can read any directory
+    scandir = os.scandir
+
+    def unreadable_scandir(path):
+        if os.path.basename(path) == 'a':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', unreadable_scandir)
+
+    assert walk(tree, [tree], 'sniff') == [('readme.txt', False), ('trp.trp', True)]
+    assert 'could not read directory' in capsys.readouterr().out
+
+
+def test_iter_files_bounded(tmp_path, monkeypatch):
+    # Only a few directory scans are submitted ahead of the files that have been read
+    for i in range(100):
+        (tmp_path / str(i)).mkdir()
+        (tmp_path / str(i) / 'recording.trp').write_bytes(b'TRP\0')
+
+    scanned = []
+
+    class Executor(concurrent.futures.ThreadPoolExecutor):
+        def submit(self, function, *args):
+            scanned.append(args[0])
+            return super().submit(function, *args)
+
+    monkeypatch.setattr(concurrent.futures, 'ThreadPoolExecutor', Executor)
+
+    files = convert.iter_files([str(tmp_path)], 'extension', 2)
+    next(files)
+    assert len(scanned) <= 1 + 2 * convert.MAX_SCANS_PER_WALKER
+
+    assert len(list(files)) == 99
+    assert len(scanned) == 101
+
+
+def tasks(sizes):
+    # Tasks as convert.py makes them: (filename, source, size, mtime, previous)
+    return [(f'{i}.rec', f'/{i}.rec', size, 0, None) for i, size in enumerate(sizes)]
+
+
+def test_batched_small_input():
+    # A few small files are spread over all workers
+    small_tasks = tasks([1000] * 11)
+
+    batches = list(convert.batched(small_tasks, 2))
+
+    assert sum(batches, []) == small_tasks
+    assert len(batches) >= 2
+    assert len(batches[0]) <= 6
+
+
+def test_batched_limits():
+    many_tasks = tasks([1000] * 1000 + [convert.BATCH_MAX_SIZE] + [1000] * 10)
+
+    batches = list(convert.batched(many_tasks, 4))
+
+    assert sum(batches, []) == many_tasks
+    assert all(0 < len(batch) <= convert.BATCH_MAX_FILES for batch in batches)
+
+    # A large file gets a batch of its own
+    assert [many_tasks[1000]] in batches
+
+
+def test_batched_reads_ahead():
+    # Only the files for a full batch per worker are read before the first batch
+    num_read = 0
+
+    def iter_tasks():
+        nonlocal num_read
+        for task in tasks([1000] * 1000):
+            num_read += 1
+            yield task
+
+    next(convert.batched(iter_tasks(), 2))
+
+    assert num_read <= 2 * convert.BATCH_MAX_FILES + 1
@@ -0,0 +1,85 @@
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording
+
+from tests.conftest import frames
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+@pytest.mark.parametrize('compact', (False, True))
+@pytest.mark.parametrize('use_mmap', (False, True))
+def test_load(corpus_paths, reference, name, compact, use_mmap):
+    length, reference_frames = reference
+
+    rec = recording.load(corpus_paths[name], compact=compact, use_mmap=use_mmap)
+
+    assert rec.length == length
+    assert rec.version is not None
+    assert frames(rec.frames) == reference_frames
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_iter_frames(corpus_paths, reference, name):
+    length, reference_frames = reference
+
+    rec = recording.Recording()
+    assert frames(recording.iter_frames(corpus_paths[name], rec=rec)) == reference_frames
+    assert rec.length == length
+    assert rec.version == recording.load(corpus_paths[name]).version
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_iter_frames_close(corpus_paths, reference, name):
+    _, reference_frames = reference
+
+    frames_iter = recording.iter_frames(corpus_paths[name])
+    assert frames(next(frames_iter) for _ in range(20)) == reference_frames[:20]
+    frames_iter.close()
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_start_ms(corpus_paths, reference, name):
+    length, reference_frames = reference
+    start_ms = length // 3
+
+    expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+    assert frames(recording.load(corpus_paths[name], start_ms=start_ms).frames) == expected
+    assert frames(recording.iter_frames(corpus_paths[name], start_ms=start_ms)) == expected
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_limits(corpus_paths, reference, name):
+    _, reference_frames = reference
+
+    assert frames(recording.load(corpus_paths[name], max_frames=15).frames) == reference_frames[:15]
+
+    # Loading stops before the first frame that is max_ms or more after start_ms
+    max_ms = 10000
+    assert frames(recording.load(corpus_paths[name], max_ms=max_ms).frames) == [frame for frame in reference_frames if frame[0] < max_ms]
+
+    # Also when a frame is exactly max_ms after start_ms
+    start_ms = reference_frames[len(reference_frames) // 4][0]
+    max_ms = reference_frames[len(reference_frames) // 2][0] - start_ms
+    expected = [frame for frame in reference_frames if start_ms <= frame[0] < start_ms + max_ms]
+    assert any(frame[0] == start_ms + max_ms for frame in reference_frames)
+    assert frames(recording.load(corpus_paths[name], start_ms=start_ms, max_ms=max_ms).frames) == expected
+    assert frames(recording.load(corpus_paths[name], max_ms=start_ms).frames) == [frame for frame in reference_frames if frame[0] < start_ms]
+
+    rec = recording.load(corpus_paths[name], max_bytes=1000)
+    assert sum(len(frame.data) for frame in rec.frames) <= 1000
+    assert frames(rec.frames) == reference_frames[:len(rec.frames)]
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_probe(corpus_paths, reference, name):
+    length, reference_frames = reference
+
+    info = recording.probe(corpus_paths[name])
+
+    assert name.endswith(info.recording_format.extension)
+    assert info.version == recording.load(corpus_paths[name]).version
+    assert info.length in (None, length)
+    assert info.num_frames is None or info.num_frames > 0
+    if name.endswith(('.trp', '.trz')):
+        assert (info.length, info.num_frames) == (length, len(reference_frames))
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording
+
+from tests.conftest import frames
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+@pytest.mark.parametrize('extension', ('.trp', '.trz'))
+def test_transcode(corpus_paths, reference, tmp_path, name, extension):
+    # The version and length are set in rec while the frames are read
+    length, reference_frames = reference
+    filename = str(tmp_path / ('transcoded' + extension))
+
+    rec = recording.Recording()
+    recording.save_frames(rec, filename, recording.iter_frames(corpus_paths[name], rec=rec))
+
+    transcoded = recording.load(filename)
+    assert (transcoded.version, transcoded.length) == (recording.load(corpus_paths[name]).version, length)
+    assert frames(transcoded.frames) == reference_frames
+
+
+@pytest.mark.parametrize('extension', ('.trp', '.trz'))
+def test_index(corpus_paths, reference, tmp_path, extension):
+    length, reference_frames = reference
+    filename = str(tmp_path / ('transcoded' + extension))
+
+    rec = recording.Recording()
+    recording.save_frames(rec, filename, recording.iter_frames(corpus_paths['rec517.rec'], rec=rec), fsync=True, index=True)
+
+    expected = [frame for frame in reference_frames if frame[0] >= length // 2]
+    assert frames(recording.load(filename, start_ms=length // 2).frames) == expected
+
+
+@pytest.mark.parametrize('extension', ('.trp', '.trz'))
+def test_exception(corpus_paths, tmp_path, extension):
+    # Nothing is written if reading the frames fails
+    def failing_frames(rec):
+        for i, frame in enumerate(recording.iter_frames(corpus_paths['rec517.rec'], rec=rec)):
+            if i == 500:
+                raise EOFError("EOF")
+            yield frame
+
+    rec = recording.Recording()
+    with pytest.raises(EOFError):
+        recording.save_frames(rec, str(tmp_path / ('transcoded' + extension)), failing_frames(rec))
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_unsupported_format(corpus_paths, tmp_path):
+    rec = recording.Recording()
+
+    with pytest.raises(recording.InvalidFileError):
+        recording.save_frames(rec, str(tmp_path / 'transcoded.txt'), recording.iter_frames(corpus_paths['trp.trp'], rec=rec))
+
+    # Only .trp and .trz files can be written
+    with pytest.raises(NotImplementedError):
+        recording.save_frames(rec, str(tmp_path / 'transcoded.rec'), recording.iter_frames(corpus_paths['trp.trp'], rec=rec))
+
+    assert os.listdir(tmp_path) == []
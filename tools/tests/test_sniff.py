@@ -0,0 +1,72 @@
+import shutil
+
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording
+
+from tests.conftest import frames
+
+
+def wrong_extension(name):
+    # An extension of another format, one that the file can not be loaded as
+    return '.trp' if not name.endswith('.trp') else '.rec'
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_wrong_extension(corpus_paths, reference, tmp_path, name):
+    _, reference_frames = reference
+    filename = str(tmp_path / ('recording' + wrong_extension(name)))
+    shutil.copyfile(corpus_paths[name], filename)
+
+    assert frames(recording.load(filename).frames) == reference_frames
+    assert frames(recording.iter_frames(filename)) == reference_frames
+    assert name.endswith(recording.probe(filename).recording_format.extension)
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_no_extension(corpus_paths, reference, tmp_path, name):
+    _, reference_frames = reference
+    filename = str(tmp_path / 'recording')
+    shutil.copyfile(corpus_paths[name], filename)
+
+    assert not recording.is_recording(filename, sniff=False)
+    assert recording.is_recording(filename)
+    assert frames(recording.load(filename).frames) == reference_frames
+    assert name.endswith(recording.probe(filename).recording_format.extension)
+
+
+@pytest.mark.parametrize('name', corpus.FILES)
+def test_content_format_first(corpus_paths, tmp_path, name, capsys):
+    # The format that the content looks like is tried before the one of the file extension,
+    # so there is no warning about a failure with the wrong format
+    filename = str(tmp_path / ('recording' + wrong_extension(name)))
+    shutil.copyfile(corpus_paths[name], filename)
+
+    recording.load(filename)
+
+    assert capsys.readouterr().out.count('warning') == 1
+
+
+def test_not_a_recording(tmp_path):
+    filename = str(tmp_path / 'readme.txt')
+    with open(filename, 'wb') as f:
+        f.write(b'This is not a Tibia recording.\n' * 100)
+
+    assert not recording.is_recording(filename)
+    with pytest.raises(recording.InvalidFileError):
+        recording.load(filename)
+    with pytest.raises(recording.InvalidFileError):
+        recording.probe(filename)
+
+
+# Not .ttm, which has no magic or checksums, so that almost any data is a valid .ttm file
+@pytest.mark.parametrize('extension', ('.rec', '.cam', '.tmv', '.trp', '.trz'))
+def test_invalid_file(tmp_path, extension):
+    filename = str(tmp_path / ('invalid' + extension))
+    with open(filename, 'wb') as f:
+        f.write(b'\xff' * 1024)
+
+    assert recording.is_recording(filename)
+    with pytest.raises(Exception):
+        recording.load(filename, allow_partial=False)
@@ -0,0 +1,124 @@
+import filecmp
+import os
+import shutil
+import struct
+
+import pytest
+
+from oldschooltibia import recording
+from oldschooltibia._trp import RecordingFormatTrp
+
+from tests.conftest import frames
+
+
+def test_save(corpus_paths, tmp_path):
+    # The corpus .trp file is written by the benchmark's own encoder
+    filename = str(tmp_path / 'saved.trp')
+    recording.save(recording.load(corpus_paths['trp.trp']), filename, fsync=True)
+
+    assert filecmp.cmp(filename, corpus_paths['trp.trp'], shallow=False)
+    assert not os.path.exists(RecordingFormatTrp.index_filename(filename))
+
+
+def test_save_existing(corpus_paths, tmp_path):
+    filename = str(tmp_path / 'saved.trp')
+    with open(filename, 'wb') as f:
+        f.write(b'existing')
+
+    with pytest.raises(IOError):
+        recording.save(recording.load(corpus_paths['trp.trp']), filename)
+
+    with open(filename, 'rb') as f:
+        assert f.read() == b'existing'
+
+
+def test_save_no_version(corpus_paths, tmp_path):
+    rec = recording.load(corpus_paths['trp.trp'])
+    rec.version = None
+
+    with pytest.raises(Exception):
+        recording.save(rec, str(tmp_path / 'saved.trp'))
+
+    # Not even a temporary file is left
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.fixture
+def indexed_trp(corpus_paths, tmp_path):
+    filename = str(tmp_path / 'indexed.trp')
+    recording.save(recording.load(corpus_paths['trp.trp']), filename, index=True)
+    return filename
+
+
+def test_index(corpus_paths, reference, indexed_trp, tmp_path):
+    length, reference_frames = reference
+
+    assert filecmp.cmp(indexed_trp, corpus_paths['trp.trp'], shallow=False)
+
+    # save_index() writes the same index for an existing file
+    filename = str(tmp_path / 'copy.trp')
+    shutil.copyfile(corpus_paths['trp.trp'], filename)
+    RecordingFormatTrp.save_index(filename)
+    num_frames = len(reference_frames)
+    assert RecordingFormatTrp._read_index(filename, num_frames) == RecordingFormatTrp._read_index(indexed_trp, num_frames)
+    assert len(RecordingFormatTrp._read_index(filename, num_frames)) > 10
+
+    for start_ms in (1, 9999, 10000, length // 2, length, length + 1):
+        expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+        assert frames(recording.load(indexed_trp, start_ms=start_ms).frames) == expected
+        assert frames(recording.iter_frames(indexed_trp, start_ms=start_ms)) == expected
+
+
+def test_index_seeks(reference, indexed_trp):
+    # Break the first frame, which is not read when the index is used to start later
+    # The modification time is kept, so that the index is still used
+    length, reference_frames = reference
+    stat = os.stat(indexed_trp)
+    with open(indexed_trp, 'r+b') as f:
+        f.seek(4 + struct.calcsize('<HII'))
+        f.write(struct.pack('<I', 0xFFFFFFFF))
+    os.utime(indexed_trp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    with pytest.raises(recording.InvalidFileError):
+        recording.load(indexed_trp, allow_partial=False)
+
+    start_ms = length // 2
+    expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+    assert frames(recording.load(indexed_trp, allow_partial=False, start_ms=start_ms).frames) == expected
+
+
+def test_stale_index(corpus_paths, reference, indexed_trp, tmp_path):
+    # An index that does not belong to the file is not used
+    length, reference_frames = reference
+    rec = recording.load(corpus_paths['trp.trp'])
+    rec.frames = rec.frames[1:]
+    filename = str(tmp_path / 'stale.trp')
+    recording.save(rec, filename)
+    shutil.copyfile(RecordingFormatTrp.index_filename(indexed_trp), RecordingFormatTrp.index_filename(filename))
+
+    start_ms = length // 4
+    expected = [frame for frame in reference_frames[1:] if frame[0] >= start_ms]
+    assert frames(recording.load(filename, start_ms=start_ms).frames) == expected
+
+    # Nor is a truncated one
+    index_filename = RecordingFormatTrp.index_filename(indexed_trp)
+    os.truncate(index_filename, os.path.getsize(index_filename) - 1)
+    expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+    assert frames(recording.load(indexed_trp, start_ms=start_ms).frames) == expected
+
+
+def test_changed_index(reference, indexed_trp, tmp_path):
+    # A .trp file that is replaced with one of the same size and number of frames, but other
+    # frame times, does not use the index of the old file
+    length, reference_frames = reference
+    rec = recording.load(indexed_trp)
+    for frame in rec.frames:
+        frame.time *= 2
+    rec.length *= 2
+    filename = str(tmp_path / 'changed.trp')
+    recording.save(rec, filename)
+    os.replace(filename, indexed_trp)
+
+    start_ms = length
+    expected = [(frame[0] * 2, frame[1]) for frame in reference_frames if frame[0] * 2 >= start_ms]
+    assert frames(recording.load(indexed_trp, start_ms=start_ms).frames) == expected
@@ -0,0 +1,90 @@
+import os
+import struct
+
+import pytest
+
+from benchmarks import corpus
+from oldschooltibia import recording, _trz
+from oldschooltibia._trz import RecordingFormatTrz
+
+from tests.conftest import frames
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Many chunks even for the small test recordings
+    monkeypatch.setattr(_trz, '_CHUNK_SIZE', 4096)
+
+
+@pytest.fixture(params=('zlib', 'lzma'))
+def trz(request, corpus_paths, tmp_path, small_chunks):
+    filename = str(tmp_path / 'saved.trz')
+    rec = recording.load(corpus_paths['trp.trp'])
+    RecordingFormatTrz.save_frames(rec, filename, rec.frames, compression=request.param)
+    return filename
+
+
+def num_chunks(filename):
+    with open(filename, 'rb') as f:
+        f.seek(-struct.calcsize('<HIIIQ4s'), os.SEEK_END)
+        return struct.unpack('<HIIIQ4s', f.read())[3]
+
+
+def test_save(reference, trz):
+    length, reference_frames = reference
+
+    assert num_chunks(trz) > 10
+
+    rec = recording.load(trz)
+    assert (rec.version, rec.length) == (corpus.VERSION, length)
+    assert frames(rec.frames) == reference_frames
+
+    info = recording.probe(trz)
+    assert (info.length, info.num_frames) == (length, len(reference_frames))
+
+
+def test_start_ms(reference, trz):
+    length, reference_frames = reference
+
+    for start_ms in (1, 1000, length // 3, length - 1, length, length + 1):
+        expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+        assert frames(recording.load(trz, start_ms=start_ms).frames) == expected
+        assert frames(recording.iter_frames(trz, start_ms=start_ms)) == expected
+
+
+def test_start_ms_seeks(reference, trz):
+    # Break the first chunk, which is not read when the chunk index is used to start later
+    length, reference_frames = reference
+    with open(trz, 'r+b') as f:
+        f.seek(4 + struct.calcsize('<HB') + struct.calcsize('<III'))
+        f.write(b'\xff' * 16)
+
+    with pytest.raises(recording.InvalidFileError):
+        recording.load(trz, allow_partial=False)
+
+    start_ms = length // 2
+    expected = [frame for frame in reference_frames if frame[0] >= start_ms]
+    assert frames(recording.load(trz, allow_partial=False, start_ms=start_ms).frames) == expected
+
+
+def test_truncated(reference, trz):
+    # Without the footer the chunks are read until the end of the file
+    _, reference_frames = reference
+    os.truncate(trz, os.path.getsize(trz) // 2)
+
+    rec = recording.load(trz)
+    assert 0 < len(rec.frames) < len(reference_frames)
+    assert frames(rec.frames) == reference_frames[:len(rec.frames)]
+
+    with pytest.raises(Exception):
+        recording.load(trz, allow_partial=False)
+
+
+def test_invalid_compression(corpus_paths, tmp_path):
+    rec = recording.load(corpus_paths['trp.trp'])
+    filename = str(tmp_path / 'saved.trz')
+
+    with pytest.raises(ValueError):
+        RecordingFormatTrz.save_frames(rec, filename, rec.frames, compression='bzip2')
+
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,198 @@
+import datetime
+import random
+import struct
+
+import pytest
+
+from oldschooltibia import recording, utils, _utils
+
+
+def string_frame(*strings):
+    # A frame with each string as the Tibia protocol sends it: a 2 byte length and the string
+    frame = recording.Frame()
+    frame.time = 0
+    frame.data = b''.join(struct.pack('<H', len(string)) + string.encode('latin-1') for string in strings)
+    return frame
+
+
+@pytest.mark.parametrize('strings, world', (
+    (['Welcome to Nova!'], 'Nova'),
+    (['nova.'], 'Nova'),
+    (['NOVA'], 'Nova'),
+    (['Nova, Nova'], 'Nova'),
+    (['Jenova is here'], None),
+    (['Welcome to Novaria'], None),
+    (['Novas'], None),
+    (['Nova2'], 'Nova'),
+    (['exura vita'], None),
+    (['Welcome to Vita'], 'Vita'),
+))
+def test_guess_world(strings, world):
+    assert utils.guess_world([string_frame(*strings)]) == world
+
+
+def test_guess_world_prefix():
+    # A world after "of", "in" or "de" counts ten times more
+    assert utils.guess_world([string_frame('Antica', 'Antica', 'Antica', 'the depot in Nova')]) == 'Nova'
+    assert utils.guess_world([string_frame('Antica', 'Antica', 'Antica', 'the depot Nova')]) == 'Antica'
+
+
+def test_guess_world_tie():
+    # On a tie the world that was found first wins, and in the same string the one first in WORLDS
+    assert utils.WORLDS.index('Antica') < utils.WORLDS.index('Nova')
+    assert utils.guess_world([string_frame('Nova is here', 'Antica is here')]) == 'Nova'
+    assert utils.guess_world([string_frame('Antica is here', 'Nova is here')]) == 'Antica'
+    assert utils.guess_world([string_frame('Nova and Antica')]) == 'Antica'
+    assert utils.guess_world([string_frame('Antica and Nova')]) == 'Antica'
+
+
+def test_guess_world_none():
+    assert utils.guess_world([]) is None
+    assert utils.guess_world([string_frame('no world here')]) is None
+
+
+def walk_strings(frames, min_len):
+    # The byte by byte search that get_all_strings() used before, to compare with
+    strings = []
+    for frame in frames:
+        data = bytes(frame.data)
+        offset = 0
+        while offset < len(data) - 2:
+            string_length = (data[offset + 1] << 8) | data[offset]
+            if string_length >= min_len and string_length < 1024 and (offset + 2 + string_length - 1 < len(data)):
+                string_raw = data[offset + 2:offset + 2 + string_length]
+                if all(32 <= c <= 126 or 160 <= c <= 255 for c in string_raw):
+                    strings.append(string_raw.decode('latin-1'))
+                    offset += 2 + string_length - 1
+
+            offset += 1
+
+    return strings
+
+
+def test_get_all_strings():
+    frame = recording.Frame()
+    frame.data = (b'\x65\x00' +
+                  struct.pack('<H', 5) + b'hello' +               # a string
+                  struct.pack('<H', 3) + b'abc' +                 # too short
+                  struct.pack('<H', 6) + b'caf\xe9 !' +           # Latin-1
+                  struct.pack('<H', 6) + b'ab\x01cde' +           # not printable
+                  b'\xff' +
+                  struct.pack('<H', 4) + b'\xa0\xff\x7e ' +       # first and last printable characters
+                  struct.pack('<H', 2000) + b'x' * 2000 +         # too long
+                  struct.pack('<H', 10) + b'past end')            # runs past the end of the frame
+
+    expected = ['hello', 'caf\xe9 !', '\xa0\xff~ ']
+    assert list(_utils.get_all_strings([frame], 4, False, False)) == expected
+    assert walk_strings([frame], 4) == expected
+
+    # The data may be a memoryview, e.g. with use_mmap
+    frame.data = memoryview(frame.data)
+    assert list(_utils.get_all_strings([frame], 4, False, False)) == expected
+
+
+def test_get_all_strings_options():
+    frame = string_frame('You lose 12 hitpoints.', 'You lose 5 mana.', 'Using one of 3 mana fluids...', 'zzz', 'You lose 12 hitpoints.')
+
+    assert list(_utils.get_all_strings([frame], 4, False, True)) == \
+        ['You lose X hitpoints.', 'You lose X mana.', 'Using one of X Y...', 'You lose X hitpoints.']
+    assert list(_utils.get_all_strings([frame], 4, True, False)) == \
+        ['Using one of 3 mana fluids...', 'You lose 12 hitpoints.', 'You lose 5 mana.']
+
+    # Empty strings are never returned
+    assert list(_utils.get_all_strings([string_frame('', 'a')], 0, False, False)) == ['a']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_get_all_strings_random(seed):
+    # Strings, strings with the wrong length, and other bytes, which may or may not be printable
+    rnd = random.Random(seed)
+    frames = []
+    for _ in range(20):
+        data = bytearray()
+        for _ in range(rnd.randrange(1, 50)):
+            kind = rnd.randrange(4)
+            if kind < 2:
+                string = bytes(rnd.choice((rnd.randrange(32, 127), rnd.randrange(160, 256))) for _ in range(rnd.randrange(20)))
+                data += struct.pack('<H', max(len(string) + (rnd.randrange(-2, 3) if kind == 1 else 0), 0)) + string
+            elif kind == 2:
+                data.append(rnd.randrange(256))
+            else:
+                data += bytes([rnd.randrange(256)]) * rnd.randrange(1, 10)
+
+        frame = recording.Frame()
+        frame.data = bytes(data)
+        frames.append(frame)
+
+    for min_len in (1, 2, 4, 10):
+        assert list(_utils.get_all_strings(frames, min_len, False, False)) == walk_strings(frames, min_len)
+
+
+def test_get_all_strings_corpus(corpus_paths):
+    frames = recording.load(corpus_paths['trp.trp']).frames
+    assert list(_utils.get_all_strings(frames, 4, False, False)) == walk_strings(frames, 4)
+
+
+def login_frame(*texts, message_type=0x14):
+    # A frame with a text message for each text, like the login messages
+    frame = recording.Frame()
+    frame.time = 0
+    frame.data = b'\x0a' + bytes(10) + b''.join(bytes([0xb4, message_type]) + struct.pack('<H', len(text)) + text.encode('ascii') for text in texts)
+    return frame
+
+
+def last_visit(day):
+    return f'Your last visit in Tibia: {day.day}. {day.strftime("%b")} {day.year} 18:12:22 CET.'
+
+
+@pytest.mark.parametrize('day, version', (
+    (datetime.date(2005, 3, 12), 740),
+    (datetime.date(2000, 1, 1), 700),
+    (datetime.date(2002, 8, 28), 700),
+    (datetime.date(2002, 10, 21), 700),
+    (datetime.date(2002, 10, 22), 701),
+    (datetime.date(2004, 12, 13), 735),
+    (datetime.date(2004, 12, 14), 740),
+    (datetime.date(2009, 9, 30), 850),
+    (datetime.date(2009, 10, 1), 852),
+    # The dates of 8.72 - 8.74 are not in order
+    (datetime.date(2011, 4, 3), 871),
+    (datetime.date(2011, 4, 19), 871),
+    (datetime.date(2011, 4, 20), 874),
+    (datetime.date(2011, 6, 8), 874),
+    (datetime.date(2011, 6, 9), None),
+))
+def test_guess_world_from_frame(day, version):
+    assert _utils.guess_world_from_frame(login_frame(last_visit(day))) == version
+
+
+def test_guess_world_from_frame_dates():
+    # Compare every date with the search through the updates that was used before
+    def previous_version(day):
+        for i in range(1, len(_utils._UPDATES)):
+            if _utils._UPDATES[i][0] > day:
+                return _utils._UPDATES[i - 1][1]
+        return None
+
+    day = datetime.date(2002, 1, 1)
+    while day < datetime.date(2012, 1, 1):
+        assert _utils.guess_world_from_frame(login_frame(last_visit(day))) == previous_version(day)
+        day += datetime.timedelta(days=1)
+
+
+@pytest.mark.parametrize('message_type', (0x11, 0x13, 0x14, 0x16))
+def test_guess_world_from_frame_message_types(message_type):
+    assert _utils.guess_world_from_frame(login_frame(last_visit(datetime.date(2005, 3, 12)), message_type=message_type)) == 740
+
+
+def test_guess_world_from_frame_invalid_date():
+    # A login message with a date that does not exist is skipped, instead of raising ValueError
+    assert _utils.guess_world_from_frame(login_frame('Your last visit in Tibia: 31. Feb 2005 18:12:22 CET.')) is None
+    assert _utils.guess_world_from_frame(login_frame('Your last visit in Tibia: 12. Foo 2005 18:12:22 CET.')) is None
+    assert _utils.guess_world_from_frame(login_frame('Your last visit in Tibia: 31. Feb 2005 18:12:22 CET.',
+                                                     'Your last visit in Tibia: 12. Mar 2005 18:12:22 CET.')) == 740
+
+
+def test_guess_world_from_frame_no_login():
+    assert _utils.guess_world_from_frame(login_frame('Welcome to Antica!')) is None
+    assert _utils.guess_world_from_frame(string_frame('Your last visit in Tibia: 12. Mar 2005 18:12:22 CET.')) is None
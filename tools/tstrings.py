@@ -23,13 +23,10 @@ if __name__ == '__main__':
 
     for filename in filenames:
         try:
-            rec = recording.load(filename, allow_partial)
+            for string in _utils.get_all_strings(recording.iter_frames(filename, allow_partial, use_mmap=True), min_len, unique, smart):
+                if print_filename:
+                    print(f"{filename}: {string}")
+                else:
+                    print(string)
         except Exception as e:
             print(f"'{filename}': could not load file: {e}")
-            continue
-
-        for string in _utils.get_all_strings(rec.frames, min_len, unique, smart):
-            if print_filename:
-                print(f"{filename}: {string}")
-            else:
-                print(string)